@@ -0,0 +1,58 @@
+"""Benchmark the ddhodge potential and curl operator on kNN graphs of increasing size.
+
+Usage: python benchmarks/bench_hodge.py [n_cells ...] [-k K] [--max-qr N]
+
+The graph is the antisymmetric kNN graph of uniform 2D points with a noisy gradient flow as edge weights. The sparse
+conjugate gradient potential is compared with the dense QR solve for up to `--max-qr` cells. Peak memory is measured
+with `tracemalloc`.
+"""
+import argparse
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.neighbors import NearestNeighbors
+
+from dynamo.external.hodge import build_graph, curlop, div, potential
+
+
+def knn_flow_graph(n, k, rng):
+    X = rng.rand(n, 2)
+    idx = NearestNeighbors(n_neighbors=k + 1).fit(X).kneighbors(X)[1]
+    rows, cols = np.repeat(np.arange(n), k), idx[:, 1:].flatten()
+    w = (X[cols, 0] - X[rows, 0]) + 0.1 * rng.randn(len(rows))
+    A = sp.csr_matrix((np.r_[w, -w], (np.r_[rows, cols], np.r_[cols, rows])), shape=(n, n))
+    return build_graph(A)
+
+
+def measure(f):
+    tracemalloc.start()
+    t = time.time()
+    res = f()
+    elapsed, peak = time.time() - t, tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return res, elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("n_cells", type=int, nargs="*", default=[2000, 10000, 50000, 200000])
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--max-qr", type=int, default=3000)
+    args = parser.parse_args()
+    warnings.filterwarnings("ignore")
+
+    rng = np.random.RandomState(0)
+    for n in args.n_cells:
+        g = knn_flow_graph(n, args.k, rng)
+        d = -div(g)
+        p, t_cg, m_cg = measure(lambda: potential(g, d))
+        C, t_curl, m_curl = measure(lambda: curlop(g))
+        line = f"{n} cells, {g.ecount()} edges: potential (cg) {t_cg:.2f} s / {m_cg:.0f} MiB, " \
+               f"curlop {t_curl:.2f} s / {m_curl:.0f} MiB ({C.shape[0]} triangles)"
+        if n <= args.max_qr:
+            p_qr, t_qr, m_qr = measure(lambda: potential(g, d, method="qr"))
+            line += f", potential (qr) {t_qr:.2f} s / {m_qr:.0f} MiB, max |dp| {np.abs(p - p_qr).max():.1e}"
+        print(line, flush=True)
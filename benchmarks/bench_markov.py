@@ -0,0 +1,69 @@
+"""Benchmark `KernelMarkovChain.fit` against the original per-cell loop.
+
+Usage: python benchmarks/bench_markov.py [n_cells ...]
+
+The per-cell loop (built from the row-wise kernels that are still in `dynamo.tools.Markov`) is only timed for up to
+`--max-loop` cells since it scales poorly. Peak memory is measured with `tracemalloc`.
+"""
+import argparse
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import scipy.sparse as sp
+
+from dynamo.tools.Markov import KernelMarkovChain, compute_density_kernel, compute_drift_kernel
+
+
+def loop_fit(X, V, M_diff, Idx, epsilon=None, tol=1e-4):
+    n = X.shape[0]
+    P = sp.lil_matrix((n, n))
+    inv_s = 1 / M_diff
+    if epsilon is not None:
+        Kd = sp.lil_matrix((n, n))
+        for i in range(n):
+            Kd[i, Idx[i]] = compute_density_kernel(X[i], X[Idx[i]], 1 / epsilon)
+        D = np.asarray(sp.csc_matrix(Kd).sum(0)).flatten()
+    for i in range(n):
+        k = compute_drift_kernel(X[i], V[i], X[Idx[i]], inv_s)
+        if epsilon is not None:
+            k = k / D[Idx[i]]
+        p = k / np.sum(k) if np.sum(k) > 0 else np.ones_like(k) / n
+        p[p <= tol] = 0
+        P[Idx[i], i] = p / np.sum(p)
+    return sp.csc_matrix(P)
+
+
+def measure(f):
+    tracemalloc.start()
+    t = time.time()
+    res = f()
+    elapsed, peak = time.time() - t, tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return res, elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("n_cells", type=int, nargs="*", default=[10000, 100000])
+    parser.add_argument("--dim", type=int, default=30)
+    parser.add_argument("-k", type=int, default=30)
+    parser.add_argument("--max-loop", type=int, default=100000)
+    args = parser.parse_args()
+    warnings.filterwarnings("ignore")
+
+    rng = np.random.RandomState(0)
+    for n in args.n_cells:
+        X, V = rng.normal(size=(n, args.dim)), 0.3 * rng.normal(size=(n, args.dim))
+        # distinct random neighbors for every cell (like a kNN graph, without the cost of building one)
+        offsets = rng.choice(np.arange(1, n), args.k - 1, replace=False)
+        Idx = (np.arange(n)[:, None] + np.hstack(([0], offsets))[None, :]) % n
+
+        mc = KernelMarkovChain()
+        _, t_new, m_new = measure(lambda: mc.fit(X, V, 1.0, neighbor_idx=Idx, epsilon=1.0))
+        line = f"{n} cells: vectorized {t_new:.2f} s / {m_new:.0f} MiB"
+        if n <= args.max_loop:
+            P, t_old, m_old = measure(lambda: loop_fit(X, V, 1.0, Idx, epsilon=1.0))
+            line += f", loop {t_old:.2f} s / {m_old:.0f} MiB, max |dP| {abs(P - mc.P).max():.1e}"
+        print(line, flush=True)
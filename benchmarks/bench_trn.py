@@ -0,0 +1,59 @@
+"""Benchmark the compiled TRN sampler (`TRNET.run`) against the original per-step `TRNET.runOnce` loop.
+
+Usage: python benchmarks/bench_trn.py [n_nodes ...] [--cells N] [--dim D] [--tmax T] [--max-loop N]
+
+The data is a mixture of two gaussian blobs. The per-step loop is only run for up to `--max-loop` nodes since it takes
+tmax * n_nodes steps of O(n_nodes log n_nodes). The quantization error is the mean distance from each cell to its
+closest node.
+"""
+import argparse
+import time
+import warnings
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+from dynamo.tools.sampling import TRNET
+
+
+def loop_run(trnet, tmax=200, li=0.2, lf=0.01, ei=0.3, ef=0.05, c=0):
+    tmax = int(tmax * trnet.n_nodes)
+    li = li * trnet.n_nodes
+    P = np.asarray(trnet.draw_sample(tmax), dtype=float)
+    trnet.W = np.array(trnet.W, dtype=float)
+    for t in range(1, tmax + 1):
+        tt = t / tmax
+        trnet.runOnce(P[t - 1], li * np.power(lf / li, tt), ei * np.power(ef / ei, tt), c)
+
+
+def quantization_error(X, W):
+    return NearestNeighbors(n_neighbors=1).fit(W).kneighbors(X)[0].mean()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("n_nodes", type=int, nargs="*", default=[100, 500, 2000])
+    parser.add_argument("--cells", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=30)
+    parser.add_argument("--tmax", type=float, default=200)
+    parser.add_argument("--max-loop", type=int, default=500)
+    args = parser.parse_args()
+    warnings.filterwarnings("ignore")
+
+    rng = np.random.RandomState(0)
+    n = args.cells
+    X = np.vstack([rng.normal(size=(n // 2, args.dim)), rng.normal(size=(n - n // 2, args.dim)) * 0.5 + 3])
+    TRNET(5, X).run(tmax=2)  # compile
+
+    for n_nodes in args.n_nodes:
+        trnet = TRNET(n_nodes, X)
+        t = time.time()
+        trnet.run(tmax=args.tmax)
+        line = f"{n_nodes} nodes: compiled {time.time() - t:.2f} s (error {quantization_error(X, trnet.W):.4f})"
+        if n_nodes <= args.max_loop:
+            ref = TRNET(n_nodes, X)
+            t = time.time()
+            loop_run(ref, tmax=args.tmax)
+            line += f", loop {time.time() - t:.2f} s (error {quantization_error(X, ref.W):.4f}), " \
+                    f"max |dW| {np.abs(trnet.W - ref.W).max():.1e}"
+        print(line, flush=True)
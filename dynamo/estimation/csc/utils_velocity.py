@@ -258,6 +258,74 @@ def fit_linreg(x, y, mask=None, intercept=False, r2=True):
     else:
         return k, b
 
+
+def fit_linreg_batch(X, Y, mask=None, intercept=False, r2=True):
+    """Vectorized version of `fit_linreg` that performs the simple linear regression y = kx + b for each row of X and Y
+    at once.
+
+    Arguments
+    ---------
+    X: :class:`~numpy.ndarray` or sparse `csr_matrix`
+        A matrix of independent variables. Dimension: genes x cells.
+    Y: :class:`~numpy.ndarray` or sparse `csr_matrix`
+        A matrix of dependent variables. Dimension: genes x cells.
+    mask: :class:`~numpy.ndarray` or None
+        A boolean matrix (genes x cells) of the data points used for the regression of each gene.
+    intercept: bool
+        If using steady state assumption for fitting, then:
+        True -- the linear regression is performed with an unfixed intercept;
+        False -- the linear regresssion is performed with a fixed zero intercept
+
+    Returns
+    -------
+    k: :class:`~numpy.ndarray`
+        The estimated slopes.
+    b: :class:`~numpy.ndarray`
+        The estimated intercepts.
+    r2: :class:`~numpy.ndarray`
+        Coefficient of determination or r square calculated with the extreme data points.
+    all_r2: :class:`~numpy.ndarray`
+        The r2 calculated using all data points.
+    """
+    X = X.A if issparse(X) else np.asarray(X, dtype=float)
+    Y = Y.A if issparse(Y) else np.asarray(Y, dtype=float)
+
+    _mask = np.logical_and(~np.isnan(X), ~np.isnan(Y))
+    if mask is not None:
+        _mask &= mask
+    n = _mask.sum(1)
+    xx, yy = np.where(_mask, X, 0), np.where(_mask, Y, 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        xm, ym = xx.sum(1) / n, yy.sum(1) / n
+        if intercept:
+            cov = np.einsum('ij,ij->i', xx, yy) / n - xm * ym
+            var_x = np.einsum('ij,ij->i', xx, xx) / n - xm * xm
+            k = cov / var_x
+            b = ym - k * xm
+        else:
+            # use uncentered cov and var_x
+            cov = np.einsum('ij,ij->i', xx, yy) / n
+            var_x = np.einsum('ij,ij->i', xx, xx) / n
+            k = cov / var_x
+            b = np.zeros_like(k)
+
+        if r2:
+            # yy and xx are reused as buffers of the centered y and the residuals of the extreme data points.
+            np.subtract(yy, ym[:, None], out=yy, where=_mask)
+            SS_tot_n = np.einsum('ij,ij->i', yy, yy) / n
+            res = Y - k[:, None] * X
+            res -= b[:, None]
+            np.copyto(xx, np.where(_mask, res, 0))
+            SS_res_n, all_SS_res_n = np.einsum('ij,ij->i', xx, xx) / n, np.einsum('ij,ij->i', res, res) / X.shape[1]
+            all_SS_tot_n = np.var(Y, 1)
+            r2, all_r2 = 1 - SS_res_n / SS_tot_n, 1 - all_SS_res_n / all_SS_tot_n
+
+            return k, b, r2, all_r2
+        else:
+            return k, b
+
+
 def fit_linreg_robust(x, y, mask=None, intercept=False, r2=True, est_method='rlm'):
     """Apply robust linear regression of y w.r.t x.
 
@@ -506,7 +506,11 @@ class ss_estimation:
                         if self.data["sl"] is None
                         else self.data["su"] + self.data["sl"]
                     )
-                    if cores == 1:
+                    if self.est_method.lower() == 'ols':
+                        (gamma, gamma_intercept, _, gamma_r2, _, gamma_logLL) = self.fit_gamma_steady_state_batch(
+                            U, S, intercept, perc_left, perc_right
+                        )
+                    elif cores == 1:
                         for i in tqdm(range(n), desc="estimating gamma"):
                             (
                                 gamma[i],
@@ -544,7 +548,11 @@ class ss_estimation:
                     )
                     U = self.data["ul"]
                     S = self.data["uu"] + self.data["ul"]
-                    if cores == 1:
+                    if self.est_method.lower() == 'ols':
+                        (gamma, gamma_intercept, _, gamma_r2, _, gamma_logLL) = self.fit_gamma_steady_state_batch(
+                            U, S, intercept, perc_left, perc_right
+                        )
+                    elif cores == 1:
                         for i in tqdm(range(n), desc="estimating gamma"):
                             (
                                 gamma[i],
@@ -938,7 +946,14 @@ class ss_estimation:
                                 )
                                 U, S = self.data["ul"], self.data["uu"] + self.data["ul"]
 
-                                if cores == 1:
+                                if self.est_method.lower() == 'ols':
+                                    (gamma_k, gamma_intercept, _, gamma_r2, _, gamma_logLL) = \
+                                        self.fit_gamma_steady_state_batch(U, S, False, None, perc_right)
+                                    gamma = -np.log(1 - gamma_k[:, None]) / t_uniq
+                                    gamma = gamma[:, 0]
+                                    self.parameters["alpha"] = U.multiply((gamma / gamma_k)[:, None]) if issparse(U) \
+                                        else U * (gamma / gamma_k)[:, None]
+                                elif cores == 1:
                                     for i in tqdm(range(n), desc="estimating gamma"):
                                         (
                                             gamma_k[i],
@@ -1233,7 +1248,11 @@ class ss_estimation:
                     if self._exist_data("sl")
                     else self.data["su"][ind_for_proteins]
                 )
-                if cores == 1:
+                if self.est_method.lower() == 'ols':
+                    (delta, delta_intercept, _, delta_r2, _, delta_logLL) = self.fit_gamma_steady_state_batch(
+                        s, self.data["p"], intercept, perc_left, perc_right
+                    )
+                elif cores == 1:
                     for i in tqdm(range(n), desc="estimating delta"):
                         (
                             delta[i],
@@ -1317,6 +1336,65 @@ class ss_estimation:
 
         return k, b, r2, all_r2, logLL, all_logLL
 
+    def fit_gamma_steady_state_batch(
+        self, U, S, intercept=True, perc_left=None, perc_right=5, normalize=True, chunk_size=None
+    ):
+        """Vectorized version of `fit_gamma_steady_state` that estimates gamma of all genes at once with the closed-form
+        least squares solution. The extreme data points of each gene are also identified vectorially. Sparse matrices are
+        densified in chunks of `chunk_size` genes.
+
+        Arguments
+        ---------
+            U: :class:`~numpy.ndarray` or sparse `csr_matrix`
+                A matrix of unspliced mRNA counts. Dimension: genes x cells.
+            S: :class:`~numpy.ndarray` or sparse `csr_matrix`
+                A matrix of spliced mRNA counts. Dimension: genes x cells.
+            intercept: bool
+                If using steady state assumption for fitting, then:
+                True -- the linear regression is performed with an unfixed intercept;
+                False -- the linear regresssion is performed with a fixed zero intercept.
+            perc_left: float
+                The percentage of samples included in the linear regression in the left tail. If set to None, then all the
+                left samples are excluded.
+            perc_right: float
+                The percentage of samples included in the linear regression in the right tail. If set to None, then all the
+                samples are included.
+            normalize: bool
+                Whether to first normalize the data.
+            chunk_size: int or None
+                The number of genes processed together. If None, it is chosen so that each chunk has at most ~2^18
+                elements.
+
+        Returns
+        -------
+            k, b, r2, all_r2, logLL, all_logLL: :class:`~numpy.ndarray`
+                The same values returned by `fit_gamma_steady_state`, one for each gene.
+        """
+        if intercept and perc_left is None:
+            perc_left = perc_right
+        n_genes, n_cells = U.shape
+        chunk_size = max(1, 2 ** 18 // max(n_cells, 1)) if chunk_size is None else chunk_size
+        res = np.zeros((6, n_genes))
+
+        for i in range(0, n_genes, chunk_size):
+            u = U[i:i + chunk_size].A if issparse(U) else np.asarray(U[i:i + chunk_size], dtype=float)
+            s = S[i:i + chunk_size].A if issparse(S) else np.asarray(S[i:i + chunk_size], dtype=float)
+
+            mask = find_extreme(s, u, normalize=normalize, perc_left=perc_left, perc_right=perc_right, axis=1)
+            k, b, r2, all_r2 = fit_linreg_batch(s, u, mask, intercept)
+
+            # the log-likelihood of u ~ N(k * s, sigma) where sigma is the root of the residual sum of squares, the same
+            # as calc_norm_loglikelihood.
+            d = k[:, None] * s - u
+            SS, all_SS = np.where(mask, d ** 2, 0).sum(1), (d ** 2).sum(1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                logLL = -mask.sum(1) / 2 * np.log(2 * np.pi) - 0.5 * np.log(SS) - 0.5 * SS / SS
+                all_logLL = -n_cells / 2 * np.log(2 * np.pi) - 0.5 * np.log(all_SS) - 0.5 * all_SS / all_SS
+
+            res[:, i:i + chunk_size] = k, b, r2, all_r2, logLL, all_logLL
+
+        return tuple(res)
+
     def fit_gamma_stochastic(
         self, est_method, u, s, us, ss, perc_left=None, perc_right=5, normalize=True
     ):
@@ -46,9 +46,16 @@ class kinetic_estimation:
                 An instance of python class which solves ODEs. It should have properties 't' (k time points, 1d numpy array),
                 'x0' (initial conditions for m species, 1d numpy array), and 'x' (solution, k-by-m array), 
                 as well as two functions: integrate (numerical integration), solve (analytical method).
+
+        Attributes
+        ----------
+            random_state: :class:`~numpy.random.RandomState` or None
+                The random state used to sample the initial guesses of parameters. If None, latin hypercube samples are
+                drawn with a fixed seed and uniform samples from numpy's global random state.
     '''
     def __init__(self, param_ranges, x0_ranges, simulator):
         self.simulator = simulator
+        self.random_state = None
 
         self.ranges = []
         self.fixed_parameters = np.ones(len(param_ranges) + len(x0_ranges)) * np.nan
@@ -79,7 +86,7 @@ class kinetic_estimation:
         else:
             for n in range(samples):
                 for i in range(self.n_params):
-                    r = np.random.rand()
+                    r = np.random.rand() if self.random_state is None else self.random_state.rand()
                     ret[n, i] = r * (self.ranges[i][1] - self.ranges[i][0]) + self.ranges[i][0]
         return ret
 
@@ -87,7 +94,8 @@ class kinetic_estimation:
         # From PyDOE
         # Generate the intervals
         #from .utils import lhsclassic
-        H = lhsclassic(samples, self.n_params)
+        H = lhsclassic(samples, self.n_params) if self.random_state is None else \
+            lhsclassic(samples, self.n_params, seed=self.random_state)
 
         return H
 
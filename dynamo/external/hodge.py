@@ -4,7 +4,11 @@
 # Code adapted from https://github.com/kazumits/ddhodge.
 
 import numpy as np
-from scipy.sparse import csr_matrix
+import warnings
+from inspect import signature
+from scipy.sparse import csr_matrix, diags
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import cg
 from scipy.linalg import qr
 from itertools import combinations
 from igraph import Graph
@@ -12,6 +16,44 @@ from ..vectorfield.scVectorField import graphize_vecfld
 from ..vectorfield.utils import vecfld_from_adata, vector_field_function
 from ..tools.sampling import trn, sample_by_velocity
 
+def _edge_pairs(g):
+    """Edges of the graph with the unordered vertex pair key of each, and the id of the first edge of each pair."""
+    n = g.vcount()
+    e = np.array(g.get_edgelist(), dtype=np.int64).reshape(-1, 2)
+    key = np.minimum(e[:, 0], e[:, 1]) * n + np.maximum(e[:, 0], e[:, 1])
+    order = np.argsort(key, kind='stable')
+    pair_key, first = np.unique(key[order], return_index=True)
+
+    return e, pair_key, order[first]
+
+
+def _triangles_from_pairs(pair_key, n, chunk_size=2**22):
+    """Enumerate the triangles (i < j < k) of the undirected graph given by the sorted unordered vertex pair keys."""
+    i, j = pair_key // n, pair_key % n
+    valid = i != j
+    U = csr_matrix((np.ones(valid.sum(), dtype=np.int8), (i[valid], j[valid])), shape=(n, n))
+    U.sort_indices()
+    ei, ej = i[valid], j[valid]
+    deg = np.diff(U.indptr)[ej]
+
+    tri, start = [], 0
+    while start < len(ei):
+        # take edges until the number of candidate third vertices reaches chunk_size
+        stop = start + max(1, np.searchsorted(np.cumsum(deg[start:]), chunk_size))
+        ci, cj, cd = ei[start:stop], ej[start:stop], deg[start:stop]
+        rep = np.repeat(np.arange(len(ci)), cd)
+        offsets = np.arange(len(rep)) - np.repeat(np.cumsum(cd) - cd, cd)
+        ck = U.indices[U.indptr[cj][rep] + offsets]
+        ci = ci[rep]
+        found = np.searchsorted(pair_key, ci * n + ck)
+        found[found == len(pair_key)] = 0
+        is_tri = pair_key[found] == ci * n + ck
+        tri.append(np.vstack((ci[is_tri], cj[rep][is_tri], ck[is_tri])).T)
+        start = stop
+
+    return np.vstack(tri) if len(tri) > 0 else np.zeros((0, 3), dtype=np.int64)
+
+
 def gradop(g):
     e = np.array(g.get_edgelist())
     ne = g.ecount()
@@ -25,23 +67,18 @@ def divop(g):
 
 
 def curlop(g):
-    triv = np.array(g.cliques(min=3, max=3))
+    """The curl operator (n_triangles x n_edges) of the graph. Each triangle i < j < k is oriented by the direction of
+    the (first) edge between i and j, and uses the first edge between each pair of its vertices."""
+    n = g.vcount()
+    e, pair_key, pair_eid = _edge_pairs(g)
+    triv = _triangles_from_pairs(pair_key, n)
     ntri = triv.shape[0]
 
-    if ntri == 1:
-        return np.zeros((0, g.ecount())) * np.nan
-    else:
-        trie = np.zeros_like(triv)
-        for i, x in enumerate(triv):
-            trie[i] = g.get_eids(path=np.hstack((x, x[0])), directed=False)
-
-        edges = np.array(g.get_edgelist())
-        cc = np.zeros_like(trie)
-        for i, x in enumerate(trie):
-            e = edges[x]
-            cc[i] = [1,
-                     1 if e[0, 1] == e[1, 0] or e[0, 0] == e[1, 1] else -1,
-                     1 if e[0, 1] == e[2, 0] or e[0, 0] == e[2, 1] else -1]
+    # edges along the cycle i -> j -> k -> i
+    heads, tails = triv, np.roll(triv, -1, axis=1)
+    trie = pair_eid[np.searchsorted(pair_key, np.minimum(heads, tails) * n + np.maximum(heads, tails))]
+    s = np.where(e[trie, 0] == heads, 1, -1)
+    cc = s * s[:, :1]
 
     i, j, x = np.repeat(range(ntri), 3), trie.flatten(), cc.flatten()
 
@@ -60,23 +97,73 @@ def laplacian1(g):
     return cur_mat.T.dot(cur_mat) - grad_mat.dot(grad_mat.T)
 
 
-def potential(g, div_neg=None):
+def graph_laplacian(g):
+    """Sparse Laplacian of the undirected simple graph (multiple edges collapsed, self-loops and weights ignored)
+    underlying g, the same as `g.laplacian()` of the undirected copy of g."""
+    n = g.vcount()
+    _, pair_key, _ = _edge_pairs(g)
+    i, j = pair_key // n, pair_key % n
+    valid = i != j
+    A = csr_matrix((np.ones(valid.sum()), (i[valid], j[valid])), shape=(n, n))
+    A = A + A.T
+
+    return diags(np.asarray(A.sum(1)).flatten()) - A
+
+
+def potential(g, div_neg=None, method='cg', tol=1e-10, maxiter=None):
     """potential is related to the intrinsic time. Note that the returned value from this function is the negative of
-    potential. Thus small potential is related to smaller intrinsic time and vice versa."""
+    potential. Thus small potential is related to smaller intrinsic time and vice versa.
+
+    The potential is the minimum norm least squares solution of `L p = div_neg`, where `L` is the Laplacian of the
+    undirected graph, shifted so that its minimum is zero. With `method` `cg` (or `amg`), `L` is kept sparse and the
+    system is solved with the (Jacobi or algebraic multigrid preconditioned) conjugate gradient method, while its
+    nullspace, the constant potential on each connected component, is removed by projection. `qr` uses the dense QR
+    decomposition of `L`, which is only feasible for a few thousand cells.
+    """
 
     div_neg = -div(g) if div_neg is None else div_neg
-    g_undirected = g.copy()
-    g_undirected.to_undirected()
-    L = np.array(g_undirected.laplacian())
-    Q, R = qr(L)
-    p = np.linalg.pinv(R).dot(Q.T).dot(div_neg)
+
+    if method == 'qr':
+        g_undirected = g.copy()
+        g_undirected.to_undirected()
+        L = np.array(g_undirected.laplacian())
+        Q, R = qr(L)
+        p = np.linalg.pinv(R).dot(Q.T).dot(div_neg)
+    elif method in ['cg', 'amg']:
+        L = graph_laplacian(g)
+        n_comp, labels = connected_components(L, directed=False)
+        comp_size = np.bincount(labels, minlength=n_comp)
+
+        def project(x):
+            return x - (np.bincount(labels, weights=x, minlength=n_comp) / comp_size)[labels]
+
+        b = project(np.asarray(div_neg, dtype=float))
+        if method == 'amg':
+            try:
+                import pyamg
+            except ImportError:
+                raise ImportError("You need to install the package `pyamg`. Install pyamg via `pip install pyamg`")
+            M = pyamg.smoothed_aggregation_solver(L.tocsr(), symmetry='symmetric').aspreconditioner(cycle='V')
+        else:
+            d = L.diagonal()
+            d[d == 0] = 1
+            M = diags(1 / d)
+
+        # scipy >= 1.12 renamed the relative tolerance `tol` to `rtol`
+        cg_tol = {'rtol': tol} if 'rtol' in signature(cg).parameters else {'tol': tol}
+        p, info = cg(L, b, M=M, atol=0, maxiter=maxiter, **cg_tol)
+        if info > 0:
+            warnings.warn(f"conjugate gradient didn't converge to the tolerance {tol} in {info} iterations.")
+        p = project(p)
+    else:
+        raise ValueError(f"method can be only one of {'cg', 'amg', 'qr'}")
 
     res = p - p.min()
     return res
 
 
 def grad(g, tol=1e-7):
-    return gradop(g).dot(potential(g, tol))
+    return gradop(g).dot(potential(g, tol=tol))
 
 
 def div(g):
@@ -159,9 +246,10 @@ def ddhodge(adata,
             The method to build the ajacency matrix that will be used to create the sparse diffusion graph, can be either
             "naive" or "graphize_vecfld". If "naive" used, the transition_matrix that created during vector field projection
             will be used; if "graphize_vecfld" used, a method that guarantees the preservance of divergence will be used.
-        n_downsamples: `int` (default: `5000`)
+        n_downsamples: `int` or None (default: `5000`)
             Number of cells to downsample to if the cell number is large than this value. Three downsampling methods are
-            available, see `sampling_method`.
+            available, see `sampling_method`. If None, all cells are used, which is feasible for large datasets since
+            the potential is solved on the sparse graph Laplacian.
         up_sampling: `bool` (default: `True`)
             Whether to assign calculated potential, curl and divergence to cells not sampled based on values from their
             nearest sampled cells.
@@ -187,7 +275,7 @@ def ddhodge(adata,
 """
 
     prefix = '' if basis is None else basis + '_'
-    to_downsample = adata.n_obs > n_downsamples
+    to_downsample = n_downsamples is not None and adata.n_obs > n_downsamples
 
     if VecFld is None:
         VecFld, func = vecfld_from_adata(adata, basis)
@@ -3,6 +3,7 @@ import matplotlib.pyplot as plt
 from matplotlib import cm
 from matplotlib.colors import ListedColormap
 from ..tools.utils import flatten, isarray, velocity_on_grid
+from ..vectorfield.utils import load_jacobian_gene
 #from ..tools.Markov import smoothen_drift_on_grid
 
 SchemeDiverge = {
@@ -214,13 +215,14 @@ def multiplot(plot_func, arr, n_row=None, n_col=3, fig=None, subplot_size=(6, 4)
 def plot_jacobian_gene(adata, jkey='jacobian', basis='pca', regulators=None, effectors=None, **kwargs):
     jkey = f'{jkey}_{basis}' if basis is not None else jkey
     J_dict = adata.uns[jkey]
+    J = load_jacobian_gene(J_dict)
     c_arr = []
     ti_arr = []
     for i, reg in enumerate(J_dict['regulators']):
         if regulators is None or reg in regulators:
             for j, eff in enumerate(J_dict['effectors']):
                 if effectors is None or eff in effectors:
-                    c_arr.append(J_dict['jacobian_gene'][j, i, :])
+                    c_arr.append(J[j, i, :])
                     ti_arr.append(f"{eff} wrt. {reg}")
     multiplot(lambda c, ti: [zscatter(adata, color=c, **kwargs),
                                plt.title(ti)],
@@ -9,6 +9,7 @@ from .utils import save_fig
 
 from ..docrep import DocstringProcessor
 from ..external.hodge import ddhodge
+from ..vectorfield.utils import load_jacobian_gene
 
 docstrings = DocstringProcessor()
 
@@ -541,7 +542,7 @@ def jacobian_kinetics(
     Jacobian_ = "jacobian" if basis is None else "jacobian_" + basis
     Der, cell_indx, jacobian_gene, regulators_, effectors_ = adata.uns[Jacobian_].get('jacobian'), \
                                                               adata.uns[Jacobian_].get('cell_idx'), \
-                                                              adata.uns[Jacobian_].get('jacobian_gene'), \
+                                                              load_jacobian_gene(adata.uns[Jacobian_]), \
                                                               adata.uns[Jacobian_].get('regulators'), \
                                                               adata.uns[Jacobian_].get('effectors')
     if tkey == "potential" and "potential" not in adata.obs_keys():
@@ -21,7 +21,7 @@ from ..tools.utils import (
     flatten,
 )
 
-from ..vectorfield.utils import intersect_sources_targets
+from ..vectorfield.utils import intersect_sources_targets, load_jacobian_gene
 
 docstrings.delete_params("scatters.parameters", "adata", "color", "cmap", "frontier", "sym_c")
 docstrings.delete_params("scatters.parameters", "adata", "color", "cmap", "frontier")
@@ -375,7 +375,7 @@ def jacobian(adata,
     Jacobian_ = jkey if j_basis is None else jkey + "_" + j_basis
     Der, cell_indx, jacobian_gene, regulators_, effectors_ = adata.uns[Jacobian_].get(jkey.split("_")[-1]), \
                                                               adata.uns[Jacobian_].get('cell_idx'), \
-                                                              adata.uns[Jacobian_].get(jkey.split("_")[-1] + '_gene'), \
+                                                              load_jacobian_gene(adata.uns[Jacobian_], jkey.split("_")[-1] + '_gene'), \
                                                               adata.uns[Jacobian_].get('regulators'), \
                                                               adata.uns[Jacobian_].get('effectors')
 
@@ -609,7 +609,7 @@ def jacobian_heatmap(adata,
     if type(cell_idx) == int: cell_idx = [cell_idx]
     Der, cell_indx, jacobian_gene, regulators_, effectors_ = adata.uns[Jacobian_].get(jkey.split("_")[-1]), \
                                                               adata.uns[Jacobian_].get('cell_idx'), \
-                                                              adata.uns[Jacobian_].get(jkey.split("_")[-1] + '_gene'), \
+                                                              load_jacobian_gene(adata.uns[Jacobian_], jkey.split("_")[-1] + '_gene'), \
                                                               adata.uns[Jacobian_].get('regulators'), \
                                                               adata.uns[Jacobian_].get('effectors')
 
@@ -1,7 +1,7 @@
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
-from sklearn.neighbors import NearestNeighbors
+from scipy.sparse import csr_matrix, diags
 from multiprocessing.dummy import Pool as ThreadPool
 import itertools
 import warnings
@@ -9,8 +9,11 @@ from ..tools.utils import (
     fetch_states,
     getTseq,
 )
+from ..tools.connectivity import k_nearest_neighbors
+from ..tools.Markov import propagate_distribution
 from .utils import (
     integrate_vf_ivp,
+    integrate_vf_batch,
 )
 from ..vectorfield import vector_field_function
 from ..vectorfield.utils import vector_transformation
@@ -32,6 +35,7 @@ def fate(adata,
          Qkey='PCs',
          scale=1,
          cores=1,
+         integration_method="ivp",
          **kwargs
 ):
     """Predict the historical and future cell transcriptomic states over arbitrary time scales.
@@ -93,6 +97,10 @@ def fate(adata,
         cores: `int` (default: 1):
             Number of cores to calculate path integral for predicting cell fate. If cores is set to be > 1,
             multiprocessing will be used to parallel the fate prediction.
+        integration_method: `str` (default: `ivp`)
+            The integrator used by `_fate`, one of `{'ivp', 'batch', 'auto'}`. If `auto`, the batched integrator is used
+            with the reconstructed vector field and the ivp integrator is used when `VecFld_true` is provided, since the
+            latter may not accept a batch of cell states.
         kwargs:
             Additional parameters that will be passed into the fate function.
 
@@ -133,6 +141,9 @@ def fate(adata,
         init_states = init_states[:, dims]
 
     vf = (lambda x: scale*vector_field_function(x=x, vf_dict=VecFld, dim=dims)) if VecFld_true is None else VecFld_true
+    if integration_method == "auto":
+        integration_method = "batch" if VecFld_true is None else "ivp"
+
     t, prediction = _fate(
         vf,
         init_states,
@@ -142,6 +153,7 @@ def fate(adata,
         average=True if average in ['origin', 'trajectory', True] else False,
         sampling=sampling,
         cores=cores,
+        integration_method=integration_method,
         **kwargs
     )
 
@@ -212,6 +224,7 @@ def _fate(
     average=True,
     sampling='arc_length',
     cores=1,
+    integration_method="ivp",
 ):
     """Predict the historical and future cell transcriptomic states over arbitrary time scales by integrating vector field
     functions from one or a set of initial cell state(s).
@@ -244,6 +257,11 @@ def _fate(
         cores: `int` (default: 1):
             Number of cores to calculate path integral for predicting cell fate. If cores is set to be > 1,
             multiprocessing will be used to parallel the fate prediction.
+        integration_method: `str` (default: `ivp`)
+            One of `{'ivp', 'batch'}`. If `ivp`, each initial state is integrated separately with `solve_ivp`. If
+            `batch`, all initial states are advanced simultaneously with a batched Dormand-Prince solver, so that the
+            vector field function is evaluated on all the active states at once; `VecFld` must then accept a
+            (n_cells x n_features) array and `cores` is ignored.
 
     Returns
     -------
@@ -259,7 +277,19 @@ def _fate(
 
     t_linspace = getTseq(init_states, t_end, step_size)
 
-    if cores == 1:
+    if integration_method == "batch":
+        t, prediction = integrate_vf_batch(
+            init_states,
+            t_linspace,
+            direction,
+            VecFld,
+            interpolation_num=interpolation_num,
+            average=average,
+            sampling=sampling,
+        )
+    elif integration_method != "ivp":
+        raise ValueError(f"integration_method can only be one of {{'ivp', 'batch'}}, but got {integration_method}.")
+    elif cores == 1:
         t, prediction = integrate_vf_ivp(
             init_states,
             t_linspace,
@@ -417,20 +447,17 @@ def fate_bias(adata,
 
     X = adata.obsm[basis_key] if basis_key != 'X' else adata.X
 
-    if X.shape[0] > 5000 and X.shape[1] > 2:
-        from pynndescent import NNDescent
-
-        nbrs = NNDescent(X, metric=metric, metric_kwds=metric_kwds, n_neighbors=30, n_jobs=cores,
-                              random_state=seed, **kwargs)
-        knn, distances = nbrs.query(X, k=30)
-    else:
-        alg = 'ball_tree' if X.shape[1] > 10 else 'kd_tree'
-        nbrs = NearestNeighbors(n_neighbors=30, algorithm=alg, n_jobs=cores).fit(X)
-        distances, knn = nbrs.kneighbors(X)
+    knn, distances, nbrs = k_nearest_neighbors(X, k=30, basis=basis, metric=metric, metric_kwds=metric_kwds,
+                                               method='pynn' if X.shape[0] > 5000 and X.shape[1] > 2 else None,
+                                               cores=cores, seed=seed, return_index=True, **kwargs)
 
     median_dist = np.median(distances[:, 1])
+    # one step random walk on the kNN graph of the observed cells
+    n_obs = X.shape[0]
+    knn_graph = csr_matrix((np.repeat(1 / knn.shape[1], knn.size), (np.repeat(np.arange(n_obs), knn.shape[1]),
+                                                                     knn.flatten())), shape=(n_obs, n_obs))
 
-    pred_dict = {}
+    pred_dict, init_knn = {}, {}
     cell_predictions, cell_indx = adata.uns[fate_key]['prediction'], adata.uns[fate_key]['init_cells']
     t = adata.uns[fate_key]['t']
     confidence = np.zeros(len(t))
@@ -461,21 +488,8 @@ def fate_bias(adata,
             is_dist_larger_than_threshold = distances.flatten() < dist_threshold * median_dist
             if any(is_dist_larger_than_threshold):
 
-                # let us diffuse one step further to identify cells from terminal cell types in case
-                # cells with indices are all close to some random progenitor cells.
-                if hasattr(nbrs, 'query'):
-                    knn, _ = nbrs.query(X[knn.flatten(), :], k=30)
-                else:
-                   _, knn = nbrs.kneighbors(X[knn.flatten(), :])
-
-                fate_prob = clusters[knn.flatten()].value_counts() / len(knn.flatten())
-                if source_groups is not None:
-                    source_p = fate_prob[source_groups].sum()
-                    if 1 > source_p > 0:
-                        fate_prob[source_groups] = 0
-                        fate_prob[fate_prob.idxmax()] += source_p
-
-                pred_dict[i] = fate_prob
+                # the fate probability is calculated for all cell states at once below.
+                init_knn[i] = knn.flatten()
 
                 confidence[i] = 1 - (sum(~ is_dist_larger_than_threshold) + walk_back_steps) / (
                         len(is_dist_larger_than_threshold) + walk_back_steps)
@@ -496,6 +510,36 @@ def fate_bias(adata,
                 knn, distances = knn[:, 0], distances[:, 0]
                 indices = indices - 1
 
+    if len(init_knn) > 0:
+        # let us diffuse one step further to identify cells from terminal cell types in case cells with indices are all
+        # close to some random progenitor cells. The distributions of all cell states are diffused in one batch.
+        rows = np.repeat(np.arange(len(init_knn)), [len(v) for v in init_knn.values()])
+        cols = np.hstack(list(init_knn.values()))
+        P0 = csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(init_knn), n_obs))
+        P0 = diags(1 / np.asarray(P0.sum(1)).flatten()).dot(P0)
+        P1 = propagate_distribution(knn_graph, P0, steps=1)
+
+        groups = pd.Categorical(clusters)
+        group_ind = csr_matrix((np.ones(n_obs), (np.arange(n_obs), groups.codes)),
+                               shape=(n_obs, len(groups.categories)))
+        fate_probs = P1.dot(group_ind).A
+
+        for j, i in enumerate(init_knn.keys()):
+            fate_prob = pd.Series(fate_probs[j], index=groups.categories)
+            if not isinstance(clusters.dtype, pd.CategoricalDtype):
+                fate_prob = fate_prob[fate_prob > 0]
+            fate_prob = fate_prob.sort_values(ascending=False, kind='stable')
+            if source_groups is not None:
+                # source groups that none of the neighbors belong to are absent for non-categorical groups
+                reached = fate_prob.index.intersection(source_groups)
+                source_p = fate_prob[reached].sum()
+                if 1 > source_p > 0:
+                    fate_prob[reached] = 0
+                    fate_prob[fate_prob.idxmax()] += source_p
+
+            pred_dict[i] = fate_prob
+
+    pred_dict = {i: pred_dict[i] for i in sorted(pred_dict.keys())}
     bias = pd.DataFrame(pred_dict).T
     conf = pd.DataFrame({"confidence": confidence}, index=bias.index)
     bias = pd.merge(conf, bias, left_index=True, right_index=True)
@@ -76,13 +76,10 @@ def integrate_vf_ivp(init_states,
                 dense_output=True,
             )
             y, t_trans = (
-                np.hstack((y_ivp_b.y[::-1, :], y_ivp_f.y)),
+                np.hstack((y_ivp_b.y[:, ::-1], y_ivp_f.y)),
                 np.hstack((y_ivp_b.t[::-1], y_ivp_f.t)),
             )
             sol = [y_ivp_b.sol, y_ivp_f.sol]
-
-            if interpolation_num is not None:
-                interpolation_num = interpolation_num * 2
         else:
             raise Exception(
                 "both, forward, backward are the only valid direction argument strings"
@@ -95,6 +92,23 @@ def integrate_vf_ivp(init_states,
         if verbose:
             print("\nintegration time: ", len(t_trans))
 
+    if integration_direction == "both" and interpolation_num is not None:
+        interpolation_num = interpolation_num * 2
+
+    return sample_trajectories(T, Y, SOL, n_feature, integration_direction, interpolation_num, average, sampling,
+                               disable)
+
+
+def sample_trajectories(T, Y, SOL, n_feature, integration_direction, interpolation_num=250, average=True,
+                        sampling='arc_length', disable=False):
+    """Sample points along integrated trajectories with the dense solutions of each trajectory.
+
+    `T`, `Y` and `SOL` are lists of the integration time points, states (n_feature x n_time) and dense solution
+    callables (a pair of backward and forward solutions if `integration_direction` is `both`) of each trajectory, as
+    returned by the ivp or the batched integrators.
+    """
+
+    n_cell = len(T)
     if sampling == 'arc_length':
         Y_, t_ = [None] * n_cell, [None] * n_cell
         for i in tqdm(range(n_cell), desc="uniformly sampling points along a trajectory", disable=disable):
@@ -154,36 +168,200 @@ def integrate_vf_ivp(init_states,
         else:
             valid_t_trans = np.logspace(0, np.log10(max(t_uniq) + 1), interpolation_num) - 1
 
-        _Y = None
+        # all trajectories share the same time points, so their solutions go into one n_cell x n_time x n_feature
+        # buffer that is averaged or flattened at the end.
+        _Y = np.empty((n_cell, len(valid_t_trans), n_feature))
         if integration_direction == "both":
             neg_t_len = sum(valid_t_trans < 0)
         for i in tqdm(range(n_cell), desc="calculate solutions on the sampled time points", disable=disable):
-            cur_Y = (
-                SOL[i](valid_t_trans)
-                if integration_direction != "both"
-                else np.hstack(
-                    (
-                        SOL[i][0](valid_t_trans[:neg_t_len]),
-                        SOL[i][1](valid_t_trans[neg_t_len:]),
-                    )
-                )
-            )
-            _Y = cur_Y if _Y is None else np.hstack((_Y, cur_Y))
+            if integration_direction != "both":
+                _Y[i] = SOL[i](valid_t_trans).T
+            else:
+                _Y[i, :neg_t_len] = SOL[i][0](valid_t_trans[:neg_t_len]).T
+                _Y[i, neg_t_len:] = SOL[i][1](valid_t_trans[neg_t_len:]).T
 
-        t, Y = valid_t_trans, _Y
+        t = valid_t_trans
+        Y = _Y.mean(0) if n_cell > 1 and average else _Y.reshape((-1, n_feature))
 
-        # this part is buggy, need to fix
-        if n_cell > 1 and average:
-            t_len = int(len(t) / n_cell)
-            avg = np.zeros((n_feature, t_len))
+    return t, Y
 
-            for i in range(t_len):
-                avg[:, i] = np.mean(Y[:, np.arange(n_cell) * t_len + i], 1)
-            Y = avg
 
-        Y = Y.T
+# Dormand-Prince 5(4) tableau, identical to the one used by scipy.integrate.RK45
+_DP_A = [
+    [],
+    [1 / 5],
+    [3 / 40, 9 / 40],
+    [44 / 45, -56 / 15, 32 / 9],
+    [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+    [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+]
+_DP_B = np.array([35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84])
+_DP_E = np.array([-71 / 57600, 0, 71 / 16695, -71 / 1920, 17253 / 339200, -22 / 525, 1 / 40])
+
+
+def _rms(x):
+    return np.sqrt(np.mean(x ** 2, 1))
+
+
+def dopri5_batch(f, y0, t_bound, max_step=np.inf, rtol=1e-3, atol=1e-6, tol=1e-5, disable=False):
+    """Integrate an autonomous vector field from many initial states at once with the Dormand-Prince 5(4) method.
+
+    All trajectories are advanced simultaneously so that the vector field is evaluated on a stacked (n_active x d)
+    array at each stage. Each trajectory keeps its own step size and error control (the same controller as
+    `scipy.integrate.RK45`), and stops once it reaches `t_bound` or once the velocity on all dimensions is below `tol`.
+
+    Parameters
+    ----------
+        f: `function`
+            Vectorized vector field function mapping an (n x d) array of states to an (n x d) array of velocities.
+        y0: `numpy.ndarray`
+            Initial states, (n x d).
+        t_bound: `float`
+            End of the integration. A negative value integrates backward in time.
+        max_step: `float` (default: `np.inf`)
+            Maximal absolute step size.
+        rtol, atol: `float` (default: `1e-3`, `1e-6`)
+            Relative and absolute tolerances.
+        tol: `float` (default: `1e-5`)
+            Velocity threshold below which a trajectory is considered converged.
+        disable: `bool` (default: `False`)
+            Whether to disable the progress bar.
+
+    Returns
+    -------
+        T, Y, dY: `list`
+            For each trajectory, the accepted time points, the states (n_time x d) and the velocities (n_time x d).
+    """
+
+    fun = lambda x: np.reshape(f(x), x.shape)
+    y = np.array(y0, dtype=float)
+    n, d = y.shape
+    direction = 1.0 if t_bound >= 0 else -1.0
+    t_bound = abs(t_bound)
+
+    t, fy = np.zeros(n), fun(y)
+    # initial step size as in scipy.integrate._ivp.common.select_initial_step
+    scale = atol + np.abs(y) * rtol
+    d0, d1 = _rms(y / scale), _rms(fy / scale)
+    h0 = np.where((d0 < 1e-5) | (d1 < 1e-5), 1e-6, 0.01 * d0 / np.maximum(d1, 1e-300))
+    f1 = fun(y + direction * h0[:, None] * fy)
+    d2 = _rms((f1 - fy) / scale) / h0
+    h1 = np.where((d1 <= 1e-15) & (d2 <= 1e-15), np.maximum(1e-6, h0 * 1e-3),
+                  (0.01 / np.maximum(np.maximum(d1, d2), 1e-300)) ** (1 / 5))
+    h = np.minimum(np.minimum(100 * h0, h1), max_step)
+
+    idx_rec, t_rec, y_rec, f_rec = [np.arange(n)], [t.copy()], [y.copy()], [fy.copy()]
+    active, rejected = np.ones(n, dtype=bool), np.zeros(n, dtype=bool)
+    K = np.empty((7, n, d))
+
+    pbar = tqdm(total=n, desc="integration with batched Dormand-Prince solver", disable=disable)
+    while active.any():
+        ind = np.flatnonzero(active)
+        t_i, y_i = t[ind], y[ind]
+        remaining = t_bound - t_i
+        hh = np.minimum(h[ind], remaining)
+        last = hh >= remaining
+        dh = direction * hh[:, None]
+
+        K_ = K[:, :len(ind)]
+        K_[0] = fy[ind]
+        for s in range(1, 6):
+            K_[s] = fun(y_i + dh * np.tensordot(_DP_A[s], K_[:s], axes=1))
+        y_new = y_i + dh * np.tensordot(_DP_B, K_[:6], axes=1)
+        f_new = K_[6] = fun(y_new)
+
+        err = dh * np.tensordot(_DP_E, K_, axes=1)
+        err_norm = _rms(err / (atol + np.maximum(np.abs(y_i), np.abs(y_new)) * rtol))
+        accept = err_norm < 1
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factor = 0.9 * err_norm ** -0.2
+        factor = np.where(accept, np.where(err_norm == 0, 10, np.minimum(10, factor)), np.maximum(0.2, factor))
+        factor[accept & rejected[ind]] = np.minimum(1, factor[accept & rejected[ind]])
+        factor[~np.isfinite(err_norm)] = 0.2
+        h[ind] = np.minimum(hh * factor, max_step)
+        rejected[ind] = ~accept
+
+        acc = ind[accept]
+        t[acc] = np.where(last[accept], t_bound, t_i[accept] + hh[accept])
+        y[acc], fy[acc] = y_new[accept], f_new[accept]
+        idx_rec.append(acc)
+        t_rec.append(t[acc].copy())
+        y_rec.append(y_new[accept])
+        f_rec.append(f_new[accept])
+
+        converged = np.all(np.abs(f_new) < tol, 1)
+        too_small = h[ind] < 10 * np.spacing(np.maximum(t_i, 1.0))
+        done = (accept & (last | converged)) | too_small
+        active[ind[done]] = False
+        pbar.update(done.sum())
+    pbar.close()
+
+    idx_rec = np.hstack(idx_rec)
+    order = np.argsort(idx_rec, kind='stable')
+    bounds = np.searchsorted(idx_rec[order], np.arange(n + 1))
+    t_rec, y_rec, f_rec = direction * np.hstack(t_rec)[order], np.vstack(y_rec)[order], np.vstack(f_rec)[order]
+
+    T = [t_rec[bounds[i]:bounds[i + 1]] for i in range(n)]
+    Y = [y_rec[bounds[i]:bounds[i + 1]] for i in range(n)]
+    dY = [f_rec[bounds[i]:bounds[i + 1]] for i in range(n)]
+
+    return T, Y, dY
+
+
+def _hermite_sol(t, y, dy):
+    """Dense solution of a trajectory from its states and velocities, with the (n_feature x n_time) layout of the
+    dense output of solve_ivp."""
+    if len(t) < 2:
+        return lambda t_: np.repeat(y[0][:, None], len(np.atleast_1d(t_)), 1)
+
+    order = np.argsort(t)
+    spline = interpolate.CubicHermiteSpline(t[order], y[order], dy[order], axis=0)
+
+    return lambda t_: spline(t_).T
+
+
+def integrate_vf_batch(init_states,
+                       t,
+                       integration_direction,
+                       f,
+                       interpolation_num=250,
+                       average=True,
+                       sampling='arc_length',
+                       rtol=1e-3,
+                       atol=1e-6,
+                       disable=False,
+):
+    """integrating along a vectorized vector field function from all initial states at once with the batched
+    Dormand-Prince solver. Arguments and returned values are the same as `integrate_vf_ivp`, except that `f` has to
+    accept a (n_cell x n_feature) array of states."""
+
+    if init_states.ndim == 1: init_states = init_states[None, :]
+    n_cell, n_feature = init_states.shape
+    max_step = np.abs(t[-1] - t[0]) / interpolation_num
+
+    if integration_direction in ["forward", "backward"]:
+        t_bound = t[-1] - t[0] if integration_direction == "forward" else t[0] - t[-1]
+        T, Y_, dY = dopri5_batch(f, init_states, t_bound, max_step, rtol, atol, disable=disable)
+        Y = [y.T for y in Y_]
+        SOL = [_hermite_sol(*i) for i in zip(T, Y_, dY)]
+    elif integration_direction == "both":
+        T_f, Y_f, dY_f = dopri5_batch(f, init_states, t[-1] - t[0], max_step, rtol, atol, disable=disable)
+        T_b, Y_b, dY_b = dopri5_batch(f, init_states, t[0] - t[-1], max_step, rtol, atol, disable=disable)
+        T = [np.hstack((T_b[i][::-1], T_f[i])) for i in range(n_cell)]
+        Y = [np.vstack((Y_b[i][::-1], Y_f[i])).T for i in range(n_cell)]
+        SOL = [[_hermite_sol(T_b[i], Y_b[i], dY_b[i]), _hermite_sol(T_f[i], Y_f[i], dY_f[i])] for i in range(n_cell)]
+
+        if interpolation_num is not None:
+            interpolation_num = interpolation_num * 2
+    else:
+        raise Exception(
+            "both, forward, backward are the only valid direction argument strings"
+        )
+
+    return sample_trajectories(T, Y, SOL, n_feature, integration_direction, interpolation_num, average, sampling,
+                               disable)
 
-    return t, Y
 
 def integrate_streamline(
     X, Y, U, V, integration_direction, init_states, interpolation_num=100, average=True
@@ -244,20 +422,10 @@ def remove_redundant_points_trajectory(X, tol=1e-4, output_discard=False):
     X = np.atleast_2d(X)
     discard = np.zeros(len(X), dtype=bool)
     if X.shape[0] > 1:
-        for i in range(len(X) - 1):
-            dist = np.linalg.norm(X[i + 1] - X[i])
-            if dist < tol:
-                discard[i + 1] = True
+        discard[1:] = np.linalg.norm(np.diff(X, axis=0), axis=1) < tol
         X = X[~discard]
 
-    arclength = 0
-
-    x0 = X[0]
-    for i in range(1, len(X)):
-        tangent = X[i] - x0 if i == 1 else X[i] - X[i - 1]
-        d = np.linalg.norm(tangent)
-
-        arclength += d
+    arclength = np.linalg.norm(np.diff(X, axis=0), axis=1).sum()
 
     if output_discard:
         return (X, arclength, discard)
@@ -266,43 +434,38 @@ def remove_redundant_points_trajectory(X, tol=1e-4, output_discard=False):
 
 
 def arclength_sampling(X, step_length, t=None):
-    """uniformly sample data points on an arc curve that generated from vector field predictions."""
-    Y = []
-    x0 = X[0]
-    T = [] if t is not None else None
-    t0 = t[0] if t is not None else None
-    i = 1
-    terminate = False
-    arclength = 0
-
-    while i < len(X) - 1 and not terminate:
-        l = 0
-        for j in range(i, len(X)):
-            tangent = X[j] - x0 if j == i else X[j] - X[j - 1]
-            d = np.linalg.norm(tangent)
-            if l + d >= step_length:
-                x = x0 if j == i else X[j - 1]
-                y = x + (step_length - l) * tangent / d
-                if t is not None:
-                    tau = t0 if j == i else t[j - 1]
-                    tau += (step_length - l) / d * (t[j] - tau)
-                    T.append(tau)
-                    t0 = tau
-                Y.append(y)
-                x0 = y
-                i = j
-                break
-            else:
-                l += d
-        if j == len(X) - 1: i += 1
-        arclength += step_length
-        if l + d < step_length:
-            terminate = True
-
-    if T is not None:
-        return np.array(Y), arclength, T
+    """uniformly sample data points on an arc curve that generated from vector field predictions.
+
+    Points are placed at every `step_length` of the cumulative arc length by linear interpolation along the curve
+    (and along `t` if provided). As before, sampling stops after the first point that falls on the last segment.
+    """
+    X = np.atleast_2d(X)
+    seg = np.linalg.norm(np.diff(X, axis=0), axis=1)
+    cum_len = np.hstack((0, np.cumsum(seg)))
+
+    n_steps = 0
+    if len(X) > 2 and step_length > 0:
+        # allow for the round-off of the step size so that the end of the curve is not dropped
+        n_steps = int(np.floor(cum_len[-1] / step_length * (1 + 1e-12)))
+    s = step_length * np.arange(1, n_steps + 1)
+    s = np.minimum(s, cum_len[-1])
+    j = np.clip(np.searchsorted(cum_len, s, side="left"), 1, len(X) - 1)
+
+    last = np.where(j == len(X) - 1)[0]
+    if len(last) > 0:
+        s, j = s[: last[0] + 1], j[: last[0] + 1]
+    arclength = step_length * (len(s) + (len(last) == 0)) if len(X) > 2 else 0
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frac = np.nan_to_num((s - cum_len[j - 1]) / seg[j - 1])
+    Y = X[j - 1] + frac[:, None] * (X[j] - X[j - 1])
+
+    if t is not None:
+        t = np.asarray(t)
+        T = t[j - 1] + frac * (t[j] - t[j - 1])
+        return Y, arclength, T
     else:
-        return np.array(Y), arclength
+        return Y, arclength
 
 
 # ---------------------------------------------------------------------------------------------------
@@ -1579,7 +1579,6 @@ def recipe_monocle(
     if method == "pca":
         adata, fit, _ = pca(adata, CM, num_dim, "X_" + method.lower())
 
-        adata.uns["explained_variance_ratio_"] = fit.explained_variance_ratio_[1:]
         adata.obsm['X'] = adata.obsm["X_" + method.lower()]
     elif method == "ica":
         fit = FastICA(
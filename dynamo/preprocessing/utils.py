@@ -4,7 +4,7 @@ import statsmodels.api as sm
 from scipy.sparse import issparse, csr_matrix
 import warnings
 # from functools import reduce
-from sklearn.decomposition import PCA, TruncatedSVD
+from sklearn.decomposition import PCA
 
 
 # ---------------------------------------------------------------------------------------------------
@@ -480,27 +480,108 @@ def Freeman_Tukey(X, inverse=False):
 # pca
 
 
-def pca(adata, CM, n_pca_components=30, pca_key='X', pcs_key='PCs'):
+class _SparseCenteredPCA(PCA):
+    """Exact (centered) PCA of a sparse matrix without densifying it.
 
-    if adata.n_obs < 100000:
-        pca = PCA(n_components=min(n_pca_components, CM.shape[1] - 1), svd_solver="arpack", random_state=0)
-        fit = pca.fit(CM.toarray()) if issparse(CM) else pca.fit(CM)
-        X_pca = fit.transform(CM.toarray()) if issparse(CM) else fit.transform(CM)
-        adata.obsm[pca_key] = X_pca
-        adata.uns[pcs_key] = fit.components_.T
+    The centering is done implicitly: `X - 1 mu^T` is wrapped as a linear operator whose products only involve the
+    sparse matrix and the column means, and its leading singular triplets are found with ARPACK. The fitted object is
+    equivalent to `PCA(svd_solver='arpack')` fitted on the dense matrix, and `transform` also accepts sparse input.
+    """
 
-        adata.uns["explained_variance_ratio_"] = fit.explained_variance_ratio_
-    else:
-        # unscaled PCA
-        fit = TruncatedSVD(
-            n_components=min(n_pca_components + 1, CM.shape[1] - 1), random_state=0
+    def fit(self, X, y=None):
+        from scipy.sparse.linalg import LinearOperator, svds
+        from sklearn.utils import check_random_state
+        from sklearn.utils.extmath import svd_flip
+
+        X = X.tocsr()
+        if X.dtype != np.float64:
+            X = X.astype(np.float64)
+        n_obs, n_var = X.shape
+        n_components = self.n_components
+        if not X.has_canonical_format:
+            X = X.copy()
+            X.sum_duplicates()
+        mean = np.asarray(X.mean(0)).ravel()
+        # centered sums of squares per gene: the stored entries deviate by x - mean and the implicit zeros by -mean
+        nnz = np.bincount(X.indices, minlength=n_var)
+        centered_ss = np.bincount(X.indices, (X.data - mean[X.indices]) ** 2, minlength=n_var)
+        total_var = (centered_ss + (n_obs - nnz) * mean ** 2).sum() / (n_obs - 1)
+        ones = np.ones(n_obs)
+
+        X_centered = LinearOperator(
+            (n_obs, n_var),
+            matvec=lambda v: X @ v - mean @ v,
+            matmat=lambda V: X @ V - mean @ V,
+            rmatvec=lambda u: X.T @ u - mean * (ones @ u),
+            rmatmat=lambda U: X.T @ U - np.outer(mean, ones @ U),
+            dtype=X.dtype,
+        )
+        v0 = check_random_state(self.random_state).uniform(-1, 1, min(X.shape))
+        U, S, Vt = svds(X_centered, k=n_components, tol=self.tol, v0=v0)
+        S = S[::-1]
+        U, Vt = svd_flip(U[:, ::-1], Vt[::-1], u_based_decision=False)
+
+        self.n_features_in_, self.n_samples_, self.n_components_ = n_var, n_obs, n_components
+        self.mean_, self.components_, self.singular_values_ = mean, Vt, S.copy()
+        self.explained_variance_ = S ** 2 / (n_obs - 1)
+        self.explained_variance_ratio_ = self.explained_variance_ / total_var
+        self.noise_variance_ = (
+            (total_var - self.explained_variance_.sum()) / (n_var - n_components) if n_components < n_var else 0.0
         )
-        # first columns is related to the total UMI (or library size)
-        X_pca = fit.fit_transform(CM)[:, 1:]
-        adata.obsm[pca_key] = X_pca
-        adata.uns[pcs_key] = fit.components_.T
 
-        adata.uns["explained_variance_ratio_"] = fit.explained_variance_ratio_[1:]
+        return self
+
+    def transform(self, X):
+        if issparse(X):
+            return X @ self.components_.T - self.mean_ @ self.components_.T
+        return super().transform(X)
+
+    def fit_transform(self, X, y=None):
+        return self.fit(X).transform(X)
+
+
+def _pca_incremental(X, n_components, batch_size=None):
+    """Out-of-core PCA that only densifies `batch_size` cells at a time."""
+    from sklearn.decomposition import IncrementalPCA
+    from sklearn.utils import gen_batches
+
+    batch_size = max(5 * X.shape[1], n_components) if batch_size is None else batch_size
+    batches = [b for b in gen_batches(X.shape[0], batch_size, min_batch_size=n_components)]
+
+    fit = IncrementalPCA(n_components=n_components, batch_size=batch_size)
+    for b in batches:
+        fit.partial_fit(X[b].toarray() if issparse(X) else X[b])
+
+    X_pca = np.empty((X.shape[0], n_components))
+    for b in batches:
+        X_pca[b] = fit.transform(X[b].toarray() if issparse(X) else X[b])
+
+    return fit, X_pca
+
+
+def pca(adata, CM, n_pca_components=30, pca_key='X', pcs_key='PCs', incremental=False, batch_size=None):
+    """Centered PCA of the cell by gene matrix `CM`.
+
+    Sparse matrices are never densified: the exact PCA is computed with implicit mean centering (see `_SparseCenteredPCA`),
+    so the outputs (`adata.obsm[pca_key]`, `adata.uns[pcs_key]` and `adata.uns['explained_variance_ratio_']`) are the
+    same as those of a dense PCA regardless of the number of cells. For matrices too large for a single fit,
+    `incremental=True` fits an `IncrementalPCA` on `batch_size` cells at a time instead.
+    """
+
+    n_components = min(n_pca_components, CM.shape[1] - 1)
+    if incremental:
+        fit, X_pca = _pca_incremental(CM, n_components, batch_size)
+    elif issparse(CM):
+        fit = _SparseCenteredPCA(n_components=n_components, svd_solver="arpack", random_state=0)
+        X_pca = fit.fit_transform(CM)
+    else:
+        fit = PCA(n_components=n_components, svd_solver="arpack", random_state=0).fit(CM)
+        X_pca = fit.transform(CM)
+
+    adata.obsm[pca_key] = X_pca
+    adata.uns[pcs_key] = fit.components_.T
+
+    adata.uns["explained_variance_ratio_"] = fit.explained_variance_ratio_
 
     return adata, fit, X_pca
 
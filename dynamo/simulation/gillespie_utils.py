@@ -1,4 +1,6 @@
 import numpy as np
+import numba
+from numba import njit, prange
 
 
 def directMethod(
@@ -31,6 +33,99 @@ def directMethod(
     return retT, retC
 
 
+@njit(parallel=True)
+def _ssa_grid(prop_fcn, stoich, params, C0, t0, t_eval, seeds, max_steps):
+    n_traj, n_reactions, n_t = C0.shape[0], stoich.shape[0], len(t_eval)
+    ret = np.zeros((n_traj, C0.shape[1], n_t))
+    for i in prange(n_traj):
+        np.random.seed(seeds[i])
+        c = C0[i].copy()
+        prop = np.zeros(n_reactions)
+        t, j, count = t0, 0, 0
+        while j < n_t:
+            prop_fcn(c, params[i], prop)
+            a0 = 0.0
+            for k in range(n_reactions):
+                a0 += prop[k]
+            if a0 > 0 and count < max_steps:
+                r0, r1 = np.random.random(), np.random.random()
+                t_next = t - np.log(r0) / a0
+            else:
+                t_next = np.inf
+
+            # the state holds until the next reaction fires
+            while j < n_t and t_eval[j] < t_next:
+                ret[i, :, j] = c
+                j += 1
+            if j == n_t:
+                break
+
+            mu, acc = n_reactions - 1, 0.0
+            for k in range(n_reactions):
+                acc += prop[k]
+                if acc >= r1 * a0:
+                    mu = k
+                    break
+            c += stoich[mu]
+            t = t_next
+            count += 1
+
+    return ret
+
+
+def simulate_ssa(prop_fcn, stoich, params, C0, t_eval, t0=None, seed=19491001, cores=1, max_steps=np.inf):
+    """Run many trajectories of the stochastic simulation algorithm (Gillespie's direct method) with a compiled engine
+    and record their states on a fixed time grid.
+
+    Parameters
+    ----------
+        prop_fcn: numba compiled function
+            `prop_fcn(C, params, prop)` writes the propensities of all reactions at state `C` with the parameters
+            `params` (a 1d array) to `prop`, e.g. `prop_slam_jit` or `prop_2bifurgenes_jit`.
+        stoich: `np.ndarray`
+            The stoichiometry matrix (n_reactions x n_species).
+        params: `np.ndarray`
+            The parameters of each trajectory (n_traj x n_params), or a 1d array shared by all trajectories.
+        C0: `np.ndarray`
+            The initial state of each trajectory (n_traj x n_species), or a 1d array shared by all trajectories.
+        t_eval: `np.ndarray`
+            The sorted time points at which the states are recorded. A state is recorded as that right after the last
+            reaction fired at or before the time point, so no interpolation is needed.
+        t0: `float` or None (default: `None`)
+            The start time of the simulation. If None, `t_eval[0]` is used.
+        seed: `int` (default: `19491001`)
+            Trajectory i draws its random numbers from an independent stream seeded with `seed + i`, so the results do
+            not depend on `cores`.
+        cores: `int` (default: `1`)
+            The number of threads across which trajectories are simulated.
+        max_steps: `int` (default: `np.inf`)
+            The maximal number of reactions per trajectory. Afterwards the state is frozen.
+
+    Returns
+    -------
+        ret: `np.ndarray`
+            The states of the trajectories (n_traj x n_species x len(t_eval)).
+    """
+    stoich = np.asarray(stoich, dtype=np.float64)
+    params, C0 = np.atleast_2d(np.asarray(params, dtype=np.float64)), np.atleast_2d(np.asarray(C0, dtype=np.float64))
+    n_traj = max(params.shape[0], C0.shape[0])
+    params = np.ascontiguousarray(np.broadcast_to(params, (n_traj, params.shape[1])))
+    C0 = np.ascontiguousarray(np.broadcast_to(C0, (n_traj, C0.shape[1])))
+    t_eval = np.asarray(t_eval, dtype=np.float64)
+    t0 = t_eval[0] if t0 is None else t0
+    seeds = seed + np.arange(n_traj)
+    max_steps = np.iinfo(np.int64).max if np.isinf(max_steps) else int(max_steps)
+
+    threads = numba.get_num_threads()
+    numba.set_num_threads(max(1, min(cores, numba.config.NUMBA_NUM_THREADS)))
+    try:
+        ret = _ssa_grid(prop_fcn, stoich, params, C0, float(t0), t_eval, seeds, max_steps)
+    finally:
+        numba.set_num_threads(threads)
+
+    return ret
+
+
 def prop_slam(C, a, b, la, aa, ai, si, be, ga):
     # species
     s = C[0]
@@ -59,7 +154,29 @@ def prop_slam(C, a, b, la, aa, ai, si, be, ga):
     return prop
 
 
-def simulate_Gillespie(a, b, la, aa, ai, si, be, ga, C0, t_span, n_traj, report=False):
+@njit
+def prop_slam_jit(C, p, prop):
+    """Compiled `prop_slam`, with p = [a, b, la, aa, ai, si, be, ga]."""
+    a, b, la, aa, ai, si, be, ga = p[0], p[1], p[2], p[3], p[4], p[5], p[6], p[7]
+    s, ul, uu, sl, su = C[0], C[1], C[2], C[3], C[4]
+
+    if s > 0:  # promoter is active
+        prop[0], prop[1] = a, 0
+        prop[2], prop[3] = la * aa, (1 - la) * aa
+        prop[4], prop[5] = 0, 0
+    else:  # promoter is inactive
+        prop[0], prop[1] = 0, b
+        prop[2], prop[3] = 0, 0
+        prop[4], prop[5] = la * ai, (1 - la) * ai
+
+    prop[6] = (1 - si) * be * ul  # ul -> sl
+    prop[7] = si * be * ul  # ul -> su
+    prop[8] = be * uu  # uu -> su
+    prop[9] = ga * sl  # sl -> 0
+    prop[10] = ga * su  # su -> 0
+
+
+def stoich_slam():
     # species
     s = 0
     u_l = 1
@@ -84,6 +201,12 @@ def simulate_Gillespie(a, b, la, aa, ai, si, be, ga, C0, t_span, n_traj, report=
     stoich[8, s_u] = 1
     stoich[9, s_l] = -1  # s_l --> 0
     stoich[10, s_u] = -1  # s_u --> 0
+
+    return stoich
+
+
+def simulate_Gillespie(a, b, la, aa, ai, si, be, ga, C0, t_span, n_traj, report=False):
+    stoich = stoich_slam()
     update_func = lambda C, mu: C + stoich[mu, :]
 
     trajs_T = [[]] * n_traj
@@ -126,6 +249,20 @@ def prop_2bifurgenes(C, a1, b1, a2, b2, K, n, be1, ga1, be2, ga2):
     return prop
 
 
+@njit
+def prop_2bifurgenes_jit(C, p, prop):
+    """Compiled `prop_2bifurgenes`, with p = [a1, b1, a2, b2, K, n, be1, ga1, be2, ga2]."""
+    a1, b1, a2, b2, K, n, be1, ga1, be2, ga2 = p[0], p[1], p[2], p[3], p[4], p[5], p[6], p[7], p[8], p[9]
+    u1, s1, u2, s2 = C[0], C[1], C[2], C[3]
+
+    prop[0] = a1 * s1 ** n / (K ** n + s1 ** n) + b1 * K ** n / (K ** n + s2 ** n)  # 0 -> u1
+    prop[1] = be1 * u1  # u1 -> s1
+    prop[2] = ga1 * s1  # s1 -> 0
+    prop[3] = a2 * s2 ** n / (K ** n + s2 ** n) + b2 * K ** n / (K ** n + s1 ** n)  # 0 -> u2
+    prop[4] = be2 * u2  # u2 -> s2
+    prop[5] = ga2 * s2  # s2 -> 0
+
+
 def stoich_2bifurgenes():
     # species
     u1 = 0
@@ -220,28 +357,21 @@ def convert_nosplice(trajs_T, trajs_C):
 
 
 def simulate_multigene(
-    a, b, la, aa, ai, si, be, ga, C0, t_span, n_traj, t_eval, report=False
+    a, b, la, aa, ai, si, be, ga, C0, t_span, n_traj, t_eval, report=False, seed=19491001, cores=1
 ):
+    """Simulate `n_traj` trajectories of each gene with the compiled SSA engine and record them at `t_eval`.
+
+    Returns an array of n_genes x n_traj x 5 species x len(t_eval). All genes and trajectories run in one batch;
+    trajectory j of gene i uses the random seed `seed + i * n_traj + j`.
+    """
     n_genes = len(a)
-    ret = []
-    for i in range(n_genes):
-        trajs_T, trajs_C = simulate_Gillespie(
-            a[i],
-            b[i],
-            la[i],
-            aa[i],
-            ai[i],
-            si[i],
-            be[i],
-            ga[i],
-            C0[i],
-            t_span,
-            n_traj,
-            report,
-        )
-        trajs_C_interp = temporal_interp(t_eval, trajs_T, trajs_C)
-        ret.append(trajs_C_interp)
-    return np.array(ret)
+    params = np.repeat(np.vstack((a, b, la, aa, ai, si, be, ga)).T, n_traj, axis=0)
+    C0 = np.vstack([np.asarray(C0[i], dtype=float).reshape(n_traj, -1) for i in range(n_genes)])
+
+    ret = simulate_ssa(prop_slam_jit, stoich_slam(), params, C0, t_eval, t0=t_span[0], seed=seed, cores=cores)
+    if report:
+        print("Simulated %d trajectories of %d genes." % (n_traj, n_genes))
+    return ret.reshape((n_genes, n_traj) + ret.shape[1:])
 
 
 class trajectories:
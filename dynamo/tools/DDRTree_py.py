@@ -1,11 +1,12 @@
+import time
 import numpy as np
 import pandas as pd
 import numpy.matlib as matlib
-from scipy.linalg import eig
+from scipy.linalg import eig, eigvalsh, lu_factor, lu_solve
 from scipy.cluster.vq import kmeans2
 from scipy.sparse.csgraph import minimum_spanning_tree
-from scipy.sparse.linalg import inv
-from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import LinearOperator
+from scipy.sparse import issparse
 
 
 def cal_ncenter(ncells, ncells_limit=100):
@@ -52,10 +53,7 @@ def sqdist(a, b):
     bb = np.sum(b ** 2, axis=0)
     ab = a.T.dot(b)
 
-    aa_repmat = matlib.repmat(aa[:, None], 1, b.shape[1])
-    bb_repmat = matlib.repmat(bb[None, :], a.shape[1], 1)
-
-    dist = abs(aa_repmat + bb_repmat - 2 * ab)
+    dist = abs(aa[:, None] + bb[None, :] - 2 * ab)
 
     return dist
 
@@ -98,11 +96,46 @@ def eye(m, n):
     return mat
 
 
+def residual_sqnorm(X, W, Z, chunk_size=None):
+    """Squared spectral norm of X - W Z, accumulated over column chunks so that the D x N residual is never formed.
+    Arguments
+    ---------
+        X: 'np.ndarray'
+            A matrix with :math:`D \times N` dimension
+        W: 'np.ndarray'
+            A matrix with :math:`D \times L` dimension
+        Z: 'np.ndarray'
+            A matrix with :math:`L \times N` dimension
+        chunk_size: 'int' or None
+            Number of columns per chunk. By default, chunks hold about 2^24 entries.
+    Returns
+    -------
+    sqnorm: 'float'
+        The squared largest singular value of X - W Z
+    """
+    (D, N) = X.shape
+    if D > N:
+        return np.linalg.norm(X - np.dot(W, Z), 2) ** 2
+
+    chunk_size = max(2 ** 24 // D, 1) if chunk_size is None else chunk_size
+    gram = np.zeros((D, D))
+    for i in range(0, N, chunk_size):
+        res = X[:, i : i + chunk_size] - np.dot(W, Z[:, i : i + chunk_size])
+        gram += np.dot(res, res.T)
+
+    return eigvalsh(gram)[-1]
+
+
 def DDRTree(
-    X, maxIter, sigma, gamma, eps=0, dim=2, Lambda=1.0, ncenter=None, keep_history=False
+    X, maxIter, sigma, gamma, eps=0, dim=2, Lambda=1.0, ncenter=None, keep_history=False, dtype=None,
+    Q_operator=False, verbose=True,
 ):
     """	This function is a pure Python implementation of the DDRTree algorithm.
 
+    The N x N matrix Q = (I + R M^-1 R') / (gamma + 1) of the original algorithm is not formed during the iterations:
+    with K centers, it is applied through the N x K soft assignment R and a factorization of the K x K matrix M, so the
+    memory footprint is O(N K + D N + D^2). Only the returned Q is dense unless `Q_operator` is True.
+
     Arguments	
     ---------	
         X : DxN:'np.ndarray'	
@@ -119,100 +152,125 @@ def DDRTree(
         gamma:'float'	
                 regularization parameter for k-means	
         ncenter :(int)	
+        dtype: 'np.dtype' or None
+                the floating point type (for example np.float32) of the N sized computations. The K x K systems are
+                always solved in double precision. If None, the dtype of X is used.
+        Q_operator: 'bool'
+                whether to return Q as a `scipy.sparse.linalg.LinearOperator` that applies the N x N matrix implicitly
+                instead of a dense N x N matrix.
+        verbose: 'bool'
+                whether to print the objective and the run time of each iteration.
     Returns	
     -------	
         history: 'DataFrame'	
                 the results dataframe of return	
+        or Z, Y, stree, R, W, Q, C, objs	
     """
-    X = np.array(X)
+    X = X.toarray() if issparse(X) else X
+    X = np.asarray(X, dtype=dtype)
     (D, N) = X.shape
+    XXt = np.dot(X, X.T)
 
     # initialization
-    W = pca_projection(np.dot(X, X.T), dim)
+    W = pca_projection(XXt, dim)
     Z = np.dot(W.T, X)
 
     if ncenter is None:
         K = N
         Y = Z.T[0:K].T
     else:
-        K = ncenter
+        K = int(ncenter)
 
         Y, _ = kmeans2(Z.T, K)
         Y = Y.T
 
     # main loop
     objs = []
+    # the state returned when no projection update is done (maxIter = 0): no assignment to the centers, so Q = I / (gamma + 1)
+    stree, R = np.zeros((K, K)), np.zeros((N, K), dtype=X.dtype)
+    R_Q, M_Q, XRM_Q = R, None, np.zeros((D, K), dtype=X.dtype)
     if keep_history:
         history = pd.DataFrame(
             index=[i for i in range(maxIter)],
-            columns=["W", "Z", "Y", "stree", "R", "objs"],
+            columns=["W", "Z", "Y", "stree", "R", "objs", "time"],
         )
+    last = time.time() if verbose or keep_history else None
     for iter in range(maxIter):
 
         # Kruskal method to find optimal B
-        distsqMU = csr_matrix(sqdist(Y, Y)).toarray()
+        distsqMU = sqdist(Y, Y)
         stree = minimum_spanning_tree(np.tril(distsqMU)).toarray()
         stree = stree + stree.T
         B = stree != 0
-        L = np.diag(sum(B.T)) - B
+        L = np.diag(B.sum(1)) - B
 
         # compute R using mean-shift update rule
         distZY = sqdist(Z, Y)
-        tem_min_dist = np.array(np.min(distZY, 1)).reshape(-1, 1)
-        min_dist = repmat(tem_min_dist, 1, K)
-        tmp_distZY = distZY - min_dist
+        tem_min_dist = distZY.min(1)[:, None]
+        tmp_distZY = distZY - tem_min_dist
         tmp_R = np.exp(-tmp_distZY / sigma)
-        R = tmp_R / repmat(
-            np.sum(tmp_R, 1).reshape(-1, 1), 1, K
-        )  ##########################3
-        Gamma = np.diag(sum(R))
+        R = tmp_R / tmp_R.sum(1)[:, None]
+        Gamma = np.diag(R.sum(0))
 
         # termination condition
-        obj1 = -sigma * sum(
-            np.log(np.sum(np.exp(-tmp_distZY / sigma), 1)) - tem_min_dist.T[0] / sigma
-        )
-        xwz = np.linalg.norm(X - np.dot(W, Z), 2)
+        obj1 = -sigma * np.sum(np.log(tmp_R.sum(1)) - tem_min_dist[:, 0] / sigma)
         objs.append(
-            (np.dot(xwz, xwz))
+            residual_sqnorm(X, W, Z)
             + Lambda * np.trace(np.dot(Y, np.dot(L, Y.T)))
             + gamma * obj1
         )
-        print("iter = ", iter, "obj = ", objs[iter])
+        if verbose or keep_history:
+            now = time.time()
+            elapsed, last = now - last, now
+        if verbose:
+            print("iter = ", iter, "obj = ", objs[iter], "time = %.3f s" % elapsed)
 
         if keep_history:
-            history.iloc[iter]["W"] = W
-            history.iloc[iter]["Z"] = Z
-            history.iloc[iter]["Y"] = Y
-            history.iloc[iter]["stree"] = stree
-            history.iloc[iter]["R"] = R
+            history.at[iter, "W"] = W
+            history.at[iter, "Z"] = Z
+            history.at[iter, "Y"] = Y
+            history.at[iter, "stree"] = stree
+            history.at[iter, "R"] = R
+            history.at[iter, "time"] = elapsed
 
         if iter > 0:
             if abs((objs[iter] - objs[iter - 1]) / abs(objs[iter - 1])) < eps:
                 break
 
-        # compute low dimension projection matrix
-        tmp = np.dot(
-            R,
-            inv(
-                csr_matrix(
-                    ((gamma + 1) / gamma) * ((Lambda / gamma) * L + Gamma)
-                    - np.dot(R.T, R)
-                )
-            ).toarray(),
-        )
-        Q = (1 / (gamma + 1)) * (eye(N, N) + np.dot(tmp, R.T))
-        C = np.dot(X, Q)
+        # compute low dimension projection matrix: C = X Q with Q = (I + R M^-1 R') / (gamma + 1)
+        A = (Lambda / gamma) * L + Gamma
+        M = lu_factor(((gamma + 1) / gamma) * A - np.dot(R.T, R).astype(np.float64))
+        XR = np.dot(X, R)
+        XRM = lu_solve(M, XR.T.astype(np.float64)).T.astype(X.dtype)  # X R M^-1 (M is symmetric)
 
-        tmp1 = np.dot(C, X.T)
+        tmp1 = (XXt + np.dot(XRM, XR.T)) / (gamma + 1)
         W = pca_projection((tmp1 + tmp1.T) / 2, dim)
-        Z = np.dot(W.T, C)
-        Y = np.dot(
-            np.dot(Z, R), inv(csr_matrix((Lambda / gamma) * L + Gamma)).toarray()
-        )
+        Z = (np.dot(W.T, X) + np.dot(np.dot(W.T, XRM), R.T)) / (gamma + 1)
+        Y = np.linalg.solve(A, np.dot(Z, R).T.astype(np.float64)).T.astype(Z.dtype)  # Z R A^-1 (A is symmetric)
+        R_Q, M_Q, XRM_Q = R, M, XRM
 
     if keep_history:
-        history.iloc[iter]["obs"] = objs
+        if len(objs) > 0:
+            history.at[len(objs) - 1, "objs"] = objs
 
         return history
     else:
+        C = (X + np.dot(XRM_Q, R_Q.T)) / (gamma + 1)
+
+        # R M^-1 R' v, which is zero before the first update
+        RMR = (lambda v: 0 * v) if M_Q is None else \
+            (lambda v: np.dot(R_Q, lu_solve(M_Q, np.dot(R_Q.T, v).astype(np.float64))).astype(X.dtype))
+
+        if Q_operator:
+            Q = LinearOperator(
+                (N, N),
+                matvec=lambda v: (v + RMR(v)) / (gamma + 1),
+                rmatvec=lambda v: (v + RMR(v)) / (gamma + 1),
+                dtype=X.dtype,
+            )
+        else:
+            Q = np.zeros((N, N), dtype=X.dtype) if M_Q is None else \
+                np.dot(R_Q, lu_solve(M_Q, R_Q.T.astype(np.float64))).astype(X.dtype)
+            Q[np.diag_indices(N)] += 1
+            Q /= gamma + 1
         return Z, Y, stree, R, W, Q, C, objs
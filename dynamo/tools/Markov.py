@@ -1,12 +1,13 @@
 # create by Yan Zhang, minor adjusted by Xiaojie Qiu
 from tqdm import tqdm
+import warnings
 import numpy as np
 import scipy.sparse as sp
-from sklearn.neighbors import NearestNeighbors
 from scipy.stats import norm
 from scipy.linalg import eig, null_space
 from numba import jit
 from .utils import append_iterative_neighbor_indices
+from .connectivity import k_nearest_neighbors
 
 def markov_combination(x, v, X):
     from cvxopt import matrix, solvers
@@ -146,6 +147,90 @@ def compute_density_kernel(x, X, inv_eps):
     return k
 
 
+def flatten_neighbor_indices(Idx):
+    """Flatten (possibly ragged) neighbor indices into CSR-style `indptr` and `indices` arrays."""
+    if isinstance(Idx, np.ndarray) and Idx.ndim == 2:
+        n, k = Idx.shape
+        return np.arange(0, n * k + 1, k), Idx.ravel().astype(int)
+
+    lens = np.array([len(i) for i in Idx], dtype=int)
+    indptr = np.concatenate(([0], np.cumsum(lens)))
+    indices = np.concatenate(Idx).astype(int) if len(Idx) > 0 else np.zeros(0, dtype=int)
+    return indptr, indices
+
+
+def segment_quantile(vals, indptr, q):
+    """Compute the `q` quantile (linear interpolation, as in `np.quantile`) of each CSR-style segment of `vals`."""
+    lens = np.diff(indptr)
+    rows = np.repeat(np.arange(len(lens)), lens)
+    sorted_vals = vals[np.lexsort((vals, rows))]
+
+    valid = lens > 0
+    h = q * (lens[valid] - 1)
+    lo = np.floor(h).astype(int)
+    hi = np.minimum(lo + 1, lens[valid] - 1)
+    base = indptr[:-1][valid] - indptr[0]
+    res = np.full(len(lens), np.nan)
+    a, b = sorted_vals[base + lo], sorted_vals[base + hi]
+    res[valid] = a + (h - lo) * (b - a)
+    return res
+
+
+def quadratic_form(R, inv_s):
+    """Compute r @ inv_s @ r.T for every row r of `R`, with `inv_s` either a scalar or a matrix."""
+    if np.isscalar(inv_s):
+        return inv_s * np.einsum("ij,ij->i", R, R)
+    else:
+        return np.einsum("ij,ij->i", R @ inv_s, R)
+
+
+def compute_drift_kernel_batch(X, V, indptr, indices, offset, inv_s, adaptive_local_kernel=False):
+    """Batched version of `compute_drift_kernel` (or `compute_drift_local_kernel` when `adaptive_local_kernel` is
+    True) for a block of cells `offset, offset + 1, ...` whose neighbors are given by the CSR-style `indptr` and
+    `indices` arrays. Returns the flat array of kernel weights aligned with `indices`."""
+    lens = np.diff(indptr)
+    rows = np.repeat(np.arange(len(lens)), lens)
+    cells = rows + offset
+    D = X[indices] - X[cells]
+
+    if not adaptive_local_kernel:
+        return np.exp(-0.25 * quadratic_form(D - V[cells], inv_s))
+
+    v = V[offset : offset + len(lens)]
+    dists = np.linalg.norm(D, axis=1)
+    vds = np.zeros_like(dists)
+    np.divide(np.einsum("ij,ij->i", D, v[rows]), dists, out=vds, where=dists > 0)
+    i_dir = np.logical_and(vds >= segment_quantile(vds, indptr, 0.7)[rows], vds > 0)
+
+    n_dir = np.bincount(rows[i_dir], minlength=len(lens))
+    tau = np.bincount(rows[i_dir], weights=dists[i_dir] / vds[i_dir], minlength=len(lens))
+    has_dir = n_dir > 0
+    tau[has_dir] = np.minimum(tau[has_dir] / n_dir[has_dir], 1e2)
+    tau_v = np.where(has_dir, tau, 0)[:, None] * v
+    tau_scale = 1 / (np.where(has_dir, tau, 1e2) * np.einsum("ij,ij->i", v, v))
+
+    return np.exp(-0.25 * tau_scale[rows] * quadratic_form(D - tau_v[rows], inv_s))
+
+
+def compute_density_kernel_batch(X, indptr, indices, offset, inv_eps):
+    """Batched version of `compute_density_kernel`, see `compute_drift_kernel_batch` for the neighbor layout."""
+    lens = np.diff(indptr)
+    D = X[indices] - X[np.repeat(np.arange(len(lens)), lens) + offset]
+    return np.exp(-0.25 * inv_eps * np.einsum("ij,ij->i", D, D))
+
+
+def normalize_kernel_weights(k, indptr, n, tol=0.0):
+    """Row-normalize flat kernel weights into transition probabilities, zeroing entries no larger than `tol`
+    before renormalizing. Segments with a zero kernel sum fall back to a weight of `1 / n`."""
+    lens = np.diff(indptr)
+    rows = np.repeat(np.arange(len(lens)), lens)
+    k_sum = np.bincount(rows, weights=k, minlength=len(lens))[rows]
+    p = np.full_like(k, 1 / n, dtype=float)
+    np.divide(k, k_sum, out=p, where=k_sum > 0)
+    p[p <= tol] = 0  # tolerance check
+    return p / np.bincount(rows, weights=p, minlength=len(lens))[rows]
+
+
 @jit(nopython=True)
 def makeTransitionMatrix(Qnn, I, tol=0.0):
     n = Qnn.shape[0]
@@ -160,25 +245,22 @@ def makeTransitionMatrix(Qnn, I, tol=0.0):
 
 
 @jit(nopython=True)
-def compute_tau(X, V, k=100, nbr_idx=None):
-    if nbr_idx is None:
-        if X.shape[0] > 200000 and X.shape[1] > 2: 
-            from pynndescent import NNDescent
+def _neighbor_dists(X, nbr_idx):
+    dists = np.zeros(nbr_idx.shape)
+    for i in range(nbr_idx.shape[0]):
+        for j in range(nbr_idx.shape[1]):
+            x = X[i]
+            y = X[nbr_idx[i, j]]
+            dists[i, j] = np.sqrt((x - y).dot(x - y))
+    return dists
 
-            nbrs = NNDescent(X, metric='euclidean', n_neighbors=k, n_jobs=-1, random_state=19491001)
-            _, dist = nbrs.query(X, k=k)
-        else:
-            alg = 'ball_tree' if X.shape[1] > 10 else 'kd_tree'
-            nbrs = NearestNeighbors(n_neighbors=k, algorithm=alg, n_jobs=-1).fit(X)
-            dists, _ = nbrs.kneighbors(X)
 
+def compute_tau(X, V, k=100, nbr_idx=None):
+    # the neighbor search can't be compiled by numba, so only the distance loop is jitted.
+    if nbr_idx is None:
+        _, dists = k_nearest_neighbors(X, k=k, cores=-1)
     else:
-        dists = np.zeros(nbr_idx.shape)
-        for i in range(nbr_idx.shape[0]):
-            for j in range(nbr_idx.shape[1]):
-                x = X[i]
-                y = X[nbr_idx[i, j]]
-                dists[i, j] = np.sqrt((x - y).dot(x - y))
+        dists = _neighbor_dists(np.asarray(X, dtype=float), np.asarray(nbr_idx))
     d = np.mean(dists[:, 1:], 1)
     v = np.linalg.norm(V, axis=1)
     tau = d / v
@@ -213,17 +295,11 @@ def prepare_velocity_grid_data(X_emb,
     if n_neighbors is None:
         n_neighbors = np.max([10, int(n_obs / 50)])
 
-    if X_emb.shape[0] > 200000 and X_emb.shape[1] > 2: 
-        from pynndescent import NNDescent
-
-        nn = NNDescent(X_emb, metric='euclidean', n_neighbors=n_neighbors, n_jobs=-1,
-                          random_state=19491001)
+    _, _, nn = k_nearest_neighbors(X_emb, k=n_neighbors, cores=-1, return_index=True)
+    if hasattr(nn, 'kneighbors'):
+        dists, neighs = nn.kneighbors(X_grid, n_neighbors=n_neighbors)
+    else:
         neighs, dists = nn.query(X_grid, k=n_neighbors)
-    else: 
-        alg = "ball_tree" if X_emb.shape[1] > 10 else 'kd_tree'
-        nn = NearestNeighbors(n_neighbors=n_neighbors, n_jobs=-1, algorithm=alg)
-        nn.fit(X_emb)
-        dists, neighs = nn.kneighbors(X_grid)
 
     weight = norm.pdf(x=dists, scale=scale)
     p_mass = weight.sum(1)
@@ -335,6 +411,95 @@ def velocity_on_grid(
     return X_grid, V_grid, D
 
 
+def stationary_distribution_sparse(P, left=True, method="eigs", tol=1e-12, maxiter=None):
+    """Compute the stationary distribution of a (sparse) transition matrix without forming dense eigensystems.
+
+    Parameters
+    ----------
+        P: :class:`~scipy.sparse.csr_matrix` or :class:`~numpy.ndarray`
+            The (n x n) transition matrix.
+        left: `bool` (default: `True`)
+            Whether the stationary distribution is the left (`pi P = pi`, row-stochastic P) or the right (`P pi = pi`,
+            column-stochastic P) Perron eigenvector.
+        method: `str` (default: `eigs`)
+            `eigs` uses ARPACK for the eigenvector with the largest real eigenvalue and falls back to `power` if ARPACK
+            does not converge. `power` uses the power iteration of the lazy chain `(I + P) / 2`, which has the same
+            stationary distribution but is aperiodic.
+        tol: `float` (default: `1e-12`)
+            The L1 tolerance of the power iteration.
+        maxiter: `int` or None (default: `None`)
+            The maximal number of ARPACK or power iterations.
+
+    Returns
+    -------
+        p: :class:`~numpy.ndarray`
+            The stationary distribution (n,).
+    """
+
+    A = P.T if left else P
+    A = A.tocsr() if sp.issparse(A) else np.asarray(A)
+    n = A.shape[0]
+
+    if method == "eigs" and n < 3:
+        w, vecs = eig(A.A if sp.issparse(A) else A)
+        p = np.abs(np.real(vecs[:, np.argmin(np.abs(w - 1))]))
+    elif method == "eigs":
+        try:
+            _, vecs = sp.linalg.eigs(A, k=1, which="LR", maxiter=maxiter)
+            p = np.abs(np.real(vecs[:, 0]))
+        except sp.linalg.ArpackNoConvergence:
+            warnings.warn("ARPACK did not converge, the power iteration is used instead.")
+            method = "power"
+
+    if method == "power":
+        p = np.ones(n) / n
+        maxiter = 100 * n if maxiter is None else maxiter
+        for _ in range(maxiter):
+            p_new = 0.5 * (p + A.dot(p))
+            p_new /= p_new.sum()
+            if np.abs(p_new - p).sum() < tol:
+                p = p_new
+                break
+            p = p_new
+    elif method != "eigs":
+        raise ValueError(f"method can be only one of {'eigs', 'power'}")
+
+    p = p / np.sum(p)
+    return p
+
+
+def propagate_distribution(P, P0, steps=1, left=True):
+    """Propagate one or a batch of state distributions through a (sparse) transition matrix with repeated sparse
+    matrix products instead of matrix powers.
+
+    Parameters
+    ----------
+        P: :class:`~scipy.sparse.csr_matrix` or :class:`~numpy.ndarray`
+            The (n x n) transition matrix.
+        P0: :class:`~numpy.ndarray` or sparse matrix
+            The initial distribution (n,) or a batch of initial distributions (m x n), one per row.
+        steps: `int` (default: `1`)
+            The number of steps of the random walk.
+        left: `bool` (default: `True`)
+            Whether the distributions are propagated as `p P` (row-stochastic P) or as `P p` (column-stochastic P).
+
+    Returns
+    -------
+        P_t: :class:`~numpy.ndarray` or sparse matrix
+            The distributions after `steps` steps, with the same shape as `P0`.
+    """
+
+    A = P.T if left else P
+    A = A.tocsr() if sp.issparse(A) else A
+    vector = not sp.issparse(P0) and np.ndim(P0) == 1
+    X = P0.T if not vector else P0
+
+    for _ in range(steps):
+        X = A.dot(X)
+
+    return X if vector else X.T
+
+
 class MarkovChain:
     def __init__(self, P=None):
         self.P = P
@@ -378,21 +543,21 @@ class KernelMarkovChain(MarkovChain):
         epsilon=None,
         adaptive_local_kernel=False,
         tol=1e-4,
-        sparse_construct=True,
+        sparse_construct=None,
         sample_fraction=None,
+        chunk_size=10000,
     ):
+        if sparse_construct is not None:
+            warnings.warn(
+                "`sparse_construct` is deprecated and ignored: the transition matrix is always assembled directly in "
+                "the sparse (csc) format. It will be removed in a future release.",
+                DeprecationWarning,
+                stacklevel=2,
+            )
+
         # compute connectivity
         if neighbor_idx is None:
-            if X.shape[0] > 200000 and X.shape[1] > 2: 
-                from pynndescent import NNDescent
-
-                nbrs = NNDescent(X, metric='euclidean', n_neighbors=k, n_jobs=-1,
-                                  random_state=19491001)
-                neighbor_idx, _ = nbrs.query(X, k=k)
-            else:
-                alg = 'ball_tree' if X.shape[1] > 10 else 'kd_tree'
-                nbrs = NearestNeighbors(n_neighbors=k, algorithm=alg, n_jobs=-1).fit(X)
-                _, neighbor_idx = nbrs.kneighbors(X)
+            neighbor_idx, _ = k_nearest_neighbors(X, k=k, cores=-1)
 
         if n_recurse_neighbors is not None:
             self.Idx = append_iterative_neighbor_indices(
@@ -422,48 +587,41 @@ class KernelMarkovChain(MarkovChain):
             self.Idx = self.Idx[np.arange(neighbor_idx.shape[0])[:, None], sampling_ixs]
 
         n = X.shape[0]
-        if sparse_construct:
-            self.P = sp.lil_matrix((n, n))
-        else:
-            self.P = np.zeros((n, n))
+        indptr, indices = flatten_neighbor_indices(self.Idx)
+        chunk_size = n if chunk_size is None else chunk_size
 
         # compute density kernel
         if epsilon is not None:
-            if sparse_construct:
-                self.Kd = sp.lil_matrix((n, n))
-            else:
-                self.Kd = np.zeros((n, n))
             inv_eps = 1 / epsilon
-            for i in range(n):
-                self.Kd[i, self.Idx[i]] = compute_density_kernel(
-                    X[i], X[self.Idx[i]], inv_eps
-                )
-            self.Kd = sp.csc_matrix(self.Kd)
-            D = np.sum(self.Kd, 0)
+            kd = np.zeros(len(indices))
+            for start in range(0, n, chunk_size):
+                end = min(start + chunk_size, n)
+                block = slice(indptr[start], indptr[end])
+                kd[block] = compute_density_kernel_batch(X, indptr[start:end + 1], indices[block], start, inv_eps)
+            self.Kd = sp.csr_matrix((kd, indices, indptr), shape=(n, n)).tocsc()
+            D = np.bincount(indices, weights=kd, minlength=n)
 
         # compute transition prob.
         if np.isscalar(M_diff):
             inv_s = 1 / M_diff
         else:
             inv_s = np.linalg.inv(M_diff)
-        for i in tqdm(range(n), desc="compute transiton matrix"):
-            y = X[i]
-            v = V[i]
-            Y = X[self.Idx[i]]
-            if adaptive_local_kernel:
-                k = compute_drift_local_kernel(y, v, Y, inv_s)
-            else:
-                k = compute_drift_kernel(y, v, Y, inv_s)
+
+        data = np.zeros(len(indices))
+        for start in tqdm(range(0, n, chunk_size), desc="compute transiton matrix"):
+            end = min(start + chunk_size, n)
+            block = slice(indptr[start], indptr[end])
+            block_indptr, block_indices = indptr[start:end + 1], indices[block]
+            k = compute_drift_kernel_batch(
+                X, V, block_indptr, block_indices, start, inv_s, adaptive_local_kernel=adaptive_local_kernel
+            )
             if epsilon is not None:
-                k = k / D[0, self.Idx[i]]
-            else:
-                k = np.matrix(k)
-            p = k / np.sum(k) if np.sum(k) > 0 else np.ones_like(k) / n
-            p[p <= tol] = 0  # tolerance check
-            p = p / np.sum(p)
-            self.P[self.Idx[i], i] = p.A[0]
+                k = k / D[block_indices]
+            data[block] = normalize_kernel_weights(k, block_indptr, n, tol=tol)
 
-        self.P = sp.csc_matrix(self.P)
+        self.P = sp.csc_matrix((data, indices, indptr), shape=(n, n))
+        self.P.eliminate_zeros()
+        self.P.sort_indices()
 
     def propagate_P(self, num_prop):
         ret = sp.csc_matrix(self.P, copy=True)
@@ -511,13 +669,10 @@ class KernelMarkovChain(MarkovChain):
             V[i] = D.T.dot(p)
         return V * 1 / V.max() if scale else V
 
-    def compute_stationary_distribution(self):
+    def compute_stationary_distribution(self, method="eigs"):
         # if self.W is None:
         # self.eigsys()
-        _, vecs = sp.linalg.eigs(self.P, k=1, which="LR")
-        p = np.abs(np.real(vecs[:, 0]))
-        p = p / np.sum(p)
-        return p
+        return stationary_distribution_sparse(self.P, left=False, method=method)
 
     def diffusion_map_embedding(self, n_dims=2, t=1):
         # if self.W is None:
@@ -536,15 +691,7 @@ class DiscreteTimeMarkovChain(MarkovChain):
         # the parameter k will be replaced by a connectivity matrix in the future.
         self.__reset__()
         # knn clustering
-        if X.shape[0] > 200000 and X.shape[1] > 2: 
-            from pynndescent import NNDescent
-
-            nbrs = NNDescent(X, metric='euclidean', n_neighbors=k, n_jobs=-1, random_state=19491001)
-            Idx, _ = nbrs.query(X, k=k)
-        else:
-            alg = 'ball_tree' if X.shape[1] > 10 else 'kd_tree'
-            nbrs = NearestNeighbors(n_neighbors=k, algorithm=alg, n_jobs=-1).fit(X)
-            _, Idx = nbrs.kneighbors(X)
+        Idx, _ = k_nearest_neighbors(X, k=k, cores=-1)
         # compute transition prob.
         n = X.shape[0]
         self.P = np.zeros((n, n))
@@ -645,16 +792,7 @@ class ContinuousTimeMarkovChain(MarkovChain):
         self.__reset__()
         # knn clustering
         if self.nbrs_idx is None:
-            if X.shape[0] > 200000 and X.shape[1] > 2: 
-                from pynndescent import NNDescent
-
-                nbrs = NNDescent(X, metric='euclidean', n_neighbors=k + 1, n_jobs=-1,
-                                  random_state=19491001)
-                Idx, _ = nbrs.query(X, k=k+1)
-            else:
-                alg = 'ball_tree' if X.shape[1] > 10 else 'kd_tree'
-                nbrs = NearestNeighbors(n_neighbors=k + 1, algorithm=alg, n_jobs=-1).fit(X)
-                _, Idx = nbrs.kneighbors(X)
+            Idx, _ = k_nearest_neighbors(X, k=k + 1, cores=-1)
 
             self.nbrs_idx = Idx[:, 1:]
         else:
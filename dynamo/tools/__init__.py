@@ -60,7 +60,7 @@ from .dimension_reduction import reduceDimension  # , run_umap
 from .clustering import hdbscan, cluster_field
 
 # mnn related
-from .connectivity import mnn, neighbors
+from .connectivity import mnn, neighbors, k_nearest_neighbors, clear_nn_cache
 
 # Pseudotime related
 from .DDRTree_py import DDRTree
@@ -14,10 +14,9 @@ from .utils import (
     get_ekey_vkey_from_adata,
     get_mapper_inverse,
     update_dict,
-    get_iterative_indices,
+    iterative_neighbor_graph,
     split_velocity_graph,
     norm,
-    einsum_correlation,
     log1p_,
     index_gene
 )
@@ -607,7 +606,7 @@ def stationary_distribution(adata, method="kmc", direction="both", calc_rnd=True
             adata.obs[
                 "sink_steady_state_distribution"
             ] = kmc.compute_stationary_distribution()
-            kmc.P = T.T / T.T.sum(0)
+            kmc.P = _normalize_rows(T).T
             adata.obs[
                 "source_steady_state_distribution"
             ] = kmc.compute_stationary_distribution()
@@ -618,7 +617,7 @@ def stationary_distribution(adata, method="kmc", direction="both", calc_rnd=True
                 adata.obs[
                     "sink_steady_state_distribution_rnd"
                 ] = kmc.compute_stationary_distribution()
-                kmc.P = T_rnd.T / T_rnd.T.sum(0)
+                kmc.P = _normalize_rows(T_rnd).T
                 adata.obs[
                     "source_steady_state_distribution_rnd"
                 ] = kmc.compute_stationary_distribution()
@@ -635,14 +634,14 @@ def stationary_distribution(adata, method="kmc", direction="both", calc_rnd=True
                     "sink_steady_state_distribution_rnd"
                 ] = kmc.compute_stationary_distribution()
         elif direction == "backward":
-            kmc.P = T.T / T.T.sum(0)
+            kmc.P = _normalize_rows(T).T
             adata.obs[
                 "source_steady_state_distribution"
             ] = kmc.compute_stationary_distribution()
 
             if calc_rnd:
                 T_rnd = adata.obsp["transition_matrix_rnd"]
-                kmc.P = T_rnd.T / T_rnd.T.sum(0)
+                kmc.P = _normalize_rows(T_rnd).T
                 adata.obs[
                     "sink_steady_state_distribution_rnd"
                 ] = kmc.compute_stationary_distribution()
@@ -704,8 +703,8 @@ def diffusion(M, P0=None, steps=None, backward=False):
     ----------
         M: :class:`~numpy.ndarray` (dimension n x n, where n is the cell number)
             The transition matrix.
-        P0: :class:`~numpy.ndarray` (default None; dimension is n, )
-            The initial cell state.
+        P0: :class:`~numpy.ndarray` (default None; dimension is n, or m x n)
+            The initial cell state, or a batch of m initial cell states (one per row).
         steps: int (default None)
             The random walk steps on the Markov transitioin matrix.
         backward: bool (default False)
@@ -719,36 +718,31 @@ def diffusion(M, P0=None, steps=None, backward=False):
 
     if backward is True:
         M = M.T
-        M = M / M.sum(1)
+        M = _normalize_rows(M)
 
     if steps is None:
-        # code inspired from  https://github.com/prob140/prob140/blob/master/prob140/markov_chains.py#L284
-        from scipy.sparse.linalg import eigs
-
-        eigenvalue, eigenvector = scp.linalg.eig(
-            M, left=True, right=False
-        )  # if not sp.issparse(M) else eigs(M) # source is on the row
-
-        eigenvector = (
-            np.real(eigenvector) if not sp.issparse(M) else np.real(eigenvector.T)
-        )
-        eigenvalue_1_ind = np.isclose(eigenvalue, 1)
-        mu = eigenvector[:, eigenvalue_1_ind] / np.sum(eigenvector[:, eigenvalue_1_ind])
-
-        # Zero out floating poing errors that are negative.
-        indices = np.logical_and(np.isclose(mu, 0), mu < 0)
-        mu[indices] = 0  # steady state distribution
+        # the left Perron eigenvector (source is on the row), from ARPACK or power iteration on the sparse matrix
+        mu = stationary_distribution_sparse(M, left=True)
 
     else:
+        # P0 defaults to the average of all rows of M, i.e. one step from the uniform distribution
         mu = (
-            np.nanmean(M.dot(np.linalg.matrix_power(M, steps)), 0)
+            propagate_distribution(M, np.ones(M.shape[0]) / M.shape[0], steps + 1)
             if P0 is None
-            else P0.dot(np.linalg.matrix_power(M, steps))
+            else propagate_distribution(M, P0, steps)
         )
 
     return mu
 
 
+def _normalize_rows(M):
+    """Normalize the rows of a dense or sparse matrix to sum to 1, keeping sparse matrices sparse."""
+    row_sums = np.asarray(M.sum(1)).flatten()
+    row_sums[row_sums == 0] = 1
+
+    return sp.diags(1 / row_sums).dot(M) if sp.issparse(M) else M / row_sums[:, None]
+
+
 def expected_return_time(M, backward=False):
     """Find the expected returning time.
 
@@ -774,52 +768,65 @@ def expected_return_time(M, backward=False):
 def kernels_from_velocyto_scvelo(
     X, X_embedding, V, indices, neg_cells_trick, xy_grid_nums,
     kernel='pearson', n_recurse_neighbors=2, max_neighs=None, transform='sqrt',
-    use_neg_vals=True,
+    use_neg_vals=True, chunk_size=None,
 ):
     """utility function for calculating the transition matrix and low dimensional velocity embedding via the original
-    pearson correlation kernel (La Manno et al., 2018) or the cosine kernel from scVelo (Bergen et al., 2019)."""
+    pearson correlation kernel (La Manno et al., 2018) or the cosine kernel from scVelo (Bergen et al., 2019).
+
+    The recursive neighbors of all cells are collected once and the kernel is evaluated for blocks of cells, each block
+    holding about `chunk_size` (cell, neighbor) pairs (by default as many as fit 2^24 features)."""
+    if kernel not in ['pearson', 'cosine']:
+        raise ValueError(f"kernel {kernel} is not supported. Only `pearson` or `cosine` kernel is supported.")
+
     n = X.shape[0]
-    if indices is not None:
-        rows = []
-        cols = []
-        vals = []
+    valid = np.where(V.sum(1) != 0)[0]
+    neighs = iterative_neighbor_graph(indices, n_recurse_neighbors, max_neighs, rows=valid)
+    n_neighs = np.diff(neighs.indptr)
+    vals = np.zeros(neighs.nnz)
+
+    chunk_size = max(2 ** 24 // X.shape[1], 1) if chunk_size is None else chunk_size
+    bounds = np.searchsorted(neighs.indptr, np.arange(0, neighs.nnz, chunk_size), side='right') - 1
+    bounds = np.unique(np.hstack((bounds, len(valid))))
 
-    delta_X = np.zeros((n, X_embedding.shape[1]))
-    for i in tqdm(range(n), desc=f"calculating transition matrix via {kernel} kernel with {transform} transform."):
-        velocity = V[i, :]  # project V to pca space
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
 
-        if velocity.sum() != 0:
-            i_vals = get_iterative_indices(indices, i, n_recurse_neighbors, max_neighs)  # np.zeros((knn, 1))
-            diff = X[i_vals, :] - X[i, :]
+        for b0, b1 in tqdm(zip(bounds[:-1], bounds[1:]), total=len(bounds) - 1,
+                           desc=f"calculating transition matrix via {kernel} kernel with {transform} transform."):
+            cells, sl = valid[b0:b1], slice(neighs.indptr[b0], neighs.indptr[b1])
+            owner = np.repeat(np.arange(b1 - b0), n_neighs[b0:b1])
+            i_vals = neighs.indices[sl]
+            velocity = V[cells]
 
             if transform == 'log':
                 diff_velocity = np.sign(velocity) * np.log1p(np.abs(velocity))
+                diff = X[i_vals] - X[cells][owner]
                 diff_rho = np.sign(diff) * np.log1p(np.abs(diff))
             elif transform == 'logratio':
-                hi_dim, hi_dim_t = X[i, :], X[i, :] + velocity
-                log2hidim = np.log1p(np.abs(hi_dim))
-                diff_velocity = np.log1p(np.abs(hi_dim_t)) - log2hidim
-                diff_rho = np.log1p(np.abs(X[i_vals, :])) - np.log1p(np.abs(hi_dim))
+                log2hidim = np.log1p(np.abs(X[cells]))
+                diff_velocity = np.log1p(np.abs(X[cells] + velocity)) - log2hidim
+                diff_rho = np.log1p(np.abs(X[i_vals])) - log2hidim[owner]
             elif transform == 'linear':
-                diff_velocity = velocity
-                diff_rho = diff
+                diff_velocity = np.array(velocity, dtype=float)
+                diff_rho = X[i_vals] - X[cells][owner]
             elif transform == 'sqrt':
                 diff_velocity = np.sign(velocity) * np.sqrt(np.abs(velocity))
+                diff = X[i_vals] - X[cells][owner]
                 diff_rho = np.sign(diff) * np.sqrt(np.abs(diff))
 
             if kernel == 'pearson':
-                vals_ = einsum_correlation(diff_rho, diff_velocity, type="pearson")
-            elif kernel == 'cosine':
-                vals_ = einsum_correlation(diff_rho, diff_velocity, type="cosine")
+                diff_rho -= diff_rho.mean(1)[:, None]
+                diff_velocity -= np.nanmean(diff_velocity, 1)[:, None]
 
-            rows.extend([i] * len(i_vals))
-            cols.extend(i_vals)
-            vals.extend(vals_)
+            vals[sl] = np.einsum('ij, ij -> i', diff_rho, diff_velocity[owner]) / (
+                norm(diff_rho, axis=1) * norm(diff_velocity, axis=1)[owner]
+            )
 
-    vals = np.hstack(vals)
     vals[np.isnan(vals)] = 0
+    indptr = np.zeros(X_embedding.shape[0] + 1, dtype=neighs.indptr.dtype)
+    indptr[valid + 1] = n_neighs
     G = sp.csr_matrix(
-        (vals, (rows, cols)), shape=(X_embedding.shape[0], X_embedding.shape[0])
+        (vals, neighs.indices, np.cumsum(indptr)), shape=(X_embedding.shape[0], X_embedding.shape[0])
     )
     G = split_velocity_graph(G, neg_cells_trick)
 
@@ -857,18 +864,22 @@ def kernels_from_velocyto_scvelo(
 
 
 def projection_with_transition_matrix(n, T, X_embedding):
-    delta_X = np.zeros((n, X_embedding.shape[1]))
+    """Project the transition matrix to the embedding: for each cell i, delta_X[i] = sum_j T_ij * u_ij - mean_j(T_ij) *
+    sum_j u_ij, where u_ij is the unit vector pointing from cell i to its neighbor j (over the stored entries of T)."""
+    T = sp.csr_matrix(T)
+    rows = np.repeat(np.arange(n), np.diff(T.indptr))
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
 
-        for i in tqdm(range(n), desc=f"projecting velocity vector to low dimensional embedding..."):
-            idx = T[i].indices
-            diff_emb = X_embedding[idx] - X_embedding[i, None]
-            diff_emb /= norm(diff_emb, axis=1)[:, None]
-            diff_emb[np.isnan(diff_emb)] = 0
-            T_i = T[i].data
-            delta_X[i] = T_i.dot(diff_emb) - T_i.mean() * diff_emb.sum(0)
+        diff_emb = X_embedding[T.indices] - X_embedding[rows]
+        diff_emb /= norm(diff_emb, axis=1)[:, None]
+        diff_emb[np.isnan(diff_emb)] = 0
+
+        # sum the per entry vectors of each row with a sparse (cells x entries) indicator matrix
+        R = sp.csr_matrix((np.ones(len(rows)), (rows, np.arange(len(rows)))), shape=(n, len(rows)))
+        T_mean = T.sum(1).A1 / np.diff(T.indptr)
+        delta_X = R.dot(T.data[:, None] * diff_emb) - T_mean[:, None] * R.dot(diff_emb)
 
     return delta_X
 
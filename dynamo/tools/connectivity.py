@@ -1,5 +1,9 @@
 import numpy as np
 import scipy
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
 from scipy.sparse import issparse, csr_matrix
 from sklearn.decomposition import TruncatedSVD
 import warnings
@@ -90,6 +94,207 @@ def get_conn_dist_graph(knn, distances):
     return distances, connectivities
 
 
+# process-wide cache of nearest neighbor indices, shared by all tools that search neighbors on the same data. Each
+# entry is keyed by the fingerprint (or the identity) of the data, the basis and the search parameters, and holds the
+# fitted index as well as the neighbors and distances of the data points themselves for the largest k queried so far.
+# The cache is shared by threads, so it is only accessed while holding `_nn_cache_lock`.
+_nn_index_cache = OrderedDict()
+_nn_cache_lock = threading.Lock()
+nn_cache_size = 8
+
+
+def data_fingerprint(X):
+    """Fingerprint of a dense or sparse data matrix, computed from its shape, dtype and raw bytes."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str((X.shape, X.dtype)).encode())
+    if issparse(X):
+        X = X.tocsr()
+        arrays = [X.data, X.indices, X.indptr]
+    else:
+        arrays = [np.asarray(X)]
+    for a in arrays:
+        h.update(np.ascontiguousarray(a).view(np.uint8))
+
+    return h.hexdigest()
+
+
+def _data_identity(X):
+    """The memory buffer(s) of `X` and the object that owns them. The buffers can only be reused by other data after
+    the owner is garbage collected, which the cache detects with a weak reference to the owner."""
+    if issparse(X) and hasattr(X, "indptr"):
+        arrays = [X.data, X.indices, X.indptr]
+    elif isinstance(X, np.ndarray):
+        arrays = [X]
+    else:
+        return None, None
+    ident = (X.shape,) + tuple((a.__array_interface__["data"][0], a.shape, a.strides, a.dtype.str) for a in arrays)
+    owner = arrays[0] if arrays[0].base is None else arrays[0].base
+    try:
+        weakref.ref(owner)
+    except TypeError:
+        return None, None
+
+    return ident, owner
+
+
+def _freeze(obj):
+    """Hashable representation of (nested) keyword arguments for the cache key."""
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(_freeze(i) for i in obj)
+    if isinstance(obj, np.ndarray):
+        return obj.shape, obj.dtype.str, obj.tobytes()
+    try:
+        hash(obj)
+        return obj
+    except TypeError:
+        return repr(obj)
+
+
+def _nn_method(X, method=None, metric="euclidean"):
+    if method is None:
+        if X.shape[0] > 200000 and X.shape[1] > 2:
+            method = 'pynn'
+        elif X.shape[1] > 10:
+            method = 'ball_tree'
+        else:
+            method = 'kd_tree'
+    if method in ['ball_tree', 'kd_tree'] and not callable(metric):
+        from sklearn.neighbors import VALID_METRICS
+
+        if metric not in VALID_METRICS[method]:
+            method = 'brute'
+
+    return method
+
+
+def clear_nn_cache():
+    """Remove all the nearest neighbor indices cached by `k_nearest_neighbors`."""
+    with _nn_cache_lock:
+        _nn_index_cache.clear()
+
+
+def k_nearest_neighbors(
+    X,
+    k=30,
+    basis=None,
+    metric="euclidean",
+    metric_kwds=None,
+    method=None,
+    cores=1,
+    seed=19491001,
+    use_cache=True,
+    fingerprint=True,
+    return_index=False,
+    **kwargs,
+):
+    """Search the k nearest neighbors of each data point, reusing the cached neighbor index of the same data.
+
+    The fitted index (sklearn's `NearestNeighbors` or pynndescent's `NNDescent`) is cached together with the neighbors
+    of the data points for the largest `k` queried so far. The cache key consists of the data, `basis`, `metric`,
+    `metric_kwds`, `method`, `kwargs` and, for `NNDescent`, `seed`. The data is identified by a hash of its content, so
+    in-place modifications of `X` are never answered from the cache; set `fingerprint` to False to identify it by its
+    memory buffer instead, which is cheaper but only safe if `X` is not modified in place. A query with a smaller or equal `k` is then answered by slicing the cached neighbors, while a
+    larger `k` is queried from the cached index without rebuilding it.
+
+    Parameters
+    ----------
+        X: `np.ndarray` or sparse matrix
+            The data (n_obs x n_features) used for nearest neighbor search.
+        k: `int` (default: `30`)
+            Number of nearest neighbors, including the data point itself.
+        basis: `str` or None (default: `None`)
+            The name of the space of `X`, used as part of the cache key.
+        metric: `str` or callable (default: `euclidean`)
+            The distance metric.
+        metric_kwds: `dict` or None (default: `None`)
+            Additional keyword arguments for the metric function.
+        method: `str` or None (default: `None`)
+            The method for nearest neighbor search, one of `pynn`, `umap`, `ball_tree`, `kd_tree` or `brute`. If None,
+            `pynn` is used for more than 200,000 data points, `ball_tree` for more than 10 features and `kd_tree`
+            otherwise.
+        cores: `int` (default: `1`)
+            The number of parallel jobs to build and query the index.
+        seed: `int` (default `19491001`)
+            Random seed of `NNDescent`.
+        use_cache: `bool` (default: `True`)
+            Whether to look up and store the index in the cache.
+        fingerprint: `bool` (default: `True`)
+            Whether to identify `X` in the cache by a hash of its content (which costs a pass over the data on every
+            call) instead of by its memory buffer. The memory buffer doesn't change when `X` is modified in place, so
+            with `fingerprint=False` the neighbors of the old data would be returned after such modifications.
+        return_index: `bool` (default: `False`)
+            Whether to also return the fitted index, which can be used to query other data points.
+        kwargs:
+            Additional arguments that will be passed to the nearest neighbor search algorithm.
+
+    Returns
+    -------
+        knn, distances: `np.ndarray`
+            The indices and distances (n_obs x k) of the nearest neighbors of each data point.
+        index:
+            The fitted index, returned if `return_index` is True.
+    """
+
+    method = _nn_method(X, method, metric)
+    pynn = method.lower() in ['pynn', 'umap']
+
+    key, owner, entry = None, None, None
+    if use_cache:
+        ident, owner = (data_fingerprint(X), None) if fingerprint else _data_identity(X)
+        if ident is None:
+            ident, owner = data_fingerprint(X), None
+        key = (fingerprint, ident, basis, _freeze(metric), _freeze(metric_kwds), 'pynn' if pynn else method,
+               _freeze(seed) if pynn else None, _freeze(kwargs))
+
+        with _nn_cache_lock:
+            entry = _nn_index_cache.get(key)
+            if entry is not None and entry["owner"] is not None and entry["owner"]() is not owner:
+                # the buffer of a garbage collected array is reused by new data
+                del _nn_index_cache[key]
+                entry = None
+            if entry is not None:
+                _nn_index_cache.move_to_end(key)
+                index, cached_k, knn, distances = entry["index"], entry["k"], entry["knn"], entry["distances"]
+
+    if entry is None:
+        if pynn:
+            from pynndescent import NNDescent
+
+            index = NNDescent(X, metric=metric, metric_kwds=metric_kwds, n_neighbors=k, n_jobs=cores,
+                              random_state=seed, **kwargs)
+        else:
+            from sklearn.neighbors import NearestNeighbors
+
+            index = NearestNeighbors(n_neighbors=k, metric=metric, metric_params=metric_kwds, algorithm=method,
+                                     n_jobs=cores, **kwargs).fit(X)
+        cached_k, knn, distances = 0, None, None
+
+    if cached_k < k:
+        if pynn:
+            knn, distances = index.query(X, k=k)
+        else:
+            distances, knn = index.kneighbors(X, n_neighbors=k)
+        if use_cache:
+            with _nn_cache_lock:
+                if entry is None:
+                    entry = {"index": index, "owner": None if owner is None else weakref.ref(owner), "k": 0}
+                    _nn_index_cache[key] = entry
+                    while len(_nn_index_cache) > nn_cache_size:
+                        _nn_index_cache.popitem(last=False)
+                if entry["k"] < k:
+                    entry.update({"k": k, "knn": knn, "distances": distances})
+    else:
+        knn, distances = knn[:, :k], distances[:, :k]
+
+    if use_cache:
+        # the caller may modify the returned arrays in place
+        knn, distances = knn.copy(), distances.copy()
+
+    return (knn, distances, index) if return_index else (knn, distances)
+
+
 @docstrings.get_sectionsf("umap_ann")
 def umap_conn_indices_dist_embedding(
     X,
@@ -106,6 +311,7 @@ def umap_conn_indices_dist_embedding(
     random_state=0,
     return_mapper=True,
     verbose=False,
+    use_cache=True,
     **umap_kwargs
 ):
     """Compute connectivity graph, matrices for kNN neighbor indices, distance matrix and low dimension embedding with UMAP.
@@ -150,6 +356,9 @@ def umap_conn_indices_dist_embedding(
             the random number generator; If None, the random number generator is the RandomState instance used by `numpy.random`.
         verbose: `bool` (optional, default False)
             Controls verbosity of logging.
+        use_cache: `bool` (optional, default True)
+            Whether to reuse and store the nearest neighbor index of `X` in the cache of `k_nearest_neighbors`. Data sets
+            with less than 4096 samples are searched exactly with pairwise distances and never use the cache.
 
     Returns
     -------
@@ -161,13 +370,12 @@ def umap_conn_indices_dist_embedding(
     from sklearn.utils import check_random_state
     from sklearn.metrics import pairwise_distances
     from umap.umap_ import (
-        nearest_neighbors,
         fuzzy_simplicial_set,
         simplicial_set_embedding,
         find_ab_params,
     )
 
-    random_state = check_random_state(random_state)
+    seed, random_state = random_state, check_random_state(random_state)
 
     _raw_data = X
 
@@ -189,15 +397,14 @@ def umap_conn_indices_dist_embedding(
             g_tmp, n_neighbors=n_neighbors
         )
     else:
-        # Standard case
-        (knn_indices, knn_dists, rp_forest) = nearest_neighbors(
-            X=X,
-            n_neighbors=n_neighbors,
+        # Standard case, reusing the cached NNDescent index of X if any
+        knn_indices, knn_dists = k_nearest_neighbors(
+            X,
+            k=n_neighbors,
             metric=metric,
-            metric_kwds={},
-            angular=False,
-            random_state=random_state,
-            verbose=verbose,
+            method='pynn',
+            seed=seed,
+            use_cache=use_cache,
         )
 
         graph = fuzzy_simplicial_set(
@@ -207,18 +414,9 @@ def umap_conn_indices_dist_embedding(
             metric=metric,
             knn_indices=knn_indices,
             knn_dists=knn_dists,
-            angular=rp_forest,
             verbose=verbose,
         )
 
-        _raw_data = X
-        _transform_available = True
-        # The corresponding nonzero values are stored in similar fashion in self.data.
-        _search_graph, _ = get_conn_dist_graph(knn_indices, knn_dists)
-        _search_graph = _search_graph.maximum(  # Element-wise maximum between this and another matrix.
-            _search_graph.transpose()
-        ).tocsr()
-
     if verbose:
         print("Construct embedding")
 
@@ -405,6 +603,7 @@ def neighbors(
     metric_kwads=None,
     cores=1,
     seed=19491001,
+    use_cache=True,
     **kwargs,
 ):
     """Function to search nearest neighbors of the adata object.
@@ -442,6 +641,9 @@ def neighbors(
             ``-1`` means using all processors.
         seed: `int` (default `19491001`)
             Random seed to ensure the reproducibility of each run.
+        use_cache: `bool` (default: `True`)
+            Whether to reuse (and store) the nearest neighbor index of the same data from the neighbor index cache
+            shared by other tools, see `k_nearest_neighbors`.
         kwargs:
             Additional arguments that will be passed to each nearest neighbor search algorithm.
 
@@ -466,27 +668,13 @@ def neighbors(
         else:
             genes, X_data = fetch_X_data(adata, genes, layer, basis)
 
-    if method is None:
-        if X_data.shape[0] > 200000 and X_data.shape[1] > 2:
-            from pynndescent import NNDescent
-            method = 'pynn'
-        elif X_data.shape[1] > 10:
-            method = 'ball_tree' 
-        else:
-            method = 'kd_tree'
+    if method is not None and method.lower() not in ['pynn', 'umap', 'ball_tree', 'kd_tree']:
+        raise ImportError(f'nearest neighbor search method {method} is not supported')
+    method = _nn_method(X_data, method, metric)
 
     # may distinguish between umap and pynndescent -- treat them equal for now
-    if method.lower() in ['pynn', 'umap']:
-        index = NNDescent(X_data, metric=metric, metric_kwads=metric_kwads, n_neighbors=n_neighbors, n_jobs=cores,
-                          random_state=seed, **kwargs)
-        knn, distances = index.query(X_data, k=n_neighbors)
-    elif method in ['ball_tree', 'kd_tree']:
-        from sklearn.neighbors import NearestNeighbors
-        nbrs = NearestNeighbors(n_neighbors=n_neighbors, metric=metric, metric_params=metric_kwads, algorithm=method,
-                                n_jobs=cores, **kwargs).fit(X_data)
-        distances, knn = nbrs.kneighbors(X_data)
-    else:
-        raise ImportError(f'nearest neighbor search method {method} is not supported')
+    knn, distances = k_nearest_neighbors(X_data, k=n_neighbors, basis=basis, metric=metric, metric_kwds=metric_kwads,
+                                         method=method, cores=cores, seed=seed, use_cache=use_cache, **kwargs)
 
 
     adata.obsp["connectivities"], adata.obsp["distances"] = get_conn_dist_graph(knn, distances)
@@ -1,5 +1,6 @@
 from tqdm import tqdm
 import inspect
+import copy
 import numpy as np
 import pandas as pd
 from scipy.sparse import (
@@ -20,6 +21,7 @@ from .utils import (
     get_U_S_for_velocity_estimation,
     one_shot_alpha_matrix,
     remove_2nd_moments,
+    map_genes,
 )
 from .utils import set_velocity, set_param_ss, set_param_kinetic
 from .moments import (
@@ -52,6 +54,7 @@ def dynamics(
     sanity_check=False,
     del_2nd_moments=False,
     cores=1,
+    backend="auto",
     **est_kwargs
 ):
     """Inclusive model of expression dynamics considers splicing, metabolic labeling and protein translation. It supports
@@ -154,8 +157,11 @@ def dynamics(
             data is huge (like > 25, 000 cells or so) to reducing the memory footprint.
         cores: `int` (default: 1):
             Number of cores to run the estimation. If cores is set to be > 1, multiprocessing will be used to parallel
-            the parameter estimation. Currently only applicable cases when assumption_mRNA is `ss` or cases when 
-            experiment_type is either "one-shot" or "mix_std_stm".
+            the parameter estimation. Applicable to cases when assumption_mRNA is `ss`, cases when experiment_type is
+            either "one-shot" or "mix_std_stm" and the per-gene fits of the kinetic models.
+        backend: `str` (default: `auto`)
+            The execution backend for the per-gene fits of the kinetic models (when assumption_mRNA is `kinetic`), one of
+            `serial`, `thread`, `process` or `joblib`. `auto` uses `serial` when cores is 1 and `process` otherwise.
         **est_kwargs
             Other arguments passed to the fit method (steady state models) or estimation methods (kinetic models).
 
@@ -563,6 +569,7 @@ def dynamics(
         elif assumption_mRNA.lower() == "kinetic":
             if model_was_auto and experiment_type.lower() == "kin": model = "mixture"
             if est_method == 'auto': est_method = 'direct'
+            if backend == 'auto': backend = 'serial' if cores == 1 else 'process'
             data_type = 'smoothed' if use_smoothed else 'sfs'
 
             params, \
@@ -581,6 +588,8 @@ def dynamics(
                                            has_switch=True,
                                            param_rngs={},
                                            data_type=data_type,
+                                           backend=backend,
+                                           cores=cores,
                                            **est_kwargs)
 
             if type(params) == dict:
@@ -808,9 +817,109 @@ def dynamics(
     return adata
 
 
+def _fit_kinetic_gene(cur_X_data, cur_X_raw, time, model, experiment_type, has_splicing, Est, _param_ranges, x0_,
+                      est_kwargs, random_state=None):
+    """Fit the kinetic model of a single gene for `kinetic_model`. This is a module level function so that it can be used
+    with the `process` and `joblib` backends of `map_genes`. `random_state` is used by the estimation object to sample
+    the initial guesses of parameters.
+
+    Returns
+    -------
+        cost, Estm, X_data, X_fit_data, half_life, logLL, popt, param_ranges: the cost of the fit, the estimated parameters,
+        the data and fitted data, the half life, the goodness of fit, the optimal parameters (`mix_pulse_chase`/
+        `mix_kin_deg` experiments only) and the parameter ranges used for this gene.
+    """
+    popt = None
+    if model.lower().startswith('mixture'):
+        # the mixture estimation object keeps the fitting state of a gene, so each gene gets its own copy.
+        estm = copy.deepcopy(Est)
+        estm.random_state = random_state
+
+        _, cost = estm.auto_fit(np.unique(time), cur_X_data)
+        model_1, model_2, kinetic_parameters, mix_x0 = estm.export_dictionary().values()
+        tmp = list(kinetic_parameters.values())
+        tmp.extend(mix_x0)
+        Estm = tmp
+    else:
+        if experiment_type.lower() == 'kin':
+            if has_splicing:
+                alpha0 = guestimate_alpha(np.sum(cur_X_data, 0), np.unique(time))
+            else:
+                alpha0 = guestimate_alpha(cur_X_data, np.unique(time)) if cur_X_data.ndim == 1 \
+                    else guestimate_alpha(cur_X_data[0], np.unique(time))
+
+            _param_ranges = _param_ranges.copy()
+            if model.lower() =='stochastic':
+                _param_ranges.update({'alpha_a': [0, alpha0*10]})
+            elif model.lower() == 'deterministic':
+                _param_ranges.update({'alpha': [0, alpha0 * 10]})
+            param_ranges = [ran for ran in _param_ranges.values()]
+
+            estm = Est(*param_ranges, x0=x0_) if 'x0' in inspect.getfullargspec(Est) \
+                else Est(*param_ranges)
+            estm.random_state = random_state
+            _, cost = estm.fit_lsq(np.unique(time), cur_X_data, **est_kwargs)
+            if model.lower() == 'deterministic':
+                Estm = estm.export_parameters()
+            else:
+                tmp = np.ma.array(estm.export_parameters(), mask=False)
+                tmp.mask[3] = True
+                Estm = tmp.compressed()
+
+        elif experiment_type.lower() == 'deg':
+            estm = Est()
+            estm.random_state = random_state
+
+            _, cost = estm.auto_fit(np.unique(time), cur_X_data)
+            Estm = estm.export_parameters()[1:]
+
+        elif experiment_type.lower() in ['mix_pulse_chase', 'mix_kin_deg']:
+            estm = Est()
+            estm.random_state = random_state
+
+            popt, cost = estm.auto_fit(np.unique(time), cur_X_data)
+            Estm = estm.export_parameters()
+
+    if model.lower().startswith('mixture'):
+        X_fit_data = estm.simulator.x.T
+        X_fit_data[estm.model1.n_species:] *= estm.scale
+    elif experiment_type in ['mix_kin_deg', 'mix_pulse_chase']:
+        # kinetic chase simulation
+        kinetic_chase = estm.simulator.x.T
+        # hidden x
+        tt, h = estm.simulator.calc_init_conc()
+
+        X_fit_data = [kinetic_chase, [tt, h]]
+    else:
+        if hasattr(estm, "extract_data_from_simulator"):
+            X_fit_data = estm.extract_data_from_simulator()
+        else:
+            X_fit_data = estm.simulator.x.T
+
+    half_life = np.log(2)/Estm[-1] if experiment_type.lower() == 'kin' else estm.calc_half_life('gamma')
+
+    if model.lower().startswith('mixture'):
+        species = [0, 1, 2, 3] if has_splicing else [0, 1]
+        gof = GoodnessOfFit(estm.export_model(), params=estm.export_parameters())
+        gof.prepare_data(time, cur_X_raw.T, species=species, normalize=True)
+    else:
+        gof = GoodnessOfFit(estm.export_model(), params=estm.export_parameters(), x0=estm.simulator.x0)
+        gof.prepare_data(time, cur_X_raw.T, normalize=True)
+
+    logLL = gof.calc_mean_squared_deviation() # .calc_gaussian_loglikelihood()
+
+    return cost, Estm, cur_X_data, X_fit_data, half_life, logLL, popt, _param_ranges
+
+
 def kinetic_model(subset_adata, tkey, model, est_method, experiment_type, has_splicing, splicing_labeling, has_switch, param_rngs,
-                  data_type='sfs', **est_kwargs):
-    """est_method can be either `twostep` (two-step model) or `direct`. data_type can either 'sfs' or 'smoothed'."""
+                  data_type='sfs', backend='serial', cores=1, chunk_size=None, seed=None, **est_kwargs):
+    """est_method can be either `twostep` (two-step model) or `direct`. data_type can either 'sfs' or 'smoothed'.
+
+    The per-gene fits are run by `map_genes` with the given execution `backend` (`serial`, `thread`, `process` or
+    `joblib`), `cores` and `chunk_size`. If `seed` is not None, the initial guesses of the i-th gene are sampled from its
+    own random state seeded with `seed + i`; otherwise the estimation objects use their default (fixed) latin hypercube
+    seed.
+    Genes whose fitting raises an exception get nan parameters instead of aborting the whole run."""
     time = subset_adata.obs[tkey].astype('float').values
 
     if experiment_type.lower() == 'kin':
@@ -1067,102 +1176,40 @@ def kinetic_model(subset_adata, tkey, model, est_method, experiment_type, has_sp
     X_data, X_fit_data = [None] * n_genes, [None] * n_genes
     if experiment_type: popt = [None] * n_genes
 
-    for i_gene in tqdm(range(n_genes), desc="estimating kinetic-parameters using kinetic model"):
-        if model.lower().startswith('mixture'):
-            estm = Est
-            if model.lower() == 'mixture':
-                cur_X_data = np.vstack([X[i_layer][i_gene] for i_layer in range(len(X))])
-                if issparse(X_raw[0]):
-                    cur_X_raw = np.hstack([X_raw[i_layer][:, i_gene].A for i_layer in range(len(X))])
-                else:
-                    cur_X_raw = np.hstack([X_raw[i_layer][:, i_gene] for i_layer in range(len(X))])
+    gene_args = []
+    for i_gene in range(n_genes):
+        if model.lower() == 'mixture':
+            cur_X_data = np.vstack([X[i_layer][i_gene] for i_layer in range(len(X))])
+            if issparse(X_raw[0]):
+                cur_X_raw = np.hstack([X_raw[i_layer][:, i_gene].A for i_layer in range(len(X))])
             else:
-                cur_X_data = X[i_gene]
-                cur_X_raw = X_raw[i_gene]
-
-                if issparse(cur_X_raw[0, 0]):
-                    cur_X_raw = np.hstack((cur_X_raw[0, 0].A, cur_X_raw[1, 0].A))
-
-            _, cost[i_gene] = estm.auto_fit(np.unique(time), cur_X_data)
-            model_1, model_2, kinetic_parameters, mix_x0 = estm.export_dictionary().values()
-            tmp = list(kinetic_parameters.values())
-            tmp.extend(mix_x0)
-            Estm[i_gene] = tmp
+                cur_X_raw = np.hstack([X_raw[i_layer][:, i_gene] for i_layer in range(len(X))])
         else:
-            if experiment_type.lower() == 'kin':
-                cur_X_data, cur_X_raw = X[i_gene], X_raw[i_gene]
-
-                if has_splicing:
-                    alpha0 = guestimate_alpha(np.sum(cur_X_data, 0), np.unique(time))
-                else:
-                    alpha0 = guestimate_alpha(cur_X_data, np.unique(time)) if cur_X_data.ndim == 1 \
-                        else guestimate_alpha(cur_X_data[0], np.unique(time))
-
-                if model.lower() =='stochastic':
-                    _param_ranges.update({'alpha_a': [0, alpha0*10]})
-                elif model.lower() == 'deterministic':
-                    _param_ranges.update({'alpha': [0, alpha0 * 10]})
-                param_ranges = [ran for ran in _param_ranges.values()]
-
-                estm = Est(*param_ranges, x0=x0_) if 'x0' in inspect.getfullargspec(Est) \
-                    else Est(*param_ranges)
-                _, cost[i_gene] = estm.fit_lsq(np.unique(time), cur_X_data, **est_kwargs)
-                if model.lower() == 'deterministic':
-                    Estm[i_gene] = estm.export_parameters()
-                else:
-                    tmp = np.ma.array(estm.export_parameters(), mask=False)
-                    tmp.mask[3] = True
-                    Estm[i_gene] = tmp.compressed()
-
-            elif experiment_type.lower() == 'deg':
-                estm = Est()
-                cur_X_data, cur_X_raw = X[i_gene], X_raw[i_gene]
-                
-                _, cost[i_gene] = estm.auto_fit(np.unique(time), cur_X_data)
-                Estm[i_gene] = estm.export_parameters()[1:]
-
-            elif experiment_type.lower() in ['mix_pulse_chase', 'mix_kin_deg']:
-                estm = Est()
-                cur_X_data, cur_X_raw = X[i_gene], X_raw[i_gene]
-
-                popt[i_gene], cost[i_gene] = estm.auto_fit(np.unique(time), cur_X_data)
-                Estm[i_gene] = estm.export_parameters()
-
+            cur_X_data, cur_X_raw = X[i_gene], X_raw[i_gene]
             if issparse(cur_X_raw[0, 0]):
                 cur_X_raw = np.hstack((cur_X_raw[0, 0].A, cur_X_raw[1, 0].A))
-            # model_1, kinetic_parameters, mix_x0 = estm.export_dictionary().values()
-            # tmp = list(kinetic_parameters.values())
-            # tmp.extend(mix_x0)
-            # Estm[i_gene] = tmp
-
-        X_data[i_gene] = cur_X_data
-        if model.lower().startswith('mixture'):
-            X_fit_data[i_gene] = estm.simulator.x.T
-            X_fit_data[i_gene][estm.model1.n_species:] *= estm.scale
-        elif experiment_type in ['mix_kin_deg', 'mix_pulse_chase']:
-            # kinetic chase simulation
-            kinetic_chase = estm.simulator.x.T
-            # hidden x
-            tt, h = estm.simulator.calc_init_conc()
-
-            X_fit_data[i_gene] = [kinetic_chase, [tt, h]]
-        else:
-            if hasattr(estm, "extract_data_from_simulator"):
-                X_fit_data[i_gene] = estm.extract_data_from_simulator()
-            else:
-                X_fit_data[i_gene] = estm.simulator.x.T
 
-        half_life[i_gene] = np.log(2)/Estm[i_gene][-1] if experiment_type.lower() == 'kin' else estm.calc_half_life('gamma')
-
-        if model.lower().startswith('mixture'):
-            species = [0, 1, 2, 3] if has_splicing else [0, 1]
-            gof = GoodnessOfFit(estm.export_model(), params=estm.export_parameters())
-            gof.prepare_data(time, cur_X_raw.T, species=species, normalize=True)
+        gene_args.append((cur_X_data, cur_X_raw, time, model, experiment_type, has_splicing, Est, _param_ranges, x0_,
+                          est_kwargs))
+
+    res, failed = map_genes(_fit_kinetic_gene, gene_args, backend=backend, cores=cores, chunk_size=chunk_size,
+                            seed=seed, desc="estimating kinetic-parameters using kinetic model")
+    if len(failed) == n_genes:
+        raise Exception(f"kinetic model fitting failed for all genes, the first error is: {repr(failed[0])}")
+
+    n_params = len(res[min(set(range(n_genes)).difference(failed))][1])
+    for i_gene in range(n_genes):
+        if res[i_gene] is None:
+            # failed genes are kept with nan parameters so that they can be filtered out downstream.
+            cost[i_gene], Estm[i_gene], half_life[i_gene], logLL[i_gene] = np.nan, np.full(n_params, np.nan), np.nan, \
+                                                                           np.nan
+            X_data[i_gene] = gene_args[i_gene][0]
         else:
-            gof = GoodnessOfFit(estm.export_model(), params=estm.export_parameters(), x0=estm.simulator.x0)
-            gof.prepare_data(time, cur_X_raw.T, normalize=True)
-
-        logLL[i_gene] = gof.calc_mean_squared_deviation() # .calc_gaussian_loglikelihood()
+            cost[i_gene], Estm[i_gene], X_data[i_gene], X_fit_data[i_gene], half_life[i_gene], logLL[i_gene], \
+            popt[i_gene], cur_param_ranges = res[i_gene]
+    if experiment_type.lower() == 'kin' and not model.lower().startswith('mixture'):
+        # the alpha range is updated gene by gene and the range of the last gene is reported, as before.
+        _param_ranges = cur_param_ranges
 
     if experiment_type.lower() == 'deg' and est_method == 'twostep' and has_splicing:
         layers = ['M_u', 'M_s'] if (
@@ -1,7 +1,7 @@
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
-from scipy.sparse import issparse
+from scipy.sparse import issparse, csr_matrix, diags
 from scipy.stats import mannwhitneyu
 from scipy import stats
 from statsmodels.sandbox.stats.multicomp import multipletests
@@ -10,26 +10,135 @@ from patsy import dmatrix, bs, cr
 import statsmodels.api as sm
 import statsmodels.formula.api as smf
 from collections import Counter
+from multiprocessing.dummy import Pool as ThreadPool
 import warnings
 from .utils import fetch_X_data
-from .utils_markers import specificity, fdr
+from .utils_markers import one_hot_specificity, fdr
 from ..preprocessing.utils import Freeman_Tukey
 
 
+def _moran_weights(neighbor_graph, weighted=True):
+    """Row standardized spatial weights of the neighbor graph (the default `'r'` transformation of pysal's weights)
+    together with the s0, s1 and s2 sums of the weights used by the moments of Moran's I."""
+    W = csr_matrix(neighbor_graph, dtype=float, copy=True)
+    if not weighted:
+        W.data[:] = 1
+    row_sums = np.asarray(W.sum(1)).flatten()
+    W = diags(np.divide(1, row_sums, out=np.zeros_like(row_sums), where=row_sums > 0)) @ W
+
+    s0 = W.sum()
+    s1 = 0.5 * (W + W.T).power(2).sum()
+    s2 = ((np.asarray(W.sum(1)).flatten() + np.asarray(W.sum(0)).flatten()) ** 2).sum()
+
+    return W, s0, s1, s2
+
+
+def _moran_genes(X_data,
+                 W,
+                 s0,
+                 s1,
+                 s2,
+                 permutations=999,
+                 seed=19491001,
+                 local_moran=False,
+                 chunk_size=None,
+                 cores=1,
+                 ):
+    """Global (and optionally local) Moran's I of all genes (columns of `X_data`) for the sparse spatial weights `W`.
+
+    The global statistic of all genes is diag(Z^T W Z) on the centered expression Z, scaled by n / (s0 * sum(z^2)).
+    Its p-values under the normality and randomization assumptions are computed in closed form and, if `permutations`
+    is larger than 0, with a permutation test in which all genes share the same permutations of the cells. Genes are
+    processed in chunks (of `chunk_size` genes) that can be distributed over a pool of `cores` threads.
+
+    Returns
+    -------
+        res: `dict`
+            The Moran's I (`I`), z-scores (`z_norm`, `z_rand`, `z_sim`) and one-tailed p-values (`p_norm`, `p_rand`,
+            `p_sim`) of each gene. `z_sim` and `p_sim` are only included when `permutations` is larger than 0. All of
+            them are NaN for constant genes.
+        local_I: `np.ndarray` or None
+            The local Moran's I of each cell and gene if `local_moran` is True.
+    """
+    n, n_genes = X_data.shape
+    if chunk_size is None: chunk_size = max(1, min(1000, int(np.ceil(n_genes / cores))))
+
+    def compute_chunk(start):
+        Z = X_data[:, start:start + chunk_size]
+        Z = Z.toarray() if issparse(Z) else np.array(Z, dtype=float)
+        # constant genes have no spatial pattern; their statistics are left undefined (NaN)
+        constant = Z.max(0) == Z.min(0)
+        Z = Z - Z.mean(0)
+        Z[:, constant] = 0
+        z2ss = (Z ** 2).sum(0)
+        WZ = W @ Z
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            res = {'I': n / s0 * (Z * WZ).sum(0) / z2ss, 'k': n * (Z ** 4).sum(0) / z2ss ** 2}
+            local_I = (n - 1) * Z * WZ / z2ss if local_moran else None
+
+            if permutations > 0:
+                rng = np.random.default_rng(seed)
+                sim = np.zeros((permutations, Z.shape[1]))
+                for i in range(permutations):
+                    Z_perm = Z[rng.permutation(n)]
+                    sim[i] = n / s0 * (Z_perm * (W @ Z_perm)).sum(0) / z2ss
+                larger = (sim >= res['I']).sum(0)
+                larger = np.minimum(larger, permutations - larger)
+                res['p_sim'] = (larger + 1) / (permutations + 1)
+                res['z_sim'] = (res['I'] - sim.mean(0)) / sim.std(0)
+
+        for key in res.keys():
+            res[key][constant] = np.nan
+        return res, local_I
+
+    starts = range(0, n_genes, chunk_size)
+    if cores == 1:
+        results = map(compute_chunk, starts)
+    else:
+        pool = ThreadPool(cores)
+        results = pool.imap(compute_chunk, starts)
+    results = [r for r in tqdm(results, total=len(starts), desc="Moran’s I Global Autocorrelation Statistic")]
+    if cores != 1:
+        pool.close()
+        pool.join()
+
+    res = {key: np.hstack([r[0][key] for r in results]) for key in results[0][0].keys()}
+    local_I = np.hstack([r[1] for r in results]) if local_moran else None
+
+    EI, s02 = -1 / (n - 1), s0 ** 2
+    VI_norm = (n ** 2 * s1 - n * s2 + 3 * s02) / ((n - 1) * (n + 1) * s02) - EI ** 2
+    A = n * ((n ** 2 - 3 * n + 3) * s1 - n * s2 + 3 * s02)
+    B = res.pop('k') * ((n ** 2 - n) * s1 - 2 * n * s2 + 6 * s02)
+    VI_rand = (A - B) / ((n - 1) * (n - 2) * (n - 3) * s02) - EI ** 2
+    with np.errstate(invalid='ignore'):
+        res['z_norm'] = (res['I'] - EI) / np.sqrt(VI_norm)
+        res['z_rand'] = (res['I'] - EI) / np.sqrt(VI_rand)
+    res['p_norm'] = stats.norm.sf(np.abs(res['z_norm']))
+    res['p_rand'] = stats.norm.sf(np.abs(res['z_rand']))
+
+    return res, local_I
+
+
 def moran_i(adata,
             X_data = None,
             genes=None,
             layer=None,
             weighted=True,
             assumption='permutation',
-            local_moran=False):
+            local_moran=False,
+            permutations=999,
+            seed=19491001,
+            chunk_size=None,
+            cores=1):
     """Identify genes with strong spatial autocorrelation with Moran's I test. This can be used to identify genes that are
     potentially related to critical dynamic process. Moran's I test is first introduced in single cell genomics analysis
     in (Cao, et al, 2019). Note that moran_i supports performing spatial autocorrelation analysis for any layer or
     normalized data in your adata object. That is you can either use the total, new, unspliced or velocity, etc. for the
     Moran's I analysis.
 
-    Global Moran's I test is based on pysal. More details can be found at:
+    Global Moran's I of all genes is computed at once with the (row standardized) sparse neighbor graph as the spatial
+    weights, following the definitions of pysal's `esda.Moran`. More details can be found at:
     http://geodacenter.github.io/workbook/5a_global_auto/lab5a.html#morans-i
 
     Parameters
@@ -56,18 +165,26 @@ def moran_i(adata,
             which yields a reference distribution.
         local_moran: `bool` (default: `False`)
             Whether to also calculate local Moran's I.
+        permutations: `int` (default: `999`)
+            The number of random permutations of the cells used by the permutation test. The same permutations are
+            shared by all genes. Only used when `assumption` is `permutation`.
+        seed: `int` (default: `19491001`)
+            The seed of the random number generator for the permutations.
+        chunk_size: `int` or None (default: `None`)
+            The number of genes processed together. If `None`, it is chosen based on the number of genes and `cores`.
+        cores: `int` (default: `1`)
+            The number of threads used to process the chunks of genes in parallel.
 
     Returns
     -------
-        Returns an updated `~anndata.AnnData` with a new key `'Moran_' + type` in the .uns attribute, storing the Moran' I
-        test results.
+        Returns an updated `~anndata.AnnData` with the Moran's I test results (`moran_i`, `moran_p_val`, `moran_q_val`
+        and `moran_z`) added to .var and, if `local_moran` is True, the local Moran's I (cells x genes) in
+        .uns['local_moran'].
     """
 
-    try:
-        import pysal
-    except ImportError:
-        raise ImportError("You need to install the package `pysal`."
-                          "Please install via pip install pysal. See more details at https://pypi.org/project/pysal/")
+    if assumption not in ['permutation', 'normality', 'randomization']:
+        raise ValueError(f"assumption {assumption} is not supported. It must be one of 'permutation', 'normality' or "
+                         f"'randomization'.")
 
     if X_data is None:
         genes, X_data = fetch_X_data(adata, genes, layer)
@@ -76,8 +193,6 @@ def moran_i(adata,
             raise ValueError(f"When providing X_data, a list of genes name that corresponds to the columns of X_data "
                              f"must be provided")
 
-    cell_num, gene_num = X_data.shape
-
     embedding_key = (
         "X_umap" if layer is None else layer + "_umap"
     )
@@ -89,44 +204,19 @@ def moran_i(adata,
         from .dimension_reduction import reduceDimension
         adata = reduceDimension(adata, X_data=X_data, layer=layer)
 
-    neighbor_graph = adata.obsp["connectivities"]
-
-    # convert a sparse adjacency matrix to a dictionary
-    adj_dict = {
-        i: row.indices
-        for i, row in enumerate(neighbor_graph)
-    }
-    if weighted :
-        weight_dict = {
-            i: row.data
-            for i, row in enumerate(neighbor_graph)
-        }
-        W = pysal.lib.weights.W(adj_dict, weight_dict)
-    else:
-        W = pysal.lib.weights.W(adj_dict)
-
-    sparse = issparse(X_data)
-
-    Moran_I, p_value, statistics = [None] * gene_num, [None] * gene_num, [None] * gene_num
-    if local_moran:
-        l_moran = np.zeros(X_data.shape)
-    for cur_g in tqdm(range(gene_num), desc="Moran’s I Global Autocorrelation Statistic"):
-        cur_X = X_data[:, cur_g].A if sparse else X_data[:, cur_g]
-        mbi = pysal.explore.esda.moran.Moran(cur_X, W, two_tailed=False)
-
-        Moran_I[cur_g] = mbi.I
-        p_value[cur_g] = mbi.p_sim if assumption == 'permutation' else \
-            mbi.p_norm if assumption == 'normality' else mbi.p_rand
-        statistics[cur_g] = mbi.z_sim if assumption == 'permutation' else \
-            mbi.z_norm if assumption == 'normality' else mbi.z_sim
-        if local_moran:
-            l_moran[:, cur_g] = pysal.explore.esda.moran.Moran_Local(cur_X, W).Is
+    W, s0, s1, s2 = _moran_weights(adata.obsp["connectivities"], weighted)
+    res, l_moran = _moran_genes(X_data, W, s0, s1, s2,
+                                permutations=permutations if assumption == 'permutation' else 0, seed=seed,
+                                local_moran=local_moran, chunk_size=chunk_size, cores=cores)
 
+    key = 'sim' if assumption == 'permutation' else 'norm' if assumption == 'normality' else 'rand'
+    p_val, q_val = res['p_' + key], np.full(len(res['I']), np.nan)
+    q_val[~np.isnan(p_val)] = fdr(p_val[~np.isnan(p_val)])
     Moran_res = pd.DataFrame(
-        {"moran_i": Moran_I,
-         "moran_p_val": p_value,
-         "moran_q_val": fdr(np.array(p_value)),
-         "moran_z": statistics,
+        {"moran_i": res['I'],
+         "moran_p_val": p_val,
+         "moran_q_val": q_val,
+         "moran_z": res['z_' + key],
          }, index=genes
     )
 
@@ -137,6 +227,187 @@ def moran_i(adata,
     return adata
 
 
+def _mwu_gene(vals, gk, n_k, pg, ph, s, sort_abs):
+    """Mann-Whitney U statistics of one gene for all (test, control) group pairs.
+
+    `vals` and `gk` are the non-zero values of the gene and the group codes of the corresponding cells, `n_k` the group
+    sizes and `pg`, `ph` the test and control group of each pair. The `s[pg, ph]` lowest (by value, or absolute value if
+    `sort_abs`) control values are dropped before testing, as when only the top ranked control values are kept.
+
+    The gene is ranked only once: the counts of each group at each distinct value (`c`, groups x levels) are enough to
+    evaluate the U statistics, tie corrections and means of all pairs.
+    """
+    K = len(n_k)
+    nnz_k = np.bincount(gk, minlength=K)
+    sum_k = np.bincount(gk, vals, minlength=K)
+    pos_k = np.bincount(gk, vals > 0, minlength=K)
+    nan_k = np.bincount(gk, np.isnan(vals), minlength=K) > 0
+
+    # distinct values (levels), with the (tied) zeros inserted as one level
+    levels, inv = np.unique(vals, return_inverse=True)
+    z = np.searchsorted(levels, 0)
+    levels = np.insert(levels, z, 0)
+    L = len(levels)
+    c = np.bincount(gk * L + inv.ravel() + (inv.ravel() >= z), minlength=K * L).reshape((K, L)).astype(float)
+    c[:, z] += n_k - nnz_k
+
+    n1, m = n_k[pg].astype(float), (n_k[ph] - s[pg, ph]).astype(float)
+    sv = s[pg, ph]
+    if not sort_abs or not np.any(sv > 0):
+        # the kept control values are the top ones in value order, so the counts below and at each level only need to
+        # be shifted by the number of dropped values.
+        C = np.cumsum(c, 1)
+        eg, el = np.nonzero(c)
+        w, B, E = c[eg, el], (C - c)[:, el].T, c[:, el].T
+        S = s[eg]
+        E_ = np.clip(B + E - S, 0, E)
+        phi = np.maximum(B - S, 0) + 0.5 * E_
+        starts = np.searchsorted(eg, np.arange(K))
+        U = np.add.reduceat(w[:, None] * phi, starts, axis=0)[pg, ph]
+        tie = np.add.reduceat(w[:, None] ** 3 + 3 * w[:, None] * E_ * (w[:, None] + E_), starts, axis=0)[pg, ph]
+
+        # the level where the dropped control values end and the number of values kept at that level
+        offset = np.arange(K)[:, None] * (n_k.max() + 1)
+        l_star = np.searchsorted((C + offset).ravel(), sv + offset[ph, 0], side='right') - ph * L
+        r = C[ph, l_star] - sv
+        suffix = lambda a: np.hstack((np.cumsum(a[:, ::-1], 1)[:, ::-1], np.zeros((K, 1))))
+        tie += suffix(c ** 3)[ph, l_star + 1] + r ** 3 - (n1 + m)
+        ctrl_sum = suffix(np.where(c > 0, c * levels, 0))[ph, l_star + 1] + r * levels[l_star]
+        ctrl_pos = np.minimum(m, pos_k[ph])
+        kept = lambda i: np.clip(C[ph[i]] - sv[i], 0, c[ph[i]])
+    else:
+        # keep the values with the largest absolute values; ties are broken toward the larger value
+        order = np.lexsort((levels, np.abs(levels)))
+        C_abs = np.empty_like(c)
+        C_abs[:, order] = np.cumsum(c[:, order], 1)
+        c_ctrl = np.clip(C_abs[ph] - sv[:, None], 0, c[ph])
+        c_test = c[pg]
+        U = (c_test * (np.cumsum(c_ctrl, 1) - 0.5 * c_ctrl)).sum(1)
+        tie = ((c_test + c_ctrl) ** 3).sum(1) - (n1 + m)
+        ctrl_sum = np.where(c_ctrl > 0, c_ctrl * levels, 0).sum(1)
+        ctrl_pos = c_ctrl[:, levels > 0].sum(1)
+        kept = lambda i: c_ctrl[i]
+
+    n1n2, N = n1 * m, n1 + m
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sd = np.sqrt(n1n2 / 12 * ((N + 1) - tie / (N * (N - 1))))
+        zscore = (np.maximum(U, n1n2 - U) - n1n2 / 2 - 0.5) / sd
+    pval = np.clip(2 * stats.norm.sf(zscore), 0, 1)
+
+    # small samples without ties get the exact p-value, as in `scipy.stats.mannwhitneyu`
+    for i in np.where(((n1 <= 8) | (m <= 8)) & (np.round(tie) == 0))[0]:
+        pval[i] = mannwhitneyu(np.repeat(levels, c[pg[i]].astype(int)),
+                               np.repeat(levels, np.round(kept(i)).astype(int))).pvalue
+
+    nan_pair = nan_k[pg] | nan_k[ph]
+    U[nan_pair], pval[nan_pair] = np.nan, np.nan
+
+    return nnz_k, sum_k, pos_k, U, pval, ctrl_sum, ctrl_pos
+
+
+def _mwu_groups(X_data,
+                codes,
+                pg,
+                ph,
+                exp_frac_thresh,
+                log2_fc_thresh,
+                subset_control_vals,
+                sort_abs=False,
+                chunk_size=None,
+                cores=1,
+                ):
+    """Batched rank-based differential expression test between the (test, control) group pairs `(pg[i], ph[i])`.
+
+    Each gene is ranked once across the cells of all groups (`codes` is the group code of each cell and -1 for the
+    cells in none of the groups) and the Mann-Whitney U test, rank-biserial correlation, expression fraction, fold
+    change, specificity and difference of positive ratios are computed for all pairs at once. Genes are processed in
+    chunks (of `chunk_size` genes) that can be distributed over a pool of `cores` threads.
+
+    Returns
+    -------
+        A pandas DataFrame with one row per gene and pair that passes the expression fraction and fold change
+        thresholds. The `gene` and `pair` columns hold the gene index and the pair index.
+    """
+    n_cells, n_genes = X_data.shape
+    K = codes.max() + 1
+    n_k = np.bincount(codes[codes >= 0], minlength=K)
+    s = np.maximum(n_k[None, :] - n_k[:, None], 0) if subset_control_vals else np.zeros((K, K), dtype=int)
+    if chunk_size is None: chunk_size = max(1, min(1000, int(np.ceil(n_genes / cores))))
+
+    def compute_chunk(start):
+        X = X_data[:, start:start + chunk_size]
+        X = X.tocsc() if issparse(X) else np.asarray(X)
+        res = []
+        for j in range(X.shape[1]):
+            if issparse(X):
+                idx, vals = X.indices[X.indptr[j]:X.indptr[j + 1]], X.data[X.indptr[j]:X.indptr[j + 1]]
+                idx, vals = idx[vals != 0], vals[vals != 0]
+            else:
+                idx = np.flatnonzero(X[:, j])
+                vals = X[idx, j]
+            in_groups = codes[idx] >= 0
+            nnz_k, sum_k, pos_k, U, pval, ctrl_sum, ctrl_pos = _mwu_gene(
+                vals[in_groups], codes[idx][in_groups], n_k, pg, ph, s, sort_abs)
+
+            ef = nnz_k[pg] / n_k[pg]
+            m = n_k[ph] - s[pg, ph]
+            mean_test, mean_ctrl = sum_k[pg] / n_k[pg], ctrl_sum / m
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if log2_fc_thresh is not None:
+                    log_fc = np.where(mean_ctrl == 0, np.inf, np.log2(mean_test) - np.log2(mean_ctrl))
+                    valid = (ef >= exp_frac_thresh) & ~(np.abs(log_fc) < log2_fc_thresh)
+                else:
+                    log_fc = mean_test - mean_ctrl # for curvature, acceleration, log fc is meaningless
+                    valid = ef >= exp_frac_thresh
+
+            specificity_ = one_hot_specificity(nnz_k / n_cells)[ph]
+            rbc = 1 - 2 * U / (n_k[pg] * m)
+            diff_ratio_pos = pos_k[pg] / n_k[pg] - ctrl_pos / m
+
+            i = np.where(valid)[0]
+            res.append(np.column_stack((np.repeat(start + j, len(i)), i, ef[i], rbc[i], log_fc[i], pval[i],
+                                        specificity_[i], diff_ratio_pos[i])))
+        return np.vstack(res)
+
+    starts = range(0, n_genes, chunk_size)
+    if cores == 1:
+        results = map(compute_chunk, starts)
+    else:
+        pool = ThreadPool(cores)
+        results = pool.imap(compute_chunk, starts)
+    res = np.vstack([r for r in tqdm(results, total=len(starts), desc="identifying top markers for each group")])
+    if cores != 1:
+        pool.close()
+        pool.join()
+
+    res = pd.DataFrame(res, columns=['gene', 'pair', 'exp_frac', 'rbc', 'log2_fc', 'pval', 'specificity',
+                                     'diff_ratio_pos'])
+    res[['gene', 'pair']] = res[['gene', 'pair']].astype(int)
+    return res
+
+
+def _mwu_de_table(res, genes, test_group, control_groups, qval_thresh):
+    """Format the `_mwu_groups` results of one test group (rows ordered by gene and then by control group) as the
+    differential expression table of `two_groups_degs`."""
+    de = pd.DataFrame({'gene': np.asarray(genes)[res['gene'].values],
+                       'versus_group': np.asarray(control_groups)[res['pair'].values]})
+    for col in ['exp_frac', 'rbc', 'log2_fc', 'pval', 'specificity', 'diff_ratio_pos']:
+        de[col] = res[col].values
+    de = de[de.iloc[:, 2:].sum(1) > 0]
+
+    if de.shape[0] > 1:
+        de['qval'] = multipletests(de['pval'].values, method='fdr_bh')[1]
+    else:
+        de['qval'] = [np.nan for _ in range(de.shape[0])]
+    de['test_group'] = [test_group for _ in range(de.shape[0])]
+    out_order = ['gene', 'test_group', 'versus_group', 'specificity', 'exp_frac', 'diff_ratio_pos',
+                 'rbc', 'log2_fc', 'pval', 'qval']
+    de = de[out_order].sort_values(by='qval')
+    res = de[(de.qval < qval_thresh)].reset_index().drop(columns=['index'])
+
+    return res
+
+
 def find_group_markers(adata,
                        group,
                        genes=None,
@@ -146,6 +417,8 @@ def find_group_markers(adata,
                        qval_thresh=0.05,
                        de_frequency=1,
                        subset_control_vals=None,
+                       chunk_size=None,
+                       cores=1,
                        ):
     """Find marker genes for each group of cells based on gene expression or velocity values as specified by the layer.
 
@@ -192,6 +465,11 @@ def find_group_markers(adata,
             `True` when layer is not related to either `velocity` related or `acceleration` or `curvature` related
             layers and `False` otherwise. When layer is not related to either `velocity` related or `acceleration` or
             `curvature` related layers used, the control values will be sorted by absolute values.
+        chunk_size: `int` or None (default: `None`)
+            The number of genes tested together. All groups are tested at once: each gene is ranked only once across all
+            cells, from which the statistics of every (test group, control group) pair are derived.
+        cores: `int` (default: 1)
+            The number of threads the chunks of genes are distributed to.
 
     Returns
     -------
@@ -224,22 +502,27 @@ def find_group_markers(adata,
     de_tables = [None] * len(cluster_set)
     de_genes = {}
 
+    codes = pd.Categorical(adata.obs[group], categories=cluster_set).codes.astype(int)
     if len(cluster_set) > 2:
-        for i, test_group in enumerate(cluster_set):
-            control_groups = sorted(set(cluster_set).difference([test_group]))
+        control_groups = [sorted(set(cluster_set).difference([test_group])) for test_group in cluster_set]
+        pg = np.repeat(np.arange(len(cluster_set)), len(cluster_set) - 1)
+        ph = np.hstack([[list(cluster_set).index(x) for x in controls] for controls in control_groups])
+    else:
+        control_groups = [[cluster_set[1]]]
+        pg, ph = np.array([0]), np.array([1])
 
-            de = two_groups_degs(adata, genes, layer, group, test_group, control_groups, X_data, exp_frac_thresh,
-                                 log2_fc_thresh, qval_thresh, subset_control_vals)
+    sort_abs = not (layer is None or not (layer.startswith('velocity') or layer in ['acceleration', 'curvature']))
+    res = _mwu_groups(X_data, codes, pg, ph, exp_frac_thresh, log2_fc_thresh, subset_control_vals, sort_abs,
+                      chunk_size, cores)
 
-            de_tables[i] = de.copy()
-            de_genes[i] = [k for k, v in Counter(de['gene']).items()
-                           if v >= de_frequency]
-    else:
-        de = two_groups_degs(adata, genes, layer, group, cluster_set[0], cluster_set[1], X_data, exp_frac_thresh,
-                             log2_fc_thresh, qval_thresh, subset_control_vals)
+    for i, controls in enumerate(control_groups):
+        offset = i * (len(cluster_set) - 1)
+        cur_res = res[(res['pair'] >= offset) & (res['pair'] < offset + len(controls))].copy()
+        cur_res['pair'] -= offset
+        de = _mwu_de_table(cur_res, genes, cluster_set[i], controls, qval_thresh)
 
-        de_tables[0] = de.copy()
-        de_genes[0] = [k for k, v in Counter(de['gene']).items()
+        de_tables[i] = de.copy()
+        de_genes[i] = [k for k, v in Counter(de['gene']).items()
                        if v >= de_frequency]
 
     de_table = pd.concat(de_tables).reset_index().drop(columns=['index'])
@@ -261,6 +544,8 @@ def two_groups_degs(adata,
                     log2_fc_thresh=None,
                     qval_thresh=0.05,
                     subset_control_vals=None,
+                    chunk_size=None,
+                    cores=1,
                     ):
     """Find marker genes between two groups of cells based on gene expression or velocity values as specified by the layer.
 
@@ -306,6 +591,11 @@ def two_groups_degs(adata,
             `True` when layer is not related to either `velocity` related or `acceleration` or `curvature` related
             layers and `False` otherwise. When layer is not related to either `velocity` related or `acceleration` or
             `curvature` related layers used, the control values will be sorted by absolute values.
+        chunk_size: `int` or None (default: `None`)
+            The number of genes tested together. Each gene is ranked only once across the test and control cells, from
+            which the statistics of all control groups are derived.
+        cores: `int` (default: 1)
+            The number of threads the chunks of genes are distributed to.
 
 
     Returns
@@ -329,94 +619,17 @@ def two_groups_degs(adata,
             raise ValueError(f"When providing X_data, a list of genes name that corresponds to the columns of X_data "
                              f"must be provided")
 
-    n_cells, n_genes = X_data.shape
-    sparse = issparse(X_data)
-
     if type(control_groups) == str: control_groups = [control_groups]
-    test_cells, control_cells = adata.obs[group] == test_group, \
-                                adata.obs[group].isin(control_groups)
-
-    num_test_cells = test_cells.sum()
-    num_groups = len(control_groups)
-
-    if subset_control_vals:
-        min_n = [min(num_test_cells, sum(adata.obs[group] == x)) for x in control_groups]
-        n1n2 = [num_test_cells * x for x in min_n]
+    codes = np.full(adata.n_obs, -1)
+    for i, x in enumerate(control_groups):
+        codes[(adata.obs[group] == x).values] = i + 1
+    codes[(adata.obs[group] == test_group).values] = 0
 
-    de = []
-    for i_gene, gene in tqdm(enumerate(genes), desc="identifying top markers for each group"):
-        rbc, specificity_, mw_p, log_fc, ncells = 0, 0, 1, 0, 0
+    sort_abs = not (layer is None or not (layer.startswith('velocity') or layer in ['acceleration', 'curvature']))
+    res = _mwu_groups(X_data, codes, np.zeros(len(control_groups), dtype=int), np.arange(1, len(control_groups) + 1),
+                      exp_frac_thresh, log2_fc_thresh, subset_control_vals, sort_abs, chunk_size, cores)
 
-        all_vals = X_data[:, i_gene].A if sparse else X_data[:, i_gene]
-        test_vals = all_vals[test_cells]
-        perc, ef = [len(test_vals.nonzero()[0]) / n_cells], len(test_vals.nonzero()[0]) / num_test_cells
-        if ef < exp_frac_thresh:
-            continue
-
-        log_mean_test_vals = np.log2(test_vals.mean())
-        perc.extend([len(all_vals[adata.obs[group] == x].nonzero()[0]) / n_cells for x in control_groups])
-
-        for i in range(num_groups):
-            control_vals = all_vals[adata.obs[group] == control_groups[i]]
-
-            if subset_control_vals:
-                if layer is None or not (layer.startswith('velocity') or layer in ['acceleration', 'curvature']):
-                    control_vals.sort()
-                else:
-                    control_vals = control_vals[np.argsort(np.absolute(control_vals))]
-
-                control_vals = control_vals[-min_n[i]:]
-                cur_n1n2 = n1n2[i]
-            else:
-                cur_n1n2 = num_test_cells * len(control_vals)
-
-            if log2_fc_thresh is not None:
-                mean_control_vals = control_vals.mean()
-                if mean_control_vals == 0:
-                    log_fc = np.inf
-                else:
-                    log_fc = log_mean_test_vals - np.log2(mean_control_vals)
-
-                if abs(log_fc) < log2_fc_thresh:
-                    continue
-            else:
-                log_fc = test_vals.mean() - control_vals.mean() # for curvature, acceleration, log fc is meaningless
-
-            try:
-                u, mw_p = mannwhitneyu(test_vals, control_vals)
-            except ValueError:
-                pass
-            else:
-                rbc = 1 - ((2 * u) / cur_n1n2)
-
-            perfect_specificity = np.repeat(0.0, num_groups + 1)
-            perfect_specificity[i + 1] = 1.0
-
-            specificity_ = specificity(perc, perfect_specificity)
-
-            tmp0, tmp1 = sum(np.sign(test_vals) > 0), sum(np.sign(control_vals) > 0)
-            tmp0 = tmp0 if np.isscalar(tmp0) else tmp0[0]
-            tmp1 = tmp0 if np.isscalar(tmp1) else tmp1[0]
-
-            diff_ratio_pos = tmp0 / len(test_vals) - tmp1 / len(control_vals)
-
-            de.append((gene, control_groups[i], ef, rbc, log_fc, mw_p, specificity_, diff_ratio_pos))
-
-    de = pd.DataFrame(de,
-                      columns=['gene', 'versus_group', 'exp_frac', 'rbc', 'log2_fc', 'pval', 'specificity', 'diff_ratio_pos'])
-    de = de[de.iloc[:, 2:].sum(1) > 0]
-
-    if de.shape[0] > 1:
-        de['qval'] = multipletests(de['pval'].values, method='fdr_bh')[1]
-    else:
-        de['qval'] = [np.nan for _ in range(de.shape[0])]
-    de['test_group'] = [test_group for _ in range(de.shape[0])]
-    out_order = ['gene', 'test_group', 'versus_group', 'specificity', 'exp_frac', 'diff_ratio_pos',
-                 'rbc', 'log2_fc', 'pval', 'qval']
-    de = de[out_order].sort_values(by='qval')
-    res = de[(de.qval < qval_thresh)].reset_index().drop(columns=['index'])
-
-    return res
+    return _mwu_de_table(res, genes, test_group, control_groups, qval_thresh)
 
 
 def top_n_markers(adata,
@@ -522,6 +735,122 @@ def top_n_markers(adata,
         return top_n_df
 
 
+def _design_basis(X):
+    """Orthonormal basis of the column space of the design matrix `X`.
+
+    The fitted means of a GLM only depend on the column space of its design, so fitting on this basis gives the same
+    models while keeping the normal equations well conditioned, even for rank deficient designs such as an intercept
+    together with an unconstrained spline basis (`cr(x, df=3)`).
+    """
+    U, s, _ = np.linalg.svd(X, full_matrices=False)
+    return U[:, s > s.max() * max(X.shape) * np.finfo(float).eps]
+
+
+def _glm_irls(Y, X, alpha=None, max_iter=100, tol=1e-8):
+    """Fit log link Poisson (`alpha` is None) or NB2 (with the per-gene dispersions `alpha`) GLMs of all columns of `Y`
+    on the shared design matrix `X` via iteratively reweighted least squares.
+
+    The iterations follow the IRLS of `statsmodels`' GLM (same starting values, working weights and deviance based
+    stopping rule) but all genes are updated together: the weighted normal equations X^T W X of every gene come from a
+    single product with the outer products of the design rows and are solved as a stack. A gene stops updating as soon
+    as its deviance converges.
+
+    Returns
+    -------
+        mu: `np.ndarray`
+            The fitted means (cells x genes).
+        failed: `np.ndarray`
+            Boolean mask of the genes whose fit failed (non-finite initial deviance, working responses or weights).
+    """
+    eps = np.finfo(float).eps
+    n, p = X.shape
+    XX = (X[:, :, None] * X[:, None, :]).reshape(n, p * p)
+
+    def deviance(y, mu, a):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            resid = y * np.log(np.clip(y / mu, eps, None))
+            resid -= y - mu if a is None else (y + 1 / a) * np.log((y + 1 / a) / (mu + 1 / a))
+        return 2 * resid.sum(0)
+
+    mu = (Y + Y.mean(0)) / 2
+    eta = np.log(np.clip(mu, eps, None))
+    dev = deviance(Y, mu, alpha)
+    failed = np.isnan(dev)
+    active = np.where(~failed)[0]
+    for _ in range(max_iter):
+        if len(active) == 0: break
+        a = None if alpha is None else alpha[active]
+        mu_a = mu[:, active]
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            var = np.abs(mu_a) if a is None else mu_a + a * mu_a ** 2
+            w = np.clip(mu_a, eps, None) ** 2 / var
+            z = eta[:, active] + (Y[:, active] - mu_a) / np.clip(mu_a, eps, None)
+            bad = ~(np.isfinite(np.sqrt(w)).all(0) & np.isfinite(z).all(0))
+        if bad.any():
+            failed[active[bad]] = True
+            active, w, z = active[~bad], w[:, ~bad], z[:, ~bad]
+            a = None if alpha is None else alpha[active]
+            if len(active) == 0: break
+
+        XtWX, XtWz = (w.T @ XX).reshape(-1, p, p), (w * z).T @ X
+        try:
+            beta = np.linalg.solve(XtWX, XtWz[:, :, None])[:, :, 0]
+        except np.linalg.LinAlgError:
+            beta = (np.linalg.pinv(XtWX) @ XtWz[:, :, None])[:, :, 0]
+        eta[:, active] = X @ beta.T
+        with np.errstate(over='ignore'):
+            mu[:, active] = np.exp(eta[:, active])
+
+        new_dev = deviance(Y[:, active], mu[:, active], a)
+        converged = np.abs(new_dev - dev[active]) <= tol
+        dev[active] = new_dev
+        active = active[~converged]
+
+    return mu, failed
+
+
+def _glm_nb_lrt(Y, X_full, X_reduced, lrdf, max_iter=100, tol=1e-8):
+    """Likelihood ratio tests of the full versus reduced NB2 models for all columns (genes) of `Y`.
+
+    The dispersion of each gene is estimated in closed form from a Poisson fit of the full model with the auxiliary OLS
+    regression (without a constant) of Cameron and Trivedi, i.e. alpha = sum((y - mu)^2 - y) / sum(mu^2). Genes whose
+    estimate is not positive (Poisson-like or underdispersed) are tested with the Poisson likelihood ratio instead.
+
+    Returns
+    -------
+        failed: `np.ndarray`
+            Boolean mask of the genes for which one of the fits failed or whose likelihood ratio is not finite. Their
+            p-values are set to 1.
+        pval: `np.ndarray`
+            The p-values of the likelihood ratio tests.
+    """
+    mu, failed = _glm_irls(Y, X_full, max_iter=max_iter, tol=tol)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alpha = ((Y - mu) ** 2 - Y).sum(0) / (mu ** 2).sum(0)
+
+    nb = alpha > 0
+    lrstat = np.full(Y.shape[1], np.nan)
+    for cols, a in ((np.where(nb)[0], alpha[nb]), (np.where(~nb)[0], None)):
+        if len(cols) == 0: continue
+        Y_ = Y[:, cols]
+        mu_full, failed_full = _glm_irls(Y_, X_full, a, max_iter=max_iter, tol=tol)
+        mu_null, failed_null = _glm_irls(Y_, X_reduced, a, max_iter=max_iter, tol=tol)
+
+        # the terms of the log-likelihoods that only depend on y and alpha cancel out in the likelihood ratio
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if a is None:
+                llf = lambda mu_: (Y_ * np.log(mu_) - mu_).sum(0)
+            else:
+                llf = lambda mu_: (Y_ * np.log(mu_) - (Y_ + 1 / a) * np.log1p(a * mu_)).sum(0)
+            lrstat[cols] = -2 * (llf(mu_null) - llf(mu_full))
+        failed[cols] |= failed_full | failed_null
+    pval = stats.chi2.sf(lrstat, df=lrdf)
+
+    failed |= ~np.isfinite(pval)
+    pval[failed] = 1
+    return failed, pval
+
+
 def glm_degs(adata,
              X_data=None,
              genes=None,
@@ -529,6 +858,8 @@ def glm_degs(adata,
              fullModelFormulaStr="~cr(integral_time, df=3)",
              reducedModelFormulaStr="~1",
              family='NB2',
+             chunk_size=None,
+             cores=1,
              ):
     """Differential genes expression tests using generalized linear regressions.
 
@@ -565,6 +896,11 @@ def glm_degs(adata,
             to obtain the correct parameter $\alpha$ (sm.genmod.families.family.NegativeBinomial(link=None, alpha=1.0), by
             default it is 1), we use the auxiliary OLS regression without a constant from Messrs Cameron and Trivedi. More 
             details can be found here: https://towardsdatascience.com/negative-binomial-regression-f99031bb25b4.
+        chunk_size: `int` or None (default: `None`)
+            The number of genes whose models are fitted together. If `None`, it is chosen based on the number of genes
+            and `cores`.
+        cores: `int` (default: `1`)
+            The number of threads used to fit the chunks of genes in parallel.
 
     Returns
     -------
@@ -608,14 +944,37 @@ def glm_degs(adata,
         raise Exception(f"adata object doesn't include the factors from the model formula "
                         f"{fullModelFormulaStr} you provided.")
 
-    sparse = issparse(X_data)
-    deg_df = pd.DataFrame(index=genes, columns=['status', 'family', 'pval'])
-    for i, gene in tqdm(enumerate(genes), "Detecting time dependent genes via Generalized Additive Models (GAMs)"):
-        expression = X_data[:, i].A if sparse else X_data[:, i]
-        df_factors['expression'] = expression
-        deg_df.iloc[i, :] = diff_test_helper(df_factors, fullModelFormulaStr, reducedModelFormulaStr)
+    # the design matrices are shared by all genes and only need to be built once
+    X_full = _design_basis(np.asarray(dmatrix(fullModelFormulaStr, df_factors)))
+    X_reduced = _design_basis(np.asarray(dmatrix(reducedModelFormulaStr, df_factors)))
+    lrdf = X_full.shape[1] - X_reduced.shape[1]
 
-    deg_df['qval'] = multipletests(deg_df['pval'], method='fdr_bh')[1]
+    n_genes = X_data.shape[1]
+    if chunk_size is None: chunk_size = max(1, min(500, int(np.ceil(n_genes / cores))))
+
+    def compute_chunk(start):
+        Y = X_data[:, start:start + chunk_size]
+        Y = Y.toarray() if issparse(Y) else np.asarray(Y)
+        return _glm_nb_lrt(Y.astype(float), X_full, X_reduced, lrdf)
+
+    starts = range(0, n_genes, chunk_size)
+    if cores == 1:
+        results = map(compute_chunk, starts)
+    else:
+        pool = ThreadPool(cores)
+        results = pool.imap(compute_chunk, starts)
+    results = [r for r in tqdm(results, total=len(starts),
+                               desc="Detecting time dependent genes via Generalized Additive Models (GAMs)")]
+    if cores != 1:
+        pool.close()
+        pool.join()
+    failed = np.hstack([r[0] for r in results])
+    pval = np.hstack([r[1] for r in results])
+
+    deg_df = pd.DataFrame({'status': np.where(failed, 'fail', 'ok'), 'family': 'NB2', 'pval': pval}, index=genes)
+    qval, finite = np.full(n_genes, np.nan), np.isfinite(pval)
+    qval[finite] = multipletests(pval[finite], method='fdr_bh')[1]
+    deg_df['qval'] = qval
 
     adata.uns['glm_degs'] = deg_df
 
@@ -1,3 +1,4 @@
+import warnings
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
@@ -98,48 +99,18 @@ def cell_wise_confidence(adata,
         # this is inspired from the locality preservation paper
         jac, intersect_, _ = jaccard(X, V, n_pca_components, n_neigh, X_neighbors)
 
-        confidence = np.zeros(adata.n_obs)
-        for i in tqdm(range(adata.n_obs), desc='calculating hybrid method (jaccard + consensus) based cell wise confidence'):
-            neigh_ids = np.where(intersect_[i].A)[0] if issparse(intersect_) else np.where(intersect_[i])[0]
-            confidence[i] = jac[i] * np.mean(
-                [consensus(V[i].A.flatten(), V[j].A.flatten()) for j in neigh_ids]
-            )  if issparse(V) else jac[i] * np.mean(
-                [consensus(V[i].flatten(), V[j].flatten()) for j in neigh_ids]
-            )
+        rows, cols = intersect_.nonzero()
+        confidence = np.asarray(jac).flatten() * neighbor_velocity_scores(
+            V, rows, cols, "consensus", desc='calculating hybrid method (jaccard + consensus) based cell wise confidence'
+        )
 
-    elif method == "cosine":
-        indices = adata.uns["neighbors"]["indices"]
-        confidence = np.zeros(adata.n_obs)
-        for i in tqdm(range(adata.n_obs), desc='calculating cosine based cell wise confidence'):
-            neigh_ids = indices[i]
-            confidence[i] = np.mean(
-                [einsum_correlation(V[i].A, V[j].A.flatten(), type="cosine")[0, 0] for j in neigh_ids]
-            ) if issparse(V) else np.mean(
-                [einsum_correlation(V[i][None, :], V[j].flatten(), type="cosine")[0, 0] for j in neigh_ids]
-            )
-
-    elif method == "consensus":
+    elif method in ["cosine", "consensus", "correlation"]:
+        # correlation is equivalent to scVelo
         indices = adata.uns["neighbors"]["indices"]
-        confidence = np.zeros(adata.n_obs)
-        for i in tqdm(range(adata.n_obs), desc='calculating consensus based cell wise confidence'):
-            neigh_ids = indices[i]
-            confidence[i] = np.mean(
-                [consensus(V[i].A.flatten(), V[j].A.flatten()) for j in neigh_ids]
-            ) if issparse(V) else np.mean(
-                [consensus(V[i], V[j].flatten()) for j in neigh_ids]
-            )
-
-    elif method == "correlation":
-        # this is equivalent to scVelo
-        indices = adata.uns["neighbors"]["indices"]
-        confidence = np.zeros(adata.n_obs)
-        for i in tqdm(range(adata.n_obs), desc='calculating correlation based cell wise confidence'):
-            neigh_ids = indices[i]
-            confidence[i] = np.mean(
-                [einsum_correlation(V[i].A, V[j].A.flatten(), type="pearson")[0, 0] for j in neigh_ids]
-            ) if issparse(V) else np.mean(
-                [einsum_correlation(V[i][None, :], V[j].flatten(), type="pearson")[0, 0] for j in neigh_ids]
-            )
+        rows, cols = np.repeat(np.arange(indices.shape[0]), indices.shape[1]), indices.flatten()
+        confidence = neighbor_velocity_scores(
+            V, rows, cols, method, desc=f'calculating {method} based cell wise confidence'
+        )
 
     elif method == "divergence":
         pass
@@ -187,6 +158,77 @@ def jaccard(X, V, n_pca_components, n_neigh, X_neighbors):
     return jaccard, intersect_, union_
 
 
+def neighbor_velocity_scores(V, rows, cols, method="cosine", chunk_size=None, desc=None):
+    """Average the cosine, pearson correlation or consensus scores between the velocity of each cell and that of its
+    neighbors.
+
+    Parameters
+    ----------
+        V: `np.ndarray` or `sp.csr_matrix`
+            The velocity of single cells. Sparse matrices are never densified as a whole (only the chunks of pairs are
+            densified for `correlation`).
+        rows: `np.ndarray`
+            The cell of each (cell, neighbor) pair.
+        cols: `np.ndarray`
+            The neighbor of each (cell, neighbor) pair.
+        method: `str` (optional, default `cosine`)
+            The score of each pair, one of `cosine`, `correlation` (pearson) or `consensus` (the cosine scaled by the
+            ratio between the smaller and the larger norm of the two velocity vectors, see `consensus`).
+        chunk_size: `int` or None (optional, default `None`)
+            The number of pairs scored at a time. By default, each chunk holds about 2^24 velocity values.
+        desc: `str` or None (optional, default `None`)
+            The description of the progress bar.
+
+    Returns
+    -------
+        scores: `np.ndarray`
+            The mean score of the pairs of each cell (NaN for cells without any pair).
+    """
+
+    n, d = V.shape
+    if method == "correlation" and not issparse(V):
+        V = V - V.mean(1)[:, None]
+
+    if issparse(V):
+        V = csr_matrix(V)
+        if method == "correlation":
+            # centered sums of squares: the stored entries deviate by v - mean and the implicit zeros by -mean
+            means = V.sum(1).A1 / d
+            nnz = np.diff(V.indptr)
+            centered = V.data - np.repeat(means, nnz)
+            sq_norm = np.bincount(np.repeat(np.arange(n), nnz), centered ** 2, minlength=n) + (d - nnz) * means ** 2
+        else:
+            sq_norm = V.multiply(V).sum(1).A1
+    else:
+        sq_norm = np.einsum('ij, ij -> i', V, V)
+    V_norm = np.sqrt(sq_norm)
+
+    chunk_size = max(2 ** 24 // d, 1) if chunk_size is None else chunk_size
+    scores = np.zeros(len(rows))
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+
+        for i in tqdm(range(0, len(rows), chunk_size), desc=desc):
+            r, c = rows[i : i + chunk_size], cols[i : i + chunk_size]
+            if issparse(V) and method == "correlation":
+                # only the chunk is densified to center it
+                dot = np.einsum('ij, ij -> i', V[r].toarray() - means[r, None], V[c].toarray() - means[c, None])
+            elif issparse(V):
+                dot = V[r].multiply(V[c]).sum(1).A1
+            else:
+                dot = np.einsum('ij, ij -> i', V[r], V[c])
+
+            x_norm, y_norm = V_norm[r], V_norm[c]
+            cos = np.where(y_norm == 0, 0, dot / (x_norm * y_norm))
+            if method == "consensus":
+                cos *= np.minimum(x_norm, y_norm) / np.maximum(x_norm, y_norm)
+            scores[i : i + chunk_size] = cos
+
+        scores = np.bincount(rows, scores, minlength=n) / np.bincount(rows, minlength=n)
+
+    return scores
+
+
 def consensus(x, y):
     x_norm, y_norm = np.linalg.norm(x), np.linalg.norm(y)
     consensus = einsum_correlation(x[None, :], y, type="cosine")[0, 0] * \
@@ -1,7 +1,9 @@
 import numpy as np
 import warnings
+import itertools
+from multiprocessing.dummy import Pool as ThreadPool
 from anndata import AnnData
-from scipy.sparse import issparse, csr_matrix, lil_matrix, diags
+from scipy.sparse import issparse, csr_matrix, diags, hstack
 from tqdm import tqdm
 from .utils import get_mapper, elem_prod, inverse_norm
 from .connectivity import mnn, normalize_knn_graph, umap_conn_indices_dist_embedding
@@ -19,6 +21,8 @@ def moments(adata,
             layers="all",
             n_pca_components=30,
             n_neighbors=30,
+            cores=1,
+            chunk_size=None,
             ):
     """Calculate kNN based first and second moments (including uncentered covariance) for
      different layers of data.
@@ -53,6 +57,14 @@ def moments(adata,
             The number of pca components to use for constructing nearest neighbor graph and calculating 1/2-st moments.
         n_neighbors: `int` (default: `30`)
             The number of neighbors for constructing nearest neighbor graph used to calculate 1/2-st moments.
+        cores: `int` (default: 1)
+            Number of cores to build the kNN graphs of different groups when `group` is provided. If cores is set to be
+            > 1, a thread pool will be used to build the graphs of different groups in parallel (the neighbor index
+            cache is bypassed in that case).
+        chunk_size: `int` or None (default: `None`)
+            The number of genes that will be processed together when calculating the moments. All the required layers
+            and their pairwise products of a gene chunk are stacked and smoothed with a single sparse-dense product. If
+            None, it will be chosen so that the stacked dense block has at most ~2^24 elements.
 
     Returns
     -------
@@ -89,8 +101,6 @@ def moments(adata,
                     CM = CM[:, valid_ind]
                     adata, fit, _ = pca(adata, CM, n_pca_components=n_pca_components)
 
-                    adata.uns["explained_variance_ratio_"] = fit.explained_variance_ratio_[1:]
-
             X = adata.obsm["X"][:, :n_pca_components]
 
             with warnings.catch_warnings():
@@ -108,23 +118,23 @@ def moments(adata,
                 else:
                     if group not in adata.obs.keys():
                         raise Exception(f'the group {group} provided is not a column name in .obs attribute.')
-                    conn = csr_matrix((adata.n_obs, adata.n_obs))
-                    cells_group = adata.obs[group]
+                    cells_group = adata.obs[group].values
                     uniq_grp = np.unique(cells_group)
-                    for cur_grp in uniq_grp:
-                        cur_cells = cells_group == cur_grp
-                        cur_X = X[cur_cells, :]
-                        cur_kNN, cur_knn_indices, cur_knn_dists, _ = umap_conn_indices_dist_embedding(
-                            cur_X, n_neighbors=np.min((n_neighbors, sum(cur_cells) - 1)), return_mapper=False
-                        )
-
-                        if use_gaussian_kernel and not use_mnn:
-                            cur_conn = gaussian_kernel(cur_X, cur_knn_indices, sigma=10, k=None, dists=cur_knn_dists)
-                        else:
-                            cur_conn = normalize_knn_graph(cur_kNN > 0)
-
-                        cur_cells_ = np.where(cur_cells)[0]
-                        conn[cur_cells_[:, None], cur_cells_] = cur_conn
+                    grp_cells = [np.where(cells_group == cur_grp)[0] for cur_grp in uniq_grp]
+                    conn_args = (X, n_neighbors, use_gaussian_kernel and not use_mnn)
+                    if cores == 1:
+                        res = [group_connectivity(cur_cells_, *conn_args) for cur_cells_ in grp_cells]
+                    else:
+                        pool = ThreadPool(cores)
+                        # the groups never share data, so the threads don't need the neighbor index cache
+                        res = pool.starmap(group_connectivity,
+                                           zip(grp_cells, *map(itertools.repeat, conn_args + (False,))))
+                        pool.close()
+                        pool.join()
+
+                    # assemble the block diagonal connectivity graph once from the COO entries of all groups
+                    rows, cols, vals = (np.concatenate(i) for i in zip(*res))
+                    conn = csr_matrix((vals, (rows, cols)), shape=(adata.n_obs, adata.n_obs))
     else:
         if conn.shape[0] != conn.shape[1] or conn.shape[0] != adata.n_obs:
             raise ValueError(f"The connectivity data `conn` you provided should a square array with dimension equal to "
@@ -140,21 +150,11 @@ def moments(adata,
     layers.sort(
         reverse=True
     )  # ensure we get M_us, M_tn, etc (instead of M_su or M_nt).
+    first_layers, pairs = [layer for layer in layers if mapper[layer] not in adata.layers.keys()], []
     for i, layer in enumerate(layers):
-        layer_x = adata.layers[layer].copy()
         layer_x_group = np.where([layer in x for x in
                                   [only_splicing, only_labeling, splicing_and_labeling]])[0][0]
-        layer_x = inverse_norm(adata, layer_x)
-
-        if mapper[layer] not in adata.layers.keys():
-            adata.layers[mapper[layer]], conn = (
-                calc_1nd_moment(layer_x, conn, normalize_W=normalize)
-                if use_gaussian_kernel
-                else (conn.dot(layer_x), conn)
-            )
         for layer2 in layers[i:]:
-            layer_y = adata.layers[layer2].copy()
-
             layer_y_group = np.where([layer2 in x for x in
                                       [only_splicing, only_labeling, splicing_and_labeling]])[0][0]
             # don't calculate 2 moments among uu, ul, su, sl -
@@ -162,18 +162,20 @@ def moments(adata,
             # those calculations are model specific
             if (layer_x_group != layer_y_group) or layer_x_group == 2:
                 continue
-            layer_y = inverse_norm(adata, layer_y)
+            pairs.append((layer, layer2))
 
-            if mapper[layer2] not in adata.layers.keys():
-                adata.layers[mapper[layer2]], conn = (
-                    calc_1nd_moment(layer_y, conn, normalize_W=normalize)
-                    if use_gaussian_kernel
-                    else (conn.dot(layer_y), conn)
-                )
+    # normalize the connectivity matrix only once instead of in every calc_1nd_moment/calc_2nd_moment call.
+    W = conn
+    if normalize and (len(first_layers) > 0 or len(pairs) > 0):
+        d = np.sum(conn, 1).flatten() if type(conn) == np.ndarray else conn.sum(1).A.flatten()
+        W = diags(1 / d) @ conn if issparse(conn) else np.diag(1 / d) @ conn
+        if use_gaussian_kernel: conn = W
 
-            adata.layers["M_" + layer[2] + layer2[2]] = calc_2nd_moment(
-                layer_x, layer_y, conn, normalize_W=normalize, mX=None, mY=None
-            )
+    first_moments, second_moments = calc_12_moments_chunked(adata, W, first_layers, pairs, chunk_size=chunk_size)
+    for layer in first_layers:
+        adata.layers[mapper[layer]] = first_moments[layer]
+    for layer, layer2 in pairs:
+        adata.layers["M_" + layer[2] + layer2[2]] = second_moments[(layer, layer2)]
 
     if (
             "X_protein" in adata.obsm.keys()
@@ -183,6 +185,23 @@ def moments(adata,
 
     return adata
 
+
+def group_connectivity(cur_cells_, X, n_neighbors, use_gaussian_kernel=False, use_cache=True):
+    """Build the kNN connectivity graph among the cells `cur_cells_` of one group and return its nonzero entries as
+    (rows, cols, vals) arrays indexed in the full cell space."""
+    cur_X = X[cur_cells_, :]
+    cur_kNN, cur_knn_indices, cur_knn_dists, _ = umap_conn_indices_dist_embedding(
+        cur_X, n_neighbors=np.min((n_neighbors, len(cur_cells_) - 1)), return_mapper=False, use_cache=use_cache
+    )
+
+    if use_gaussian_kernel:
+        cur_conn = gaussian_kernel(cur_X, cur_knn_indices, sigma=10, k=None, dists=cur_knn_dists)
+    else:
+        cur_conn = normalize_knn_graph(cur_kNN > 0)
+
+    cur_conn = cur_conn.tocoo()
+    return cur_cells_[cur_conn.row], cur_cells_[cur_conn.col], cur_conn.data
+
 def time_moment(adata,
     tkey,
     has_splicing,
@@ -607,19 +626,27 @@ def _calc_2nd_moment(X, Y, W, normalize_W=True, center=False, mX=None, mY=None):
     return XY
 
 
-def gaussian_kernel(X, nbr_idx, sigma, k=None, dists=None):
-    n = X.shape[0]
+def gaussian_kernel(X, nbr_idx, sigma, k=None, dists=None, chunk_size=10000):
+    """Weight the kNN graph with the Gaussian kernel exp(-d^2 / (2 sigma^2)) of the euclidean distances `dists` (as
+    returned by the nearest neighbor search) between each cell and its neighbors. If `dists` is None, the distances are
+    computed from `X` in chunks of `chunk_size` cells."""
+    nbr_idx = np.asarray(nbr_idx)[:, :k]
+    n, k = nbr_idx.shape
     if dists is None:
-        dists = []
-        for i in range(n):
-            d = X[nbr_idx[i][:k]] - X[i]
-            dists.append(np.sum(elem_prod(d, d), 1).flatten())
-    W = lil_matrix((n, n))
+        dists = np.zeros((n, k))
+        for i in range(0, n, chunk_size):
+            d = X[nbr_idx[i:i + chunk_size]] - X[i:i + chunk_size, None, :]
+            dists[i:i + chunk_size] = np.sqrt(np.einsum('ijk, ijk -> ij', d, d))
+    else:
+        dists = np.asarray(dists)[:, :k]
+
     s2_inv = 1 / (2 * sigma ** 2)
-    for i in range(n):
-        W[i, nbr_idx[i][:k]] = np.exp(-s2_inv * dists[i][:k] ** 2)
+    rows, cols = np.repeat(np.arange(n), k), nbr_idx.ravel()
+    valid = cols >= 0
+    W = csr_matrix((np.exp(-s2_inv * dists.ravel()[valid] ** 2), (rows[valid], cols[valid])), shape=(n, n))
+    W.eliminate_zeros()
 
-    return csr_matrix(W)
+    return W
 
 
 def calc_12_mom_labeling(data, t, calculate_2_mom=True):
@@ -640,6 +667,72 @@ def calc_12_mom_labeling(data, t, calculate_2_mom=True):
     return (m, v, t_uniq) if calculate_2_mom else (m, t_uniq)
 
 
+def calc_12_moments_chunked(adata, W, first_layers, pairs, chunk_size=None, mem_limit=2**24):
+    """Calculate the first moments of a list of layers and the second moments (uncentered covariance) of a list of
+    layer pairs with a row normalized connectivity matrix.
+
+    Genes are processed in chunks. For each chunk, the (inverse normalized) layers and their pairwise products are
+    stacked column-wise into one dense block which is then smoothed with a single sparse-dense product `W @ block`.
+    Moments involving sparse layers are smoothed layer by layer on the same chunk.
+
+    Parameters
+    ----------
+        adata: :class:`~anndata.AnnData`
+            AnnData object.
+        W: `csr_matrix` or `np.ndarray`
+            The (normalized) connectivity matrix.
+        first_layers: `list`
+            The layers whose first moments will be calculated.
+        pairs: `list`
+            The (layer, layer2) tuples whose second moments will be calculated.
+        chunk_size: `int` or None (default: `None`)
+            The number of genes in each chunk. If None, it is chosen so that the stacked dense block has at most
+            `mem_limit` elements (all genes are processed at once when there are no dense layers).
+        mem_limit: `int` (default: `2**24`)
+            The maximal number of elements of the stacked block when `chunk_size` is None.
+
+    Returns
+    -------
+        first_moments, second_moments: `dict`
+            The first moments keyed by layer and second moments keyed by the (layer, layer2) tuples. A moment is a sparse
+            matrix if (one of) its input layer(s) is sparse, consistent with `W @ elem_prod(Y, X)`.
+    """
+    n_obs, n_var = adata.n_obs, adata.n_vars
+    used_layers = list(dict.fromkeys(first_layers + [layer for pair in pairs for layer in pair]))
+    keys = [(layer,) for layer in first_layers] + list(pairs)
+    is_sparse = {key: any(issparse(adata.layers[layer]) for layer in key) for key in keys}
+    sparse_keys, dense_keys = [key for key in keys if is_sparse[key]], [key for key in keys if not is_sparse[key]]
+    res = {key: [] for key in sparse_keys}
+    if chunk_size is None:
+        chunk_size = max(1, int(mem_limit / (n_obs * len(dense_keys)))) if len(dense_keys) > 0 else max(n_var, 1)
+
+    for start in range(0, n_var, chunk_size):
+        end = min(start + chunk_size, n_var)
+        m, data = end - start, {}
+        for layer in used_layers:
+            layer_x = adata.layers[layer][:, start:end]
+            data[layer] = inverse_norm(adata, layer_x.copy() if issparse(layer_x) else np.asarray(layer_x))
+
+        # the smoothed moments of sparse layers are (nearly) dense but stored as sparse matrices, so a stacked block
+        # would only add the cost of slicing them apart again; they are smoothed one by one with sparse-sparse
+        # products instead. Dense layers are stacked into one block and smoothed with a single sparse-dense product.
+        for key in sparse_keys:
+            res[key].append(csr_matrix(W @ (data[key[0]] if len(key) == 1 else elem_prod(data[key[1]], data[key[0]]))))
+        if len(dense_keys) > 0:
+            block = np.hstack([data[key[0]] if len(key) == 1 else np.multiply(data[key[1]], data[key[0]])
+                               for key in dense_keys])
+            block = np.asarray(W @ block)
+            for i, key in enumerate(dense_keys):
+                if key not in res:
+                    res[key] = np.empty((n_obs, n_var), dtype=block.dtype)
+                res[key][:, start:end] = block[:, i * m: (i + 1) * m]
+
+    for key in sparse_keys:
+        res[key] = hstack(res[key]).tocsr() if len(res[key]) > 1 else res[key][0]
+
+    return {key[0]: res[key] for key in keys if len(key) == 1}, {key: res[key] for key in keys if len(key) == 2}
+
+
 def calc_1nd_moment(X, W, normalize_W=True):
 
     if normalize_W:
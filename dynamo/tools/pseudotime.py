@@ -1,5 +1,5 @@
 import numpy as np
-from .DDRTree_py import DDRTree_py as DDRTree
+from .DDRTree_py import DDRTree
 from .utils import log1p_
 
 
@@ -29,6 +29,7 @@ def Pseudotime(adata, layer="X", method="DDRTree", **kwargs):
         "dim": 2,
         "Lambda": 5 * X.shape[1],
         "ncenter": _cal_ncenter(X.shape[1]),
+        "Q_operator": True,  # Q is not used, so never form the N x N matrix
     }
     DDRTree_kwargs.update(kwargs)
 
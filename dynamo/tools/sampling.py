@@ -1,15 +1,84 @@
 import numpy as np 
 from tqdm import tqdm
+from numba import njit, objmode
 from sklearn.neighbors import NearestNeighbors
 from .utils import timeit
 
+@njit
+def trn_steps(W, P, t0, t1, tmax, li, lf, ei, ef, c):
+    """Run the TRN updates t0, ..., t1 (1-based, as in `TRNET.run`) in place on the node positions W. The distance,
+    rank and update of each step are fused, and only the nodes whose update does not underflow to zero (or is above the
+    cutoff `c`) are ranked."""
+    n, d = W.shape
+    Wt = np.ascontiguousarray(W.T)  # a dims x nodes copy, so that the distances of all nodes are accumulated together
+    sD, w, w_node = np.empty(n), np.empty(n), np.empty(n)
+    cand = np.arange(n)
+    for t in range(t0, t1 + 1):
+        # calc the parameters
+        tt = t / tmax
+        l = li * np.power(lf / li, tt)
+        ep = ei * np.power(ef / ei, tt)
+        p = P[t - 1]
+
+        # calc the squared distances ||w - p||^2
+        sD[:] = 0
+        for j in range(d):
+            for i in range(n):
+                sD[i] += (p[j] - Wt[j, i]) ** 2
+
+        # nodes with rank k >= m would move by ep * exp(-k / l) * D == 0 (or are beyond the cutoff)
+        kc = np.inf if c == 0 else -l * np.log(c / ep)
+        m_max = min(746.0 * l, kc)
+        m = n if m_max >= n else max(int(np.ceil(m_max)), 1)
+        if m < n:
+            thr = np.partition(sD, m - 1)[m - 1]
+            cand = np.where(sD <= thr)[0]
+            sD_c = sD[cand]
+        else:
+            sD_c = sD
+
+        # calc the closeness rank k's
+        if len(sD_c) < 256:
+            I = np.argsort(sD_c, kind="mergesort")
+        else:
+            # numpy's vectorized sort is several times faster than the compiled one for many nodes
+            with objmode(I='intp[:]'):
+                I = np.argsort(sD_c, kind="mergesort")
+        if m < n:
+            I = cand[I]
+
+        # move the nodes
+        n_move = 0
+        while n_move < len(I) and n_move < kc and ep * np.exp(-n_move / l) != 0:
+            n_move += 1
+        for k in range(n_move):
+            w[k] = ep * np.exp(-k / l)
+        if n_move > n // 4:
+            # update all nodes at once row by row, with zero weights beyond the moving ones
+            w_node[:] = 0
+            for k in range(n_move):
+                w_node[I[k]] = w[k]
+            for j in range(d):
+                Wt_j, p_j = Wt[j], p[j]
+                for i in range(n):
+                    Wt_j[i] += w_node[i] * (p_j - Wt_j[i])
+        else:
+            for j in range(d):
+                Wt_j, p_j = Wt[j], p[j]
+                for k in range(n_move):
+                    Wt_j[I[k]] += w[k] * (p_j - Wt_j[I[k]])
+
+    W[:] = Wt.T
+    return W
+
+
 class TRNET:
     def __init__(self, n_nodes, X, seed=19491001):
         self.n_nodes = n_nodes
         self.n_dims = X.shape[1]
         self.X = X
-        self.W = self.draw_sample(self.n_nodes)     # initialize the positions of nodes
         self.seed = seed
+        self.W = self.draw_sample(self.n_nodes)     # initialize the positions of nodes
 
     def draw_sample(self, n_samples):
         np.random.seed(self.seed)
@@ -20,12 +89,10 @@ class TRNET:
     def runOnce(self, p, l, ep, c):
         # calc the squared distances ||w - p||^2
         D = p - self.W
-        sD = np.zeros(self.n_nodes)
-        for i in range(self.n_nodes):
-            sD[i] = D[i].dot(D[i])
+        sD = np.einsum('ij, ij -> i', D, D)
         
         # calc the closeness rank k's
-        I = np.argsort(sD)
+        I = np.argsort(sD, kind="mergesort")
         K = np.empty_like(I)
         K[I] = np.arange(len(I))       
         
@@ -38,33 +105,30 @@ class TRNET:
             idx = K < kc
             K = K[:, None]
             self.W[idx, :] += ep * np.exp(-K[idx]/l) * D[idx, :]
-                
+
     def run(self, tmax=200, li=0.2, lf=0.01, ei=0.3, ef=0.05, c=0):
         tmax = int(tmax * self.n_nodes)
         li = li * self.n_nodes
-        P = self.draw_sample(tmax)
-        for t in tqdm(range(1, tmax + 1), desc='Running TRN'):
-            # calc the parameters
-            tt = t / tmax
-            l = li * np.power(lf / li, tt)
-            ep = ei * np.power(ef / ei, tt)
-            # run once
-            self.runOnce(P[t-1], l, ep, c)
+        P = np.asarray(self.draw_sample(tmax), dtype=float)
+        self.W = np.array(self.W, dtype=float)
+        for t in tqdm(range(1, tmax + 1, 10000), desc='Running TRN'):
+            # run the steps in compiled chunks
+            trn_steps(self.W, P, t, min(t + 9999, tmax), tmax, li, lf, ei, ef, c)
     
     def run_n_pause(self, k0, k, tmax=200, li=0.2, lf=0.01, ei=0.3, ef = 0.05, c=0):
         tmax = int(tmax * self.n_nodes)
         li = li * self.n_nodes
-        P = self.draw_sample(tmax)
-        for t in range(k0, k + 1):
-            # calc the parameters
-            tt = t / tmax
-            l = li * np.power(lf / li, tt)
-            ep = ei * np.power(ef / ei, tt)           
-            # run once
-            self.runOnce(P[t-1], l, ep, c)
-            
-            if t % 1000 == 0:
-                print (str(t) + " steps have been run")
+        P = np.asarray(self.draw_sample(tmax), dtype=float)
+        self.W = np.array(self.W, dtype=float)
+        t = k0
+        while t <= k:
+            t1 = min(k, ((t - 1) // 1000 + 1) * 1000)
+            # run the steps up to the next report
+            trn_steps(self.W, P, t, t1, tmax, li, lf, ei, ef, c)
+            t = t1 + 1
+
+            if t1 % 1000 == 0:
+                print (str(t1) + " steps have been run")
 
 
 @timeit
@@ -96,11 +160,13 @@ def sample_by_velocity(V, n, seed=19491001):
 def lhsclassic(n_samples, n_dim, seed=19491001):
     # From PyDOE
     # Generate the intervals
-    np.random.seed(seed)
+    # use a local random state (the same stream as seeding the global one) so that concurrent calls from different
+    # threads are reproducible. `seed` can also be a `np.random.RandomState` instance to draw from.
+    rng = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
     cut = np.linspace(0, 1, n_samples + 1)
 
     # Fill points uniformly in each interval
-    u = np.random.rand(n_samples, n_dim)
+    u = rng.rand(n_samples, n_dim)
     a = cut[:n_samples]
     b = cut[1: n_samples + 1]
     rdpoints = np.zeros(u.shape)
@@ -110,7 +176,7 @@ def lhsclassic(n_samples, n_dim, seed=19491001):
     # Make the random pairings
     H = np.zeros(rdpoints.shape)
     for j in range(n_dim):
-        order = np.random.permutation(range(n_samples))
+        order = rng.permutation(range(n_samples))
         H[:, j] = rdpoints[order, j]
 
     return H
@@ -6,7 +6,6 @@ from scipy import interpolate, stats
 from scipy.spatial.distance import squareform as spsquare
 from scipy.integrate import odeint
 from scipy.linalg.blas import dgemm
-from sklearn.neighbors import NearestNeighbors
 import warnings
 import time
 
@@ -365,6 +364,108 @@ def timeit(method):
     return timed
 
 
+def _map_gene_chunk(func, chunk, seed=None):
+    """Apply `func` to each (index, args) item of a gene chunk. Exceptions are caught per gene so that one failed gene
+    does not abort the others."""
+    res = []
+    for i, args in chunk:
+        kwargs = {} if seed is None else {"random_state": np.random.RandomState((seed + i) % 2 ** 32)}
+        try:
+            res.append((i, func(*args, **kwargs), None))
+        except Exception as e:
+            res.append((i, None, e))
+    return res
+
+
+def map_genes(func, args, backend='serial', cores=1, chunk_size=None, seed=None, desc=None):
+    """Apply a per-gene function to the argument tuples of all genes with a pluggable execution backend.
+
+    Parameters
+    ----------
+        func: `function`
+            The function that will be called as `func(*args[i])` for the i-th gene. It has to be defined at the module
+            level (picklable) for the `process` and `joblib` backends.
+        args: `list`
+            A list of argument tuples, one for each gene.
+        backend: `str` (default: `serial`)
+            The execution backend, one of `serial`, `thread` (multiprocessing.dummy thread pool), `process`
+            (multiprocessing process pool) or `joblib` (joblib with the loky backend).
+        cores: `int` (default: 1)
+            The number of workers used by the `thread`, `process` and `joblib` backends.
+        chunk_size: `int` or None (default: `None`)
+            The number of genes dispatched to a worker at a time. If None, genes are split into ~4 chunks per worker.
+        seed: `int` or None (default: `None`)
+            If not None, `func` of the i-th gene is called with the keyword argument `random_state`, a
+            `np.random.RandomState` seeded with `seed + i`, so that the results do not depend on the backend or on the
+            chunking. numpy's global random state is never reseeded.
+        desc: `str` or None (default: `None`)
+            The description of the progress bar.
+
+    Returns
+    -------
+        res: `list`
+            The returned values of `func` for each gene, `None` for genes whose fitting raised an exception.
+        failed: `dict`
+            A dictionary of gene indices to the raised exceptions.
+    """
+    n = len(args)
+    cores = max(1, int(cores))
+    if chunk_size is None:
+        chunk_size = max(1, int(np.ceil(n / (4 * cores))))
+    chunks = [list(zip(range(i, min(i + chunk_size, n)), args[i:i + chunk_size])) for i in range(0, n, chunk_size)]
+
+    if backend == 'serial' or (cores == 1 and backend != 'joblib'):
+        results = (_map_gene_chunk(func, chunk, seed) for chunk in chunks)
+        pool = None
+    elif backend == 'thread':
+        from multiprocessing.dummy import Pool as ThreadPool
+
+        pool = ThreadPool(cores)
+        results = pool.imap(lambda chunk: _map_gene_chunk(func, chunk, seed), chunks)
+    elif backend == 'process':
+        import multiprocessing
+        from functools import partial
+
+        pool = multiprocessing.Pool(cores)
+        results = pool.imap(partial(_map_gene_chunk, func, seed=seed), chunks)
+    elif backend == 'joblib':
+        try:
+            from joblib import Parallel, delayed
+        except ImportError:
+            raise ImportError("You need to install the package `joblib`."
+                              "install joblib via `pip install joblib`")
+
+        pool = None
+        try:
+            parallel = Parallel(n_jobs=cores, backend='loky', return_as='generator')
+        except TypeError:
+            # joblib < 1.3 can only return the results once all the chunks are done
+            parallel = Parallel(n_jobs=cores, backend='loky')
+        results = parallel(delayed(_map_gene_chunk)(func, chunk, seed) for chunk in chunks)
+    else:
+        raise ValueError(f"backend {backend} is not supported. Available backends include `serial`, `thread`, "
+                         f"`process` and `joblib`.")
+
+    res, failed = [None] * n, {}
+    with tqdm(total=n, desc=desc) as pbar:
+        for chunk_res in results:
+            for i, cur_res, err in chunk_res:
+                res[i] = cur_res
+                if err is not None:
+                    failed[i] = err
+            pbar.update(len(chunk_res))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if len(failed) > 0:
+        warnings.warn(f"fitting failed for {len(failed)} out of {n} genes, the first error is: "
+                      f"{repr(failed[min(failed)])}")
+
+    return res, failed
+
+
 def velocity_on_grid(X, V, n_grids, nbrs=None, k=None, 
     smoothness=1, cutoff_coeff=2, margin_coeff=0.025):
     # codes adapted from velocyto
@@ -383,16 +484,13 @@ def velocity_on_grid(X, V, n_grids, nbrs=None, k=None,
     X_grid = np.vstack([i.flat for i in meshes_tuple]).T
 
     if nbrs is None:
+        from .connectivity import k_nearest_neighbors
+
         k = 100 if k is None else k
-        if X.shape[0] > 200000 and X.shape[1] > 2: 
-            from pynndescent import NNDescent
-            nbrs = NNDescent(X, metric='euclidean', n_neighbors=k+1, n_jobs=-1, random_state=19491001)
-        else:
-            alg = 'ball_tree' if X.shape[1] > 10 else 'kd_tree'
-            nbrs = NearestNeighbors(n_neighbors=k+1, algorithm=alg, n_jobs=-1).fit(X)
+        _, _, nbrs = k_nearest_neighbors(X, k=k+1, cores=-1, return_index=True)
 
     if hasattr(nbrs, 'kneighbors'): 
-        dists, neighs = nbrs.kneighbors(X_grid)
+        dists, neighs = nbrs.kneighbors(X_grid, n_neighbors=None if k is None else k+1)
     elif hasattr(nbrs, 'query'): 
         neighs, dists = nbrs.query(X_grid, k=k+1)
 
@@ -1308,21 +1406,25 @@ def calc_norm_loglikelihood(X, Y, k, f=lambda X, k: np.einsum('ij,i -> ij', X, k
 # ---------------------------------------------------------------------------------------------------
 # velocity related
 
-def find_extreme(s, u, normalize=True, perc_left=None, perc_right=None):
+def find_extreme(s, u, normalize=True, perc_left=None, perc_right=None, axis=None):
+    """Find the extreme data points (cells) whose sum of (normalized) s and u are in the bottom `perc_left` or top
+    `perc_right` percentiles. If `axis` is not None, s and u are matrices and the extreme data points are identified for
+    each row (axis=1) or column (axis=0) separately."""
     s, u = (s.A if sp.issparse(s) else s, u.A if sp.issparse(u) else u)
 
     if normalize:
-        su = s / np.clip(np.max(s), 1e-3, None)
-        su += u / np.clip(np.max(u), 1e-3, None)
+        su = s / np.clip(np.max(s, axis=axis, keepdims=axis is not None), 1e-3, None)
+        su += u / np.clip(np.max(u, axis=axis, keepdims=axis is not None), 1e-3, None)
     else:
         su = s + u
 
     if perc_left is None:
-        mask = su >= np.percentile(su, 100 - perc_right, axis=0)
+        mask = su >= np.percentile(su, 100 - perc_right, axis=0 if axis is None else axis, keepdims=axis is not None)
     elif perc_right is None:
         mask = np.ones_like(su, dtype=bool)
     else:
-        left, right = np.percentile(su, [perc_left, 100 - perc_right], axis=0)
+        left, right = np.percentile(su, [perc_left, 100 - perc_right], axis=0 if axis is None else axis,
+                                    keepdims=axis is not None)
         mask = (su <= left) | (su >= right)
 
     return mask
@@ -1590,11 +1692,57 @@ def get_iterative_indices(indices, index, n_recurse_neighbors=2, max_neighs=None
     return indices
 
 
+def iterative_neighbor_graph(indices, n_recurse_neighbors=2, max_neighs=None, rows=None):
+    """Vectorized `get_iterative_indices` for many cells at once.
+
+    Parameters
+    ----------
+        indices: :class:`~numpy.ndarray`
+            The nearest neighbor indices (n x k) of each cell. NaN entries are ignored.
+        n_recurse_neighbors: `int` (default: `2`)
+            The number of recursions over the nearest neighbors.
+        max_neighs: `int` or None (default: `None`)
+            The maximal number of neighbors of each cell. Cells with more neighbors are randomly subsampled, in the
+            same order (and with the same draws from `np.random`) as `get_iterative_indices`.
+        rows: :class:`~numpy.ndarray` or None (default: `None`)
+            The cells for which the neighbors are collected. If None, all cells are used.
+
+    Returns
+    -------
+        G: :class:`~scipy.sparse.csr_matrix`
+            A (len(rows) x n) matrix whose i-th row stores the sorted indices of the cells (including itself) reachable
+            from the cell `rows[i]` within `n_recurse_neighbors` steps on the nearest neighbor graph.
+    """
+
+    indices = np.asarray(indices)
+    n, k = indices.shape
+    rows = np.arange(n) if rows is None else np.asarray(rows)
+    valid = np.isfinite(indices).flatten() if indices.dtype.kind == 'f' else np.ones(n * k, dtype=bool)
+
+    r = np.hstack((np.arange(n), np.repeat(np.arange(n), k)[valid]))
+    c = np.hstack((np.arange(n), indices.flatten()[valid].astype(int)))
+    B = sp.csr_matrix((np.ones(len(r), dtype=np.float32), (r, c)), shape=(n, n))
+    B.data[:] = 1
+
+    G = B[rows]
+    for _ in range(max(n_recurse_neighbors, 1) - 1):
+        G = G.dot(B)
+        G.data[:] = 1
+    G.sort_indices()
+
+    if max_neighs is not None and np.diff(G.indptr).max(initial=0) > max_neighs:
+        neighs = np.split(G.indices, G.indptr[1:-1])
+        neighs = [np.sort(np.random.choice(i, max_neighs, replace=False)) if len(i) > max_neighs else i
+                  for i in neighs]
+        indptr = np.hstack((0, np.cumsum([len(i) for i in neighs])))
+        G = sp.csr_matrix((np.ones(indptr[-1], dtype=np.float32), np.hstack(neighs), indptr), shape=G.shape)
+
+    return G
+
+
 def append_iterative_neighbor_indices(indices, n_recurse_neighbors=2, max_neighs=None):
-    indices_rec = []
-    for i in range(indices.shape[0]):
-        neig = get_iterative_indices(indices, i, n_recurse_neighbors, max_neighs)
-        indices_rec.append(neig)
+    G = iterative_neighbor_graph(indices, n_recurse_neighbors, max_neighs)
+    indices_rec = np.split(G.indices, G.indptr[1:-1])
     return indices_rec
 
 def split_velocity_graph(G, neg_cells_trick=True):
@@ -1685,72 +1833,56 @@ def linear_least_squares(a, b, residuals=False):
 def integrate_vf(
     init_states, t, args, integration_direction, f, interpolation_num=None, average=True
 ):
-    """integrating along vector field function"""
+    """integrating along vector field function
 
-    n_cell, n_feature, n_steps = (
-        init_states.shape[0],
-        init_states.shape[1],
-        len(t) if interpolation_num is None else interpolation_num,
-    )
+    The trajectories of all cells are written into a preallocated `n_cell x n_time x n_feature` buffer, so that the
+    interpolation onto a common time grid and the averaging across cells are each done in a single batched step.
 
-    if n_cell > 1:
-        if integration_direction == "both":
-            if average:
-                avg = np.zeros((n_steps * 2, n_feature))
-        else:
-            if average:
-                avg = np.zeros((n_steps, n_feature))
+    Without `interpolation_num` the input `t` is returned unchanged, as before. With `interpolation_num` the common
+    time grid is returned, tiled once per cell when the trajectories of several cells are stacked (`average=False`).
+    """
 
-    Y = None
-    if interpolation_num is not None:
-        valid_ids = None
+    n_cell, n_feature = init_states.shape
+    if integration_direction == "forward":
+        t_trans = t
+    elif integration_direction == "backward":
+        t_trans = -t
+    elif integration_direction == "both":
+        t_trans = np.hstack((-t[::-1], t))
+        if interpolation_num is not None:
+            interpolation_num = interpolation_num * 2
+    else:
+        raise Exception(
+            "both, forward, backward are the only valid direction argument strings"
+        )
+
+    Y = np.empty((n_cell, len(t_trans), n_feature))
     for i in tqdm(range(n_cell), desc="integrating vector field"):
         y0 = init_states[i, :]
         if integration_direction == "forward":
-            y = odeint(lambda x, t: f(x), y0, t, args=args)
-            t_trans = t
+            Y[i] = odeint(lambda x, t: f(x), y0, t, args=args)
         elif integration_direction == "backward":
-            y = odeint(lambda x, t: f(x), y0, -t, args=args)
-            t_trans = -t
-        elif integration_direction == "both":
+            Y[i] = odeint(lambda x, t: f(x), y0, -t, args=args)
+        else:
             y_f = odeint(lambda x, t: f(x), y0, t, args=args)
             y_b = odeint(lambda x, t: f(x), y0, -t, args=args)
-            y = np.hstack((y_b[::-1, :], y_f))
-            t_trans = np.hstack((-t[::-1], t))
-
-            if interpolation_num is not None:
-                interpolation_num = interpolation_num * 2
-        else:
-            raise Exception(
-                "both, forward, backward are the only valid direction argument strings"
-            )
-
-        if interpolation_num is not None:
-            vids = np.where((np.diff(y.T) < 1e-3).sum(0) < y.shape[1])[0]
-            valid_ids = vids if valid_ids is None else list(set(valid_ids).union(vids))
-
-        Y = y if Y is None else np.vstack((Y, y))
+            Y[i, : len(t)], Y[i, len(t) :] = y_b[::-1, :], y_f
 
     if interpolation_num is not None:
+        # keep the time points where any cell is still moving along at least one dimension
+        moving = (np.diff(Y, axis=1) < 1e-3).sum(2) < n_feature
+        valid_ids = np.where(moving.any(0))[0]
         valid_t_trans = t_trans[valid_ids]
 
-        _t, _Y = None, None
-        for i in range(n_cell):
-            cur_Y = Y[i : (i + 1) * len(t_trans), :][valid_ids, :]
-            t_linspace = np.linspace(
-                valid_t_trans[0], valid_t_trans[-1], interpolation_num
-            )
-            f = interpolate.interp1d(valid_t_trans, cur_Y.T)
-            _Y = f(t_linspace) if _Y is None else np.hstack((_Y, f(t_linspace)))
-            _t = t_linspace if _t is None else np.hstack((_t, t_linspace))
-
-        t, Y = _t, _Y.T
+        t = np.linspace(valid_t_trans[0], valid_t_trans[-1], interpolation_num)
+        Y = interpolate.interp1d(valid_t_trans, Y[:, valid_ids, :], axis=1)(t)
+        if n_cell > 1 and not average:
+            t = np.tile(t, n_cell)
 
     if n_cell > 1 and average:
-        t_len = int(len(t) / n_cell)
-        for i in range(t_len):
-            avg[i, :] = np.mean(Y[np.arange(n_cell) * t_len + i, :], 0)
-        Y = avg
+        Y = Y.mean(0)
+    else:
+        Y = Y.reshape((-1, n_feature))
 
     return t, Y
 
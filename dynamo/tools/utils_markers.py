@@ -51,3 +51,22 @@ def fdr(p_vals):
     fdr[fdr > 1] = 1
 
     return fdr
+
+
+def one_hot_specificity(percentage):
+    """Calculate the specificity of `percentage` to each of the one-hot perfect distributions at once, i.e. the k-th
+    entry is `specificity(percentage, e_k)` where `e_k` is 1 for the k-th group and 0 otherwise."""
+
+    p = makeprobsvec(np.asarray(percentage, dtype=float))
+    if np.min(p) < 0 or np.sum(p) <= 0:
+        return np.zeros(len(p))
+
+    plogp = np.zeros(len(p))
+    plogp[p > 0] = p[p > 0] / 2 * np.log(p[p > 0] / 2)
+    q = (p + 1) / 2
+    # entropy of (p + e_k) / 2 for every k, without building the k mixtures explicitly
+    H_q = - (plogp.sum() - plogp + q * np.log(q))
+    Jsdiv = H_q - shannon_entropy(p) / 2
+    Jsdiv[Jsdiv < 0] = 0
+
+    return 1 - np.sqrt(Jsdiv)
@@ -77,7 +77,6 @@ def prepare_dim_reduction(adata,
                 valid_ind = np.array(valid_ind).flatten()
                 CM = CM[:, valid_ind]
                 adata, fit, _ = pca(adata, CM, n_pca_components=n_pca_components, pca_key=pca_key)
-                adata.uns["explained_variance_ratio_"] = fit.explained_variance_ratio_[1:]
         else:
             has_basis = True
 
@@ -97,7 +96,6 @@ def prepare_dim_reduction(adata,
             valid_ind = np.array(valid_ind).flatten()
             CM = CM[:, valid_ind]
             adata, fit, _ = pca(adata, CM, n_pca_components=n_pca_components, pca_key=pca_key)
-            adata.uns["explained_variance_ratio_"] = fit.explained_variance_ratio_[1:]
 
             X_data = adata.obsm[pca_key]
 
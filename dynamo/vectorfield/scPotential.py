@@ -11,17 +11,32 @@ from .Ao import Ao_pot_map
 from .Wang import Wang_action, Wang_LAP
 # the LAP method should be rewritten in TensorFlow/PyTorch using optimization with SGD
 
-from .topography import FixedPoints
-from .utils import is_outside_domain
+from .topography import FixedPoints, solve_fixed_points_batch
+from .utils import is_outside_domain, vector_field_function, Jacobian_rkhs_gaussian_block
 from ..tools.sampling import lhsclassic
 from warnings import warn
 
 def search_fixed_points(func, domain, x0, x0_method='lhs', 
     reverse=False, return_x0=False, fval_tol=1e-8, 
-    remove_outliers=True, ignore_fsolve_err=False, **fsolve_kwargs):
-    import numdifftools as nda
+    remove_outliers=True, ignore_fsolve_err=False, jac=None, method='batch', cores=1, chunk_size=None,
+    **fsolve_kwargs):
+    """Search the fixed points of a vector field from many start points.
+
+    With `method='batch'` (default), all start points are solved together with `solve_fixed_points_batch` and the
+    Jacobians at the solutions come from `jac`, a vectorized function that maps n x d points to n x d x d Jacobians
+    (forward differences of `func` are used if it is None). `func` can also be a RKHS vector field dictionary (e.g.
+    `adata.uns['VecFld_pca']['VecFld']`), in which case the vector field function and its analytical Jacobian
+    (`Jacobian_rkhs_gaussian_block`) are built from it. `method='fsolve'` runs `scipy.optimize.fsolve` from each start
+    point in turn, for vector field functions that do not accept a matrix of points.
+    """
+    if type(func) is dict:
+        vf_dict = func
+        func = lambda x: vector_field_function(x, vf_dict)
+        if jac is None and "div_cur_free_kernels" not in vf_dict.keys():
+            jac = lambda x: Jacobian_rkhs_gaussian_block(x, vf_dict)
 
     func_ = (lambda x: -func(x)) if reverse else func
+    jac_ = None if jac is None else ((lambda x: -jac(x)) if reverse else jac)
     k = domain.shape[1]
 
     if np.isscalar(x0):
@@ -43,29 +58,54 @@ def search_fixed_points(func, domain, x0, x0_method='lhs',
 
         x0 = x0 * (domain[1] - domain[0]) + domain[0]
 
-    fp = FixedPoints()
-    succeed = 0
-    for i in range(len(x0)):
-        x, fval_dict, ier, mesg = sp.optimize.fsolve(
-                func_, x0[i], full_output=True, **fsolve_kwargs)
-
-        if ignore_fsolve_err:
-            ier = 1
-        if fval_dict["fvec"].dot(fval_dict["fvec"]) > fval_tol and ier == 1:
-            ier = -1
-            mesg = 'Function evaluated at the output is larger than the tolerance.'
-        elif remove_outliers and is_outside_domain(x, domain) and ier == 1:
-            ier = -2
-            mesg = 'The output is outside the domain.'
-
-        if ier == 1:
-            jacobian_mat = nda.Jacobian(func_)(np.array(x))
-            fp.add_fixed_points([x], [jacobian_mat])
-            succeed += 1
-        else:
-            #jacobian_mat = nda.Jacobian(func_)(np.array(x))
-            #fp.add_fixed_points([x], [jacobian_mat])
-            print('Solution not found: ' + mesg)
+    if method == 'batch':
+        X, J, fval, converged = solve_fixed_points_batch(x0, func_, jac_, cores=cores, chunk_size=chunk_size)
+        ier = np.where(converged | ignore_fsolve_err, 1, 0)
+        ier[((fval ** 2).sum(1) > fval_tol) & (ier == 1)] = -1
+        if remove_outliers:
+            ier[is_outside_domain(X, domain) & (ier == 1)] = -2
+        mesg = {
+            0: 'The iteration is not making good progress.',
+            -1: 'Function evaluated at the output is larger than the tolerance.',
+            -2: 'The output is outside the domain.',
+        }
+        for i, m in mesg.items():
+            if np.any(ier == i):
+                print('Solution not found (%d points): ' % np.sum(ier == i) + m)
+        fp = FixedPoints()
+        fp.add_fixed_points(X[ier == 1], J[ier == 1])
+        succeed = np.sum(ier == 1)
+    elif method == 'fsolve':
+        fp = FixedPoints()
+        succeed = 0
+        for i in range(len(x0)):
+            x, fval_dict, ier, mesg = sp.optimize.fsolve(
+                    func_, x0[i], full_output=True, **fsolve_kwargs)
+
+            if ignore_fsolve_err:
+                ier = 1
+            if fval_dict["fvec"].dot(fval_dict["fvec"]) > fval_tol and ier == 1:
+                ier = -1
+                mesg = 'Function evaluated at the output is larger than the tolerance.'
+            elif remove_outliers and is_outside_domain(x, domain) and ier == 1:
+                ier = -2
+                mesg = 'The output is outside the domain.'
+
+            if ier == 1:
+                if jac_ is None:
+                    import numdifftools as nda
+
+                    jacobian_mat = nda.Jacobian(func_)(np.array(x))
+                else:
+                    jacobian_mat = jac_(np.array(x)[None, :])[0]
+                fp.add_fixed_points([x], [jacobian_mat])
+                succeed += 1
+            else:
+                #jacobian_mat = nda.Jacobian(func_)(np.array(x))
+                #fp.add_fixed_points([x], [jacobian_mat])
+                print('Solution not found: ' + mesg)
+    else:
+        raise ValueError(f"method can only be one of {{'batch', 'fsolve'}}, but got {method}.")
 
     print('%d/%d solutions found.'%(succeed, len(x0)))
         
@@ -4,10 +4,9 @@ from numpy import format_float_scientific as scinot
 import numpy as np
 import scipy.sparse as sp
 from scipy.linalg import lstsq
-from scipy.spatial.distance import pdist
 from sklearn.neighbors import NearestNeighbors
 from multiprocessing.dummy import Pool as ThreadPool
-import itertools, functools
+import itertools
 import warnings
 import time
 from ..tools.sampling import sample_by_velocity
@@ -16,12 +15,13 @@ from ..tools.utils import (
     update_n_merge_dict,
     linear_least_squares,
     timeit,
-    index_condensed_matrix,
 )
+from ..tools.connectivity import k_nearest_neighbors
 from .utils import (
     vector_field_function,
     con_K_div_cur_free,
     con_K,
+    con_K_dot,
     Jacobian_numerical,
     compute_divergence,
     compute_curl,
@@ -204,69 +204,102 @@ def get_P(Y, V, sigma2, gamma, a, div_cur_free_kernels=False):
 
 
 @timeit
-def graphize_vecfld(func, X, nbrs_idx=None, dist=None, k=30, distance_free=True, n_int_steps=20, cores=1):
+def graphize_vecfld(func, X, nbrs_idx=None, dist=None, k=30, distance_free=True, n_int_steps=20, cores=1,
+                    chunk_size=None):
+    """Construct the antisymmetric diffusion graph of a vector field on the kNN graph of the data.
+
+    The weight of the edge from a cell to each of its neighbors is the mean projection of the vector field, evaluated
+    on `n_int_steps` points along the segment between them, onto the unit direction of the segment (multiplied by the
+    segment length if `distance_free` is False). The vector field is evaluated on all the (cell, neighbor, step)
+    points of `chunk_size` edges at once and the graph is assembled in a single pass in COO form.
+
+    Parameters
+    ----------
+        func: `function`
+            The vector field function, which accepts an (n_points x d) array.
+        X: `numpy.ndarray` or sparse matrix
+            The cell states (n x d).
+        nbrs_idx: `numpy.ndarray`, list of lists or None (default: `None`)
+            The neighbor indices of each cell, whose first element is skipped as the cell itself. If None, the `k`
+            nearest neighbors are searched (with the neighbor index cache).
+        dist: `numpy.ndarray` or None (default: `None`)
+            The distances corresponding to `nbrs_idx`. If None, the euclidean distances are used.
+        k: `int` (default: `30`)
+            The number of nearest neighbors if `nbrs_idx` is None.
+        distance_free: `bool` (default: `True`)
+            Whether to leave out the distance between the cell and its neighbor from the edge weights.
+        n_int_steps: `int` (default: `20`)
+            The number of integration steps along each edge.
+        cores: `int` (default: `1`)
+            Number of threads to evaluate the chunks of edges.
+        chunk_size: `int` or None (default: `None`)
+            The number of edges evaluated at once. By default, each chunk holds about 2^22 integration points
+            coordinates.
+
+    Returns
+    -------
+        V: `scipy.sparse.csr_matrix`
+            The antisymmetric (n x n) diffusion graph.
+        nbrs:
+            The nearest neighbor index if the neighbors were searched, otherwise None.
+    """
     n, d = X.shape
 
     nbrs = None
     if nbrs_idx is None:
-        if X.shape[0] > 200000 and X.shape[1] > 2: 
-            from pynndescent import NNDescent
-
-            nbrs = NNDescent(X, metric='euclidean', n_neighbors=k+1, n_jobs=-1, random_state=19491001)
-            nbrs_idx, dist = nbrs.query(X, k=k+1)
-        else:
-            alg = 'ball_tree' if X.shape[1] > 10 else 'kd_tree'
-            nbrs = NearestNeighbors(n_neighbors=k+1, algorithm=alg, n_jobs=-1).fit(X)
-            dist, nbrs_idx = nbrs.kneighbors(X)
+        nbrs_idx, dist, nbrs = k_nearest_neighbors(X, k=k+1, cores=-1, return_index=True)
 
-    if dist is None and not distance_free:
-        D = pdist(X)
+    # flat (cell, neighbor) edges, skipping the first neighbor of each cell (the cell itself)
+    if isinstance(nbrs_idx, np.ndarray) and nbrs_idx.ndim == 2:
+        rows = np.repeat(np.arange(n), nbrs_idx.shape[1] - 1)
+        cols = nbrs_idx[:, 1:].flatten()
+        edge_dist = None if dist is None or distance_free else np.asarray(dist)[:, 1:].flatten()
     else:
-        D = None
+        rows = np.repeat(np.arange(n), [max(len(idx) - 1, 0) for idx in nbrs_idx])
+        cols = np.hstack([np.asarray(idx[1:], dtype=int) for idx in nbrs_idx])
+        edge_dist = None if dist is None or distance_free else np.hstack([np.asarray(i[1:]) for i in dist])
 
-    V = sp.csr_matrix((n, n))
-    if cores == 1:
-        for i, idx in tqdm(enumerate(nbrs_idx), desc='Constructing diffusion graph from reconstructed vector field'):
-            V += construct_v(X, i, idx, n_int_steps, func, distance_free, dist, D, n)
+    if chunk_size is None:
+        chunk_size = max(1, 2 ** 22 // (n_int_steps * d))
+    chunks = [slice(i, i + chunk_size) for i in range(0, len(rows), chunk_size)]
 
+    if cores == 1:
+        res = [construct_v(X, rows[c], cols[c], n_int_steps, func, distance_free,
+                           None if edge_dist is None else edge_dist[c])
+               for c in tqdm(chunks, desc='Constructing diffusion graph from reconstructed vector field')]
     else:
         pool = ThreadPool(cores)
-        res = pool.starmap(construct_v, zip(itertools.repeat(X), np.arange(len(nbrs_idx)), nbrs_idx, itertools.repeat(n_int_steps),
-                                            itertools.repeat(func), itertools.repeat(distance_free),
-                                            itertools.repeat(dist), itertools.repeat(D), itertools.repeat(n)))
+        res = pool.starmap(construct_v, zip(itertools.repeat(X), [rows[c] for c in chunks], [cols[c] for c in chunks],
+                                            itertools.repeat(n_int_steps), itertools.repeat(func),
+                                            itertools.repeat(distance_free),
+                                            [None if edge_dist is None else edge_dist[c] for c in chunks]))
         pool.close()
         pool.join()
-        V = functools.reduce((lambda a, b: a + b), res)
+    w = np.hstack(res) if len(res) > 0 else np.zeros(0)
+
+    V = sp.csr_matrix((np.hstack((w, -w)), (np.hstack((rows, cols)), np.hstack((cols, rows)))), shape=(n, n))
 
     return V, nbrs
 
 
-def construct_v(X, i, idx, n_int_steps, func, distance_free, dist, D, n):
-    """helper function for parallism"""
+def construct_v(X, i, j, n_int_steps, func, distance_free, dist):
+    """helper function for parallism: the weights of the edges from cells `i` to their neighbors `j`."""
 
-    V = sp.csr_matrix((n, n))
     x = X[i].A if sp.issparse(X) else X[i]
-    Y = X[idx[1:]].A if sp.issparse(X) else X[idx[1:]]
-    for j, y in enumerate(Y):
-        pts = np.linspace(x, y, n_int_steps)
-        v = func(pts)
-
-        lxy = np.linalg.norm(y - x)
-        if lxy > 0:
-            u = (y - x) / np.linalg.norm(y - x)
-        else:
-            u = y - x
-        v = np.mean(v.dot(u))
-        if not distance_free:
-            if dist is None:
-                d = D[index_condensed_matrix(n, i, idx[j + 1])]
-            else:
-                d = dist[i][j + 1]
-            v *= d
-        V[i, idx[j + 1]] = v
-        V[idx[j + 1], i] = -v
+    y = X[j].A if sp.issparse(X) else X[j]
+    m, d = x.shape
+
+    u = y - x
+    lxy = np.linalg.norm(u, axis=1)
+    pts = x[:, None, :] + np.linspace(0, 1, n_int_steps)[None, :, None] * u[:, None, :]
+    v = np.reshape(func(pts.reshape(-1, d)), (m, n_int_steps, d))
+
+    u[lxy > 0] /= lxy[lxy > 0, None]
+    v = np.einsum('msd,md->m', v, u) / n_int_steps
+    if not distance_free:
+        v *= lxy if dist is None else dist
 
-    return V
+    return v
 
 
 def SparseVFC(
@@ -288,6 +321,7 @@ def SparseVFC(
     eta=0.5,
     seed=0,
     lstsq_method='drouin',
+    chunk_size=None,
     verbose=1
 ):
     """Apply sparseVFC (vector field consensus) algorithm to learn a functional form of the vector field from random
@@ -338,6 +372,14 @@ def SparseVFC(
             is to be 0 for ensure consistency between different runs.
         lstsq_method: 'str' (default: `drouin`)
            The name of the linear least square solver, can be either 'scipy` or `douin`.
+        chunk_size: `int` or None (default: `None`)
+            If not None, run the memory-bounded exact EM: every iteration still visits all the cells (this is not a
+            stochastic or online mini-batch EM), but in chunks of `chunk_size` cells. The N x M kernel matrix between
+            cells and control points is never stored; the M x M normal equations and the predicted velocities are
+            accumulated chunk by chunk. This gives the same `C`, `P` and `sigma2` as the default solver (up to floating
+            point error) with memory independent of N x M. It is somewhat slower, as the kernel is evaluated twice per
+            iteration, so it is meant for data sets whose kernel matrix does not fit in memory. Not supported with
+            `div_cur_free_kernels`.
         verbose: `int` (default: `1`)
             The level of printing running information.
 
@@ -394,17 +436,21 @@ def SparseVFC(
         h = bandwidth_selector(ctrl_pts)
         beta = 1/h**2
 
+    if chunk_size is not None and div_cur_free_kernels:
+        raise ValueError("chunk_size is not supported with div_cur_free_kernels.")
+
     K = (
         con_K(ctrl_pts, ctrl_pts, beta, timeit=timeit_)
         if div_cur_free_kernels is False
         else con_K_div_cur_free(ctrl_pts, ctrl_pts, sigma, eta, timeit=timeit_)[0]
     )
-    U = (
-        con_K(X, ctrl_pts, beta, timeit=timeit_)
-        if div_cur_free_kernels is False
-        else con_K_div_cur_free(X, ctrl_pts, sigma, eta, timeit=timeit_)[0]
-    )
-    if Grid is not None:
+    if chunk_size is None:
+        U = (
+            con_K(X, ctrl_pts, beta, timeit=timeit_)
+            if div_cur_free_kernels is False
+            else con_K_div_cur_free(X, ctrl_pts, sigma, eta, timeit=timeit_)[0]
+        )
+    if Grid is not None and chunk_size is None:
         grid_U = (
             con_K(Grid, ctrl_pts, beta, timeit=timeit_)
             if div_cur_free_kernels is False
@@ -450,10 +496,17 @@ def SparseVFC(
             P = np.kron(P, np.ones((int(U.shape[0] / P.shape[0]), 1))) # np.kron(P, np.ones((D, 1)))
             lhs = (U.T * np.matlib.tile(P.T, [M, 1])).dot(U) + lambda_ * sigma2 * K
             rhs = (U.T * np.matlib.tile(P.T, [M, 1])).dot(Y)
-        else:
-            UP = U.T * numpy.matlib.repmat(P.T, M, 1)
+        elif chunk_size is None:
+            UP = U.T * P.T
             lhs = UP.dot(U) + lambda_ * sigma2 * K
             rhs = UP.dot(Y)
+        else:
+            lhs, rhs = lambda_ * sigma2 * K, np.zeros((M, D))
+            for j in range(0, N, chunk_size):
+                U_b = np.atleast_2d(con_K(X[j:j + chunk_size], ctrl_pts, beta))
+                UP_b = U_b.T * P[j:j + chunk_size].T
+                lhs += UP_b.dot(U_b)
+                rhs += UP_b.dot(Y[j:j + chunk_size])
 
         if timeit_:
             print('Time elapsed for computing lhs and rhs: %f s'%(time.time()-st))
@@ -461,7 +514,11 @@ def SparseVFC(
         C = lstsq_solver(lhs, rhs, method=lstsq_method, timeit=timeit_)
             
         # Update V and sigma**2
-        V = U.dot(C)
+        if chunk_size is None:
+            V = U.dot(C)
+        else:
+            for j in range(0, N, chunk_size):
+                V[j:j + chunk_size] = np.atleast_2d(con_K(X[j:j + chunk_size], ctrl_pts, beta)).dot(C)
         Sp = sum(P) / 2 if div_cur_free_kernels else sum(P)
         sigma2 = (sum(P.T.dot(np.sum((Y - V) ** 2, 1))) / np.dot(Sp, D))[0]
 
@@ -478,7 +535,7 @@ def SparseVFC(
 
     grid_V = None
     if Grid is not None:
-        grid_V = np.dot(grid_U, C)
+        grid_V = np.dot(grid_U, C) if chunk_size is None else con_K_dot(Grid, ctrl_pts, beta, C, block_size=chunk_size)
 
     VecFld = {
         "X": X_ori,
@@ -558,6 +615,9 @@ class vectorfield:
         seed : int or 1-d array_like, optional (default: `0`)
             Seed for RandomState. Must be convertible to 32 bit unsigned integers. Used in sampling control points. Default
             is to be 0 for ensure consistency between different runs.
+        chunk_size: `int` or None (default: None)
+            If not None, SparseVFC runs its memory-bounded exact EM, streaming the cells in chunks of this size instead
+            of storing the full kernel matrix between cells and control points. See `SparseVFC` for more details.
         """
 
         
@@ -579,6 +639,7 @@ class vectorfield:
                 "sigma": kwargs.pop('sigma', 0.8),
                 "eta": kwargs.pop('eta', 0.5),
                 "seed": kwargs.pop('seed', 0),
+                "chunk_size": kwargs.pop('chunk_size', None),
             })
 
         self.norm_dict = {}
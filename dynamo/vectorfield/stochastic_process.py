@@ -1,7 +1,8 @@
 from tqdm import tqdm
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
+from scipy.sparse import csr_matrix
 from ..tools.utils import log1p_
+from ..tools.connectivity import k_nearest_neighbors
 from .utils import vecfld_from_adata, vector_field_function
 
 
@@ -14,7 +15,10 @@ def diffusionMatrix(adata,
               dims=None,
               n=30,
               VecFld=None,
-              residual='vector_field'):
+              residual='vector_field',
+              store='matrix',
+              dtype=np.float64,
+              chunk_size=None):
     """"Calculate the diffusion matrix from the estimated velocity vector and the reconstructed vector field.
 
     Parameters
@@ -23,8 +27,10 @@ def diffusionMatrix(adata,
             an Annodata object.
         X_data: `np.ndarray` (default: `None`)
             The user supplied expression (embedding) data that will be used for calculating diffusion matrix directly.
+            The nearest neighbors are then searched in `X_data` instead of taken from the neighbor graph of `adata`.
         V_data: `np.ndarray` (default: `None`)
-            The user supplied velocity data that will be used for calculating diffusion matrix directly.
+            The user supplied velocity data that will be used for calculating diffusion matrix directly, together with
+            `X_data`.
         genes: `list` or None (default: `None`)
             The list of genes that will be used to subset the data. If `None`, all genes will be used.
         layer: `str` or None (default: None)
@@ -41,16 +47,34 @@ def diffusionMatrix(adata,
             Method to calculate residual velocity vectors for diffusion matrix calculation. If `average`, all velocity
             of the nearest neighbor cells will be minused by its average velocity; if `vector_field`, all velocity will be
             minused by the predicted velocity from the reconstructed deterministic velocity vector field.
+        store: `str` or None (default: `matrix`)
+            What to store for each cell besides the `diffusion` column. If `matrix`, the diffusion matrices are stored
+            as a n_cells x n_dims x n_dims array; if `trace`, only their traces are stored (as a n_cells array), which
+            avoids computing the n_dims x n_dims blocks; if None, nothing else is stored. Results of previous runs that
+            are not overwritten are removed.
+        dtype: `np.dtype` (default: `np.float64`)
+            The data type of the stored diffusion matrices or traces, for example np.float32 to halve the memory.
+        chunk_size: `int` or None (default: `None`)
+            The number of cells whose local covariances are computed at once. By default, each chunk holds about 2^24
+            values of the gathered neighbor residuals (or their outer products).
 
     Returns
     -------
         adata: :class:`~anndata.AnnData`
-            `AnnData` object that is updated with the `diffusion_matrix` key in the `uns` attribute which is a list of
-            the diffusion matrix for each cell. A column `diffusion` corresponds to the square root of the sum of all
-            elements for each cell's diffusion matrix will also be added.
+            `AnnData` object that is updated with the `diffusion_matrix` (or `diffusion_trace`) key in the `uns`
+            attribute which stores the diffusion matrix (or its trace) of each cell. A column `diffusion` corresponds to
+            the square root of the sum of all elements for each cell's diffusion matrix will also be added. Cells with
+            less than two neighbors get NaN values.
     """
 
-    if X_data is None or V_data is not None:
+    user_data = X_data is not None and V_data is not None
+    if residual == 'vector_field':
+        if VecFld is None:
+            VecFld, func = vecfld_from_adata(adata, basis)
+        else:
+            func = lambda x: vector_field_function(x, VecFld)
+
+    if not user_data:
         if genes is not None:
             genes = adata.var_name.intersection(genes).to_list()
             if len(genes) == 0:
@@ -65,11 +89,6 @@ def diffusionMatrix(adata,
                     raise ValueError(
                         f'the data corresponds to the velocity key {vkey} is not included in the adata object!')
 
-        if VecFld is None:
-            VecFld, func = vecfld_from_adata(adata, basis)
-        else:
-            func = lambda x: vector_field_function(x, VecFld)
-
         prefix = 'X_' if layer is None else layer + '_'
 
         if basis is not None:
@@ -124,26 +143,27 @@ def diffusionMatrix(adata,
         X_data, V_data = X_data[:, dims], V_data[:, dims]
 
     neighbor_key = "neighbors" if layer is None else layer + "_neighbors"
-    if neighbor_key not in adata.uns_keys() or (X_data is not None and V_data is not None):
-        if X_data.shape[0] > 200000 and X_data.shape[1] > 2: 
-            from pynndescent import NNDescent
-
-            nbrs = NNDescent(X_data, metric='euclidean', n_neighbors=n, n_jobs=-1, random_state=19491001)
-            Idx, _ = nbrs.query(X_data, k=n)
-        else:
-            alg = 'ball_tree' if X_data.shape[1] > 10 else 'kd_tree'
-            nbrs = NearestNeighbors(n_neighbors=n, algorithm=alg, n_jobs=-1).fit(X_data)
-            _, Idx = nbrs.kneighbors(X_data)
+    if neighbor_key not in adata.uns_keys() or user_data:
+        Idx, _ = k_nearest_neighbors(X_data, k=n, basis=basis, cores=-1)
     else:
         conn_key = "connectivities" if layer is None else layer + "_connectivities"
         neighbors = adata.obsp[conn_key]
         Idx = neighbors.tolil().rows
 
+    if isinstance(Idx, np.ndarray) and Idx.dtype != object:
+        n_nbrs = np.repeat(Idx.shape[1], Idx.shape[0])
+        indices = Idx.flatten()
+    else:
+        n_nbrs = np.array([len(i) for i in Idx])
+        indices = np.hstack(Idx).astype(int) if n_nbrs.sum() > 0 else np.zeros(0, dtype=int)
+    indptr = np.hstack((0, np.cumsum(n_nbrs)))
+    n_cells, n_dims = V_data.shape
+    V_data = np.asarray(V_data, dtype=np.float64)
+
     if residual == 'average':
-        V_ave = np.zeros_like(V_data)
-        for i in range(X_data.shape[0]):
-            vv = V_data[Idx[i]]
-            V_ave[i] = vv.mean(0)
+        A = csr_matrix((np.ones(len(indices)), indices, indptr), shape=(n_cells, n_cells))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            V_ave = A.dot(V_data) / n_nbrs[:, None]
     elif residual == 'vector_field':
         V_ave = func(X_data)
     else:
@@ -151,17 +171,57 @@ def diffusionMatrix(adata,
                          f'Currently only {"average", "vector_field"} supported.')
 
     V_diff = V_data - V_ave
-    val = np.zeros((V_data.shape[0], 1))
-    dmatrix = [None] * V_data.shape[0]
+    val = np.zeros(n_cells)
+    if store == 'matrix':
+        dmatrix = np.zeros((n_cells, n_dims, n_dims), dtype=dtype)
+    elif store == 'trace':
+        dmatrix = np.zeros(n_cells, dtype=dtype)
+    elif store is not None:
+        raise ValueError(f'store can only be one of "matrix", "trace" or None.')
 
-    for i in tqdm(range(X_data.shape[0]), "calculating diffusion matrix for each cell."):
-        vv = V_diff[Idx[i]]
-        d = np.cov(vv.T)
-        val[i] = np.sqrt(sum(sum(d)))
-        dmatrix[i] = d
+    # chunk the cells by the number of gathered residual values (or their outer products)
+    width = n_dims * n_dims if store == 'matrix' else n_dims
+    chunk_size = max(2 ** 24 // (width * max(n_nbrs.max(initial=1), 1)), 1) if chunk_size is None else chunk_size
+    uniform = np.all(n_nbrs == n_nbrs[0]) if n_cells > 0 else True
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for c0 in tqdm(range(0, n_cells, chunk_size), "calculating diffusion matrix for each cell."):
+            c1 = min(c0 + chunk_size, n_cells)
+            m, sl = n_nbrs[c0:c1], slice(indptr[c0], indptr[c1])
+            owner = np.repeat(np.arange(c1 - c0), m)
+            if uniform:
+                # residuals of the neighbors of each cell centered by their mean: cells x neighbors x dims
+                R = V_diff[indices[sl]].reshape(c1 - c0, m[0], n_dims)
+                R -= R.mean(1)[:, None, :]
+                R_sum = R.sum(2) ** 2
+            else:
+                # ragged neighborhoods: the flat (cell, neighbor) residuals are summed per cell with a sparse indicator
+                S = csr_matrix((np.ones(len(owner)), (owner, np.arange(len(owner)))), shape=(c1 - c0, len(owner)))
+                R = V_diff[indices[sl]]
+                R -= (S.dot(R) / m[:, None])[owner]
+                R_sum = R.sum(1) ** 2
+
+            # the sum of all elements of the (unbiased) covariance matrix is the variance of the summed residual; the
+            # sums of cells with less than two neighbors are 0 and divided by 0 to NaN, as np.cov would give
+            dof = np.maximum(m - 1, 0)
+            val[c0:c1] = np.sqrt((R_sum.sum(1) if uniform else S.dot(R_sum)) / dof)
+            if store == 'matrix':
+                if uniform:
+                    d = np.matmul(R.transpose(0, 2, 1), R)
+                else:
+                    d = S.dot(np.einsum('pi, pj -> pij', R, R).reshape(len(owner), -1)).reshape(-1, n_dims, n_dims)
+                dmatrix[c0:c1] = d / dof[:, None, None]
+            elif store == 'trace':
+                dmatrix[c0:c1] = ((R ** 2).sum((1, 2)) if uniform else S.dot((R ** 2).sum(1))) / dof
 
     adata.obs['diffusion'] = val
-    adata.uns['diffusion_matrix'] = dmatrix
+    for key, kind in (('diffusion_matrix', 'matrix'), ('diffusion_trace', 'trace')):
+        if store != kind:
+            adata.uns.pop(key, None)
+    if store == 'matrix':
+        adata.uns['diffusion_matrix'] = dmatrix
+    elif store == 'trace':
+        adata.uns['diffusion_trace'] = dmatrix
 
 
 def diffusionMatrix2D(V_mat):
@@ -3,34 +3,34 @@ import warnings
 import numpy as np
 import scipy.sparse as sp
 from scipy.optimize import fsolve
-from scipy.spatial.distance import pdist
+from scipy.spatial import cKDTree
 from scipy.linalg import eig
 from scipy.integrate import odeint
 from sklearn.neighbors import NearestNeighbors
+from multiprocessing.dummy import Pool as ThreadPool
 
 from .scVectorField import vectorfield
 from ..tools.utils import (
     update_dict,
     form_triu_matrix,
-    index_condensed_matrix,
     inverse_norm,
     gaussian_1d,
 )
 
-from .utils import vector_field_function, vecfld_from_adata, angle
+from .utils import vector_field_function, vecfld_from_adata, angle, Jacobian_rkhs_gaussian_block
 
 from ..external.hodge import ddhodge
 from .vector_calculus import curl, divergence
 
 def remove_redundant_points(X, tol=1e-4, output_discard=False):
+    """Discard every point that is closer than `tol` to a point before it. Close pairs are found with a KD-tree."""
     X = np.atleast_2d(X)
     discard = np.zeros(len(X), dtype=bool)
     if X.shape[0] > 1:
-        dist = pdist(X)
-        for i in range(len(X)):
-            for j in range(i + 1, len(X)):
-                if dist[index_condensed_matrix(len(X), i, j)] < tol:
-                    discard[j] = True
+        pairs = cKDTree(X).query_pairs(tol, output_type="ndarray")
+        if len(pairs) > 0:
+            pairs = pairs[np.linalg.norm(X[pairs[:, 0]] - X[pairs[:, 1]], axis=1) < tol]
+            discard[np.maximum(pairs[:, 0], pairs[:, 1])] = True
         X = X[~discard]
     if output_discard:
         return X, discard
@@ -72,6 +72,153 @@ def find_fixed_points(X0, func_vf, tol_redundant=1e-4, full_output=False):
         return X
 
 
+def _jacobian_fd_batch(func, X, F, eps=1.49012e-08):
+    """Forward difference Jacobians (n x d x d) of a vectorized function at all rows of `X`."""
+    n, d = X.shape
+    h = eps * np.maximum(np.abs(X), 1)
+    J = np.zeros((n, d, d))
+    for k in range(d):
+        X_h = X.copy()
+        X_h[:, k] += h[:, k]
+        J[:, :, k] = (np.atleast_2d(func(X_h)) - F) / h[:, k, None]
+    return J
+
+
+def _lm_fixed_points(X0, func, jac, max_iter, xtol):
+    """Levenberg-Marquardt iterations for f(x) = 0 advanced for all start points at once."""
+    X = np.array(X0, dtype=float)
+    n, d = X.shape
+    F = np.atleast_2d(func(X))
+    cost = (F ** 2).sum(1)
+    lam = np.full(n, np.nan)
+    converged = cost == 0
+    active = ~converged
+
+    for _ in range(max_iter):
+        idx = np.where(active)[0]
+        if len(idx) == 0:
+            break
+        J = jac(X[idx]) if jac is not None else _jacobian_fd_batch(func, X[idx], F[idx])
+        JtJ = np.matmul(J.transpose((0, 2, 1)), J)
+        g = np.matmul(J.transpose((0, 2, 1)), F[idx, :, None])[:, :, 0]
+        JtJ_diag = np.diagonal(JtJ, axis1=1, axis2=2)
+        new = np.isnan(lam[idx])
+        lam[idx[new]] = 1e-3 * np.maximum(JtJ_diag[new].max(1), 1e-12)
+
+        A = JtJ + lam[idx, None, None] * np.eye(d)
+        delta = -np.linalg.solve(A, g[:, :, None])[:, :, 0]
+        X_new = X[idx] + delta
+        F_new = np.atleast_2d(func(X_new))
+        cost_new = (F_new ** 2).sum(1)
+
+        better = cost_new < cost[idx]
+        acc = idx[better]
+        X[acc], F[acc], cost[acc] = X_new[better], F_new[better], cost_new[better]
+        lam[acc] *= 1 / 3
+        lam[idx[~better]] *= 10
+
+        small_step = np.linalg.norm(delta, axis=1) <= xtol * (xtol + np.linalg.norm(X[idx], axis=1))
+        converged[idx] = (better & small_step) | (cost[idx] == 0)
+        active[idx] = ~converged[idx] & (lam[idx] < 1e16)
+
+    return X, F, converged
+
+
+def solve_fixed_points_batch(X0, func, jac=None, max_iter=100, xtol=1.49012e-08, chunk_size=None, cores=1):
+    """Find the roots of a vector field from many start points at once.
+
+    All start points are advanced together by Levenberg-Marquardt steps (Newton steps close to a root), so each
+    iteration costs one vectorized evaluation of `func` and `jac` on the whole chunk. Chunks of start points can be
+    distributed over a thread pool.
+
+    Arguments
+    ---------
+        X0: :class:`~numpy.ndarray`
+            The n x d start points.
+        func: callable
+            Vectorized vector field function that maps an n x d array to an n x d array.
+        jac: callable or None (default: None)
+            Vectorized Jacobian that maps an n x d array to n x d x d Jacobians, e.g.
+            `lambda x: Jacobian_rkhs_gaussian_block(x, vf_dict)` for RKHS vector fields. If None, forward differences
+            of `func` are used.
+        max_iter: int (default: 100)
+            The maximal number of iterations.
+        xtol: float (default: 1.49012e-08)
+            A point converges when the relative size of its step falls below `xtol` (as in `scipy.optimize.fsolve`).
+        chunk_size: int or None (default: None)
+            The number of start points solved together. If None, the start points are split evenly over `cores`.
+        cores: int (default: 1)
+            The number of threads the chunks are distributed to.
+
+    Returns
+    -------
+        X: :class:`~numpy.ndarray`
+            The n x d solutions.
+        J: :class:`~numpy.ndarray`
+            The n x d x d Jacobians at the solutions.
+        fval: :class:`~numpy.ndarray`
+            The vector field at the solutions.
+        converged: :class:`~numpy.ndarray`
+            A boolean array indicating whether the iterations of each start point converged.
+    """
+    X0 = np.atleast_2d(X0)
+    n, d = X0.shape
+    if n == 0:
+        return np.zeros((0, d)), np.zeros((0, d, d)), np.zeros((0, d)), np.zeros(0, dtype=bool)
+    if chunk_size is None:
+        chunk_size = int(np.ceil(n / cores))
+
+    def solve_chunk(start):
+        X, F, converged = _lm_fixed_points(X0[start:start + chunk_size], func, jac, max_iter, xtol)
+        J = jac(X) if jac is not None else _jacobian_fd_batch(func, X, F)
+        return X, J, F, converged
+
+    starts = range(0, n, chunk_size)
+    if cores == 1:
+        res = list(map(solve_chunk, starts))
+    else:
+        pool = ThreadPool(cores)
+        res = pool.map(solve_chunk, starts)
+        pool.close()
+        pool.join()
+
+    X, J, fval, converged = [np.concatenate(r) for r in zip(*res)]
+    return X, J, fval, converged
+
+
+def find_fixed_points_batch(X0, func_vf, jac=None, tol_redundant=1e-4, full_output=False, **kwargs):
+    """Batched counterpart of `find_fixed_points` that uses `solve_fixed_points_batch` instead of sequential `fsolve`
+    calls. `J` is the Jacobian (analytical if `jac` is given) at each solution."""
+    X, J, fval, _ = solve_fixed_points_batch(X0, func_vf, jac, **kwargs)
+
+    if tol_redundant is not None:
+        X, discard = remove_redundant_points(X, tol_redundant, output_discard=True)
+        J = J[~discard]
+        fval = fval[~discard]
+
+    if full_output:
+        return X, J, fval
+    else:
+        return X
+
+
+def _is_vectorized(func, X_probe=np.array([[0.3, -0.7], [1.1, 0.4]])):
+    """Whether `func` maps an n x d array of points to the n x d array of their values, as required by
+    `find_fixed_points_batch`, instead of only accepting a single point. The function is probed on the rows of
+    `X_probe` at once and one by one."""
+    try:
+        F = np.asarray(func(X_probe))
+    except Exception:
+        return False
+    if F.shape != X_probe.shape:
+        return False
+    try:
+        F_ref = np.array([np.ravel(func(x)) for x in X_probe])
+    except Exception:
+        return True
+    return F_ref.shape == F.shape and np.allclose(F, F_ref, equal_nan=True)
+
+
 def pac_onestep(x0, func, v0, ds=0.01):
     x01 = x0 + v0 * ds
     F = lambda x: np.array([func(x), (x - x0).dot(v0) - ds])
@@ -254,11 +401,10 @@ def dup_osc_idx(x, n_dom=3, tol=0.05):
     y2 = x[(n_dom-1)*l : n_dom*l]
     
     def calc_fft_k(x):
-        ret = []
-        for k in range(x.shape[1]):
-            xFFT, _ = calc_fft(x[:, k])
-            ret.append(xFFT[1:])
-        return np.hstack(ret)
+        # transform all dimensions at once; the spectra are concatenated dimension by dimension as in `calc_fft`.
+        n = len(x)
+        xFFT = np.abs(np.fft.rfft(x, axis=0)) / n * 2
+        return xFFT[1:int(n/2)].T.ravel()
     
     xFFt1 = calc_fft_k(y1)
     xFFt2 = calc_fft_k(y2)
@@ -275,6 +421,7 @@ def dup_osc_idx_iter(x, max_iter=5, **kwargs):
     idx = len(x)
     j = 0
     D = []
+    # each window is cut from the previous accepted one and has a different length, so the steps stay sequential
     while (not stop):
         i, d = dup_osc_idx(x[:idx], **kwargs)
         D.append(d)
@@ -301,15 +448,26 @@ class FixedPoints:
         return np.array(self.J)
 
     def add_fixed_points(self, X, J, tol_redundant=1e-4):
-        for i, x in enumerate(X):
-            redundant = False
-            if tol_redundant is not None and len(self.X) > 0:
-                for y in self.X:
-                    if np.linalg.norm(x - y) <= tol_redundant:
-                        redundant = True
-            if not redundant:
-                self.X.append(x)
-                self.J.append(J[i])
+        if len(X) == 0:
+            return
+        X = np.atleast_2d(X)
+        if tol_redundant is None:
+            keep = np.arange(len(X))
+        else:
+            # a point is redundant if it is within `tol_redundant` of an existing point or of an earlier added one
+            redundant = np.zeros(len(X), dtype=bool)
+            if len(self.X) > 0:
+                dist, _ = cKDTree(self.get_X()).query(X)
+                redundant = dist <= tol_redundant
+            neighbors = cKDTree(X).query_ball_point(X, tol_redundant)
+            keep, kept = [], set()
+            for i in np.where(~redundant)[0]:
+                if kept.isdisjoint(neighbors[i]):
+                    keep.append(i)
+                    kept.add(i)
+        for i in keep:
+            self.X.append(X[i])
+            self.J.append(J[i])
 
     def compute_eigvals(self):
         self.eigvals = []
@@ -337,8 +495,9 @@ class FixedPoints:
 
 
 class VectorField2D:
-    def __init__(self, func, func_vx=None, func_vy=None, X_data=None):
+    def __init__(self, func, func_vx=None, func_vy=None, X_data=None, jac=None):
         self.func = func
+        self.jac = jac
 
         def func_dim(x, func, dim):
             y = func(x)
@@ -403,6 +562,13 @@ class VectorField2D:
         confidence /= np.max(confidence)
         return confidence[:-1]
 
+    def _find_fixed_points(self, X0, tol_redundant):
+        # the batched solver needs a vectorized function; a point-wise one is solved with fsolve point by point
+        if _is_vectorized(self.func):
+            return find_fixed_points_batch(X0, self.func, self.jac, tol_redundant=tol_redundant, full_output=True)
+        else:
+            return find_fixed_points(X0, self.func, tol_redundant=tol_redundant, full_output=True)
+
     def find_fixed_points_by_sampling(
         self, n, x_range, y_range, lhs=True, tol_redundant=1e-4
     ):
@@ -414,17 +580,13 @@ class VectorField2D:
             X0 = np.random.rand(n, 2)
         X0[:, 0] = X0[:, 0] * (x_range[1] - x_range[0]) + x_range[0]
         X0[:, 1] = X0[:, 1] * (y_range[1] - y_range[0]) + y_range[0]
-        X, J, _ = find_fixed_points(
-            X0, self.func, tol_redundant=tol_redundant, full_output=True
-        )
+        X, J, _ = self._find_fixed_points(X0, tol_redundant)
         # remove points that are outside the domain
         outside = is_outside(X, [x_range, y_range])
         self.Xss.add_fixed_points(X[~outside], J[~outside], tol_redundant)
 
     def find_nearest_fixed_point(self, x, x_range, y_range, tol_redundant=1e-4):
-        X, J, _ = find_fixed_points(
-            x, self.func, tol_redundant=tol_redundant, full_output=True
-        )
+        X, J, _ = self._find_fixed_points(np.atleast_2d(x), tol_redundant)
         # remove point if outside the domain
         outside = is_outside(X, [x_range, y_range])[0]
         if not outside:
@@ -489,6 +651,7 @@ def topography(adata, basis="umap", layer=None, X=None, dims=None, n=25, VecFld=
         VecFld, func = vecfld_from_adata(adata, basis)
     else:
         func = lambda x: vector_field_function(x, VecFld)
+    jac = None if "div_cur_free_kernels" in VecFld.keys() else lambda x: Jacobian_rkhs_gaussian_block(x, VecFld)
 
     if dims is None:
         dims = [0, 1]
@@ -498,7 +661,7 @@ def topography(adata, basis="umap", layer=None, X=None, dims=None, n=25, VecFld=
     xlim = [min_[0] - (max_[0] - min_[0]) * 0.1, max_[0] + (max_[0] - min_[0]) * 0.1]
     ylim = [min_[1] - (max_[1] - min_[1]) * 0.1, max_[1] + (max_[1] - min_[1]) * 0.1]
 
-    vecfld = VectorField2D(func, X_data=X_basis)
+    vecfld = VectorField2D(func, X_data=X_basis, jac=jac)
     vecfld.find_fixed_points_by_sampling(n, xlim, ylim)
     if vecfld.get_num_fixed_points() > 0:
         vecfld.compute_nullclines(xlim, ylim, find_new_fixed_points=True)
@@ -671,6 +834,7 @@ def VectorField(
         "sigma": 0.8,
         "eta": 0.5,
         "seed": 0,
+        "chunk_size": None,
     }
     vf_kwargs = update_dict(vf_kwargs, kwargs)
 
@@ -44,6 +44,12 @@ def vector_field_function(x, vf_dict, dim=None, kernel='full', X_ctrl_ind=None,
     if x.ndim == 1:
         x = x[None, :]
 
+    if X_ctrl_ind is not None:
+        C = np.zeros_like(vf_dict["C"])
+        C[X_ctrl_ind, :] = vf_dict["C"][X_ctrl_ind, :]
+    else:
+        C = vf_dict["C"]
+
     if has_div_cur_free_kernels:
         if kernel == 'full':
             kernel_ind = 0
@@ -55,29 +61,32 @@ def vector_field_function(x, vf_dict, dim=None, kernel='full', X_ctrl_ind=None,
             raise ValueError(f"the kernel can only be one of {'full', 'df_kernel', 'cf_kernel'}!")
 
         K = con_K_div_cur_free(x, vf_dict["X_ctrl"], vf_dict["sigma"], vf_dict["eta"], **kernel_kwargs)[kernel_ind]
+        K = K.dot(C)
     else:
-        Xc = vf_dict["X_ctrl"]
-        K = con_K(x, Xc, vf_dict["beta"], **kernel_kwargs)
-
-    if X_ctrl_ind is not None:
-        C = np.zeros_like(vf_dict["C"])
-        C[X_ctrl_ind, :] = vf_dict["C"][X_ctrl_ind, :]
-    else:
-        C = vf_dict["C"]
-
-    K = K.dot(C)
-
-    if dim is not None and not has_div_cur_free_kernels:
         if np.isscalar(dim):
-            K = K[:, :dim]
+            C = C[:, :dim]
         elif dim is not None:
-            K = K[:, dim]
+            C = C[:, dim]
+
+        if kernel_kwargs.pop('return_d', False):
+            raise ValueError("`return_d` is not supported by vector_field_function, use `con_K` to get the differences "
+                             "between the coordinates and the control points.")
+        method = kernel_kwargs.pop('method', 'sqdist')
+        if method == 'sqdist':
+            # the kernel times coefficients is evaluated block by block, so the n x m kernel is never fully allocated
+            K = con_K_dot(x, vf_dict["X_ctrl"], vf_dict["beta"], C, **kernel_kwargs)
+        elif method == 'cdist':
+            K = np.atleast_2d(con_K(x, vf_dict["X_ctrl"], vf_dict["beta"], method=method, **kernel_kwargs)).dot(C)
+        else:
+            raise ValueError(f"the method can only be one of {'sqdist', 'cdist'}!")
+        if len(K) == 1:
+            K = K.flatten()
 
     return K
 
 
 @timeit
-def con_K(x, y, beta, method='cdist', return_d=False):
+def con_K(x, y, beta, method='cdist', return_d=False, dtype=None):
     """con_K constructs the kernel K, where K(i, j) = k(x, y) = exp(-beta * ||x - y||^2).
 
     Arguments
@@ -88,29 +97,38 @@ def con_K(x, y, beta, method='cdist', return_d=False):
             Control points used to build kernel basis functions.
         beta: float (default: 0.1)
             Paramerter of Gaussian Kernel, k(x, y) = exp(-beta*||x-y||^2),
+        method: str (default: 'cdist')
+            The method used to compute the squared distances, either `'cdist'` (scipy's cdist) or `'sqdist'` (the
+            ||x||^2 + ||y||^2 - 2xy^T identity evaluated with matrix products, see `sqdist`).
         return_d: bool
             If True the intermediate 3D matrix x - y will be returned for analytical Jacobian.
+        dtype: numpy dtype or None (default: None)
+            If not None (e.g. `np.float32`), the kernel is evaluated in this precision.
 
     Returns
     -------
     K: :class:`~numpy.ndarray`
     the kernel to represent the vector field function.
     """
-    if method == 'cdist' and not return_d:
+    if dtype is not None:
+        x, y = x.astype(dtype, copy=False), y.astype(dtype, copy=False)
+    elif not np.issubdtype(np.result_type(x, y), np.floating):
+        x, y = x.astype(float), y.astype(float)
+
+    if return_d:
+        D = x[:, :, None] - y.T[None, :, :]
+        K = np.squeeze(np.einsum('ijk, ijk -> ik', D, D))
+    elif method == 'cdist':
         K = cdist(x, y, 'sqeuclidean')
+        if dtype is not None: K = K.astype(dtype, copy=False)
         if len(K) == 1:
             K = K.flatten()
     else:
-        n = x.shape[0]
-        m = y.shape[0]
-
-        # https://stackoverflow.com/questions/1721802/what-is-the-equivalent-of-matlabs-repmat-in-numpy
-        # https://stackoverflow.com/questions/12787475/matlabs-permute-in-python
-        D = np.matlib.tile(x[:, :, None], [1, 1, m]) - np.transpose(
-            np.matlib.tile(y[:, :, None], [1, 1, n]), [2, 1, 0])
-        K = np.squeeze(np.sum(D ** 2, 1))
-    K = -beta * K
-    K = np.exp(K)
+        K = sqdist(x, y)
+        if len(K) == 1:
+            K = K.flatten()
+    K *= -beta
+    np.exp(K, out=K)
 
     if return_d:
         return K, D
@@ -118,6 +136,80 @@ def con_K(x, y, beta, method='cdist', return_d=False):
         return K
 
 
+def sqdist(x, y, yy=None, block_size=None, center=True):
+    """Pairwise squared Euclidean distances computed via ||x||^2 + ||y||^2 - 2xy^T in blocks of rows of x, so that
+    no n x d x m difference tensor is built.
+
+    The identity cancels catastrophically for points far from the origin, so both sets of points are first shifted by
+    the mean of y (the distances are translation invariant). `yy` are the (optionally precomputed) squared norms of
+    the rows of y and are only used with `center=False`, i.e. when the caller has already centered x and y."""
+    if center:
+        c = y.mean(0)
+        x, y, yy = x - c, y - c, None
+    if yy is None: yy = np.einsum('ij, ij -> i', y, y)
+    n = x.shape[0]
+    if block_size is None: block_size = n
+
+    D = np.empty((n, y.shape[0]), dtype=np.result_type(x, y, np.float32))
+    for i in range(0, n, block_size):
+        xi = x[i:i + block_size]
+        Di = D[i:i + block_size]
+        np.matmul(xi, y.T, out=Di)
+        Di *= -2
+        Di += np.einsum('ij, ij -> i', xi, xi)[:, None]
+        Di += yy[None, :]
+        np.maximum(Di, 0, out=Di)
+    return D
+
+
+def _kernel_block_size(m, mem_limit=2**24):
+    """Number of rows per block so that a block of the n x m kernel stays under `mem_limit` elements."""
+    return int(max(1, mem_limit // max(m, 1)))
+
+
+@timeit
+def con_K_dot(x, y, beta, C, block_size=None, dtype=None):
+    """Compute `con_K(x, y, beta).dot(C)` block by block without allocating the full n x m kernel.
+
+    Arguments
+    ---------
+        x: :class:`~numpy.ndarray`
+            Coordinates where the kernel is evaluated.
+        y: :class:`~numpy.ndarray`
+            Control points used to build kernel basis functions.
+        beta: float
+            Paramerter of Gaussian Kernel, k(x, y) = exp(-beta*||x-y||^2),
+        C: :class:`~numpy.ndarray`
+            The m x d coefficients of the kernel basis functions.
+        block_size: int or None (default: None)
+            The number of rows of x processed at a time. If None, it is chosen so that each kernel block has at most
+            2^24 elements.
+        dtype: numpy dtype or None (default: None)
+            If not None (e.g. `np.float32`), the kernel is evaluated in this precision.
+
+    Returns
+    -------
+    KC: :class:`~numpy.ndarray`
+        The n x d matrix K @ C.
+    """
+    if dtype is not None:
+        x, y, C = x.astype(dtype, copy=False), y.astype(dtype, copy=False), C.astype(dtype, copy=False)
+    n, m = x.shape[0], y.shape[0]
+    if block_size is None: block_size = _kernel_block_size(m)
+
+    # center once on the control points (see `sqdist`) instead of in every block
+    c = y.mean(0)
+    x, y = x - c, y - c
+    yy = np.einsum('ij, ij -> i', y, y)
+    KC = np.empty((n, C.shape[1]), dtype=np.result_type(x, y, C, np.float32))
+    for i in range(0, n, block_size):
+        K = sqdist(x[i:i + block_size], y, yy, center=False)
+        K *= -beta
+        np.exp(K, out=K)
+        np.matmul(K, C, out=KC[i:i + block_size])
+    return KC
+
+
 @timeit
 def con_K_div_cur_free(x, y, sigma=0.8, eta=0.5):
     """Construct a convex combination of the divergence-free kernel T_df and curl-free kernel T_cf with a bandwidth sigma
@@ -271,13 +363,132 @@ def Jacobian_rkhs_gaussian(x, vf_dict, vectorize=False):
             K, D = con_K(xi[None, :], vf_dict['X_ctrl'], vf_dict['beta'], return_d=True)
             J[:, :, i] = (vf_dict['C'].T * K) @ D[0].T
     else:
-        K, D = con_K(x, vf_dict['X_ctrl'], vf_dict['beta'], return_d=True)
-        if K.ndim == 1: K = K[None, :]
-        J = np.einsum('nm, mi, njm -> ijn', K, vf_dict['C'], D)
+        return np.transpose(Jacobian_rkhs_gaussian_block(x, vf_dict), axes=(1, 2, 0))
 
     return -2 * vf_dict['beta'] * J
 
 
+def Jacobian_rkhs_gaussian_block(x, vf_dict, CY=None):
+    """Analytical Jacobian for a block of coordinates without building the n x d x m difference tensor.
+
+    With `D = x - y`, the Jacobian at `x_n` is `-2 beta sum_m K[n, m] C[m] (x_n - y_m)^T`, which is computed as
+    `(K @ C)[n] x_n^T - (K @ CY)[n]` where `CY[m] = C[m] y_m^T` is shared by all cells (see `rkhs_gaussian_CY`).
+    Both x and y are taken relative to the mean of the control points to avoid cancellation far from the origin.
+
+        Returns
+        -------
+        J: :class:`~numpy.ndarray`
+            Jacobian matrices stored as n-by-d-by-d numpy arrays evaluated at x.
+    """
+    x = np.atleast_2d(x)
+    n, d = x.shape
+    if CY is None: CY = rkhs_gaussian_CY(vf_dict)
+    K = con_K(x, vf_dict['X_ctrl'], vf_dict['beta'], method='sqdist')
+    if K.ndim == 1: K = K[None, :]
+    x = x - vf_dict['X_ctrl'].mean(0)
+    J = (K @ vf_dict['C'])[:, :, None] * x[:, None, :] - (K @ CY).reshape((n, d, d))
+    return -2 * vf_dict['beta'] * J
+
+
+def rkhs_gaussian_CY(vf_dict):
+    """The m x d^2 matrix of outer products `C[m] y_m^T` between RKHS coefficients and control points, with the
+    control points y taken relative to their mean."""
+    C, Y = vf_dict['C'], vf_dict['X_ctrl'] - vf_dict['X_ctrl'].mean(0)
+    return (C[:, :, None] * Y[:, None, :]).reshape((C.shape[0], -1))
+
+
+def _jacobian_chunk_size(n_ctrl, d, d1=0, d2=0, mem_limit=2**27):
+    """Number of cells per chunk so that the largest per-chunk array stays under `mem_limit` elements."""
+    return int(max(1, mem_limit // max(n_ctrl, d * d, d1 * d2, 1)))
+
+
+@timeit
+def Jacobian_rkhs_gaussian_chunked(x,
+                                   vf_dict,
+                                   Qi=None,
+                                   Qj=None,
+                                   chunk_size=None,
+                                   cores=1,
+                                   jacobian_gene=None,
+                                   return_det=True):
+    """Bounded-memory analytical Jacobian engine for RKHS vector fields with Gaussian kernel.
+
+    Cells are streamed in chunks (optionally across a pool of `cores` workers). For each chunk the low dimensional
+    Jacobians, their determinants and, if `Qi` and `Qj` are given, the Jacobians transformed back to the gene space
+    (:math:`Q_i J Q_j^T`, see `subset_jacobian_transformation`) are computed in the same pass, so that neither the
+    n x d x m difference tensor nor a second sweep over the Jacobians is needed.
+
+    Parameters
+    ----------
+        x: :class:`~numpy.ndarray`
+            Coordinates (n x d) where the Jacobian is evaluated.
+        vf_dict: dict
+            A dictionary containing RKHS vector field control points, Gaussian bandwidth, and RKHS coefficients.
+            Essential keys: 'X_ctrl', 'beta', 'C'
+        Qi: :class:`~numpy.ndarray` or None (default: None)
+            PCA loading matrix (d1 x d) of the effector genes.
+        Qj: :class:`~numpy.ndarray` or None (default: None)
+            PCA loading matrix (d2 x d) of the regulator genes.
+        chunk_size: int or None (default: None)
+            The number of cells processed in each chunk. If `None`, it is chosen to bound the per-chunk memory.
+        cores: int (default: 1)
+            Number of workers. Each chunk is dominated by BLAS matrix products which release the GIL, so chunks are
+            distributed over a thread pool.
+        jacobian_gene: array-like or None (default: None)
+            A preallocated d1 x d2 x n array (e.g. a `numpy.memmap` or a zarr array) the gene space Jacobians are written
+            to. If `None`, a float32 numpy array is allocated.
+        return_det: bool (default: True)
+            Whether to compute the determinant of the Jacobian of each cell.
+
+    Returns
+    -------
+        Js: :class:`~numpy.ndarray`
+            Jacobian matrices stored as d-by-d-by-n numpy arrays evaluated at x.
+        det: :class:`~numpy.ndarray` or None
+            The determinant of each Jacobian.
+        jacobian_gene: array-like or None
+            The d1 x d2 x n gene space Jacobians.
+    """
+    x = np.atleast_2d(x)
+    n, d = x.shape
+    if Qi is not None: Qi, Qj = np.atleast_2d(Qi), np.atleast_2d(Qj)
+    d1, d2 = (0, 0) if Qi is None else (Qi.shape[0], Qj.shape[0])
+    if chunk_size is None: chunk_size = _jacobian_chunk_size(vf_dict['X_ctrl'].shape[0], d, d1, d2)
+
+    CY = rkhs_gaussian_CY(vf_dict)
+    Js = np.zeros((d, d, n))
+    det = np.zeros(n) if return_det else None
+    if Qi is not None and jacobian_gene is None:
+        jacobian_gene = np.zeros((d1, d2, n), dtype=np.float32)
+
+    def compute_chunk(start):
+        J = Jacobian_rkhs_gaussian_block(x[start:start + chunk_size], vf_dict, CY=CY)
+        J_det = np.linalg.det(J) if return_det else None
+        J_gene = None if Qi is None else np.transpose(Qi @ J @ Qj.T, axes=(1, 2, 0))
+        return start, J, J_det, J_gene
+
+    starts = range(0, n, chunk_size)
+    if cores == 1:
+        results = map(compute_chunk, starts)
+        pool = None
+    else:
+        if cores is None: cores = mp.cpu_count()
+        pool = ThreadPool(cores)
+        results = pool.imap(compute_chunk, starts)
+
+    for start, J, J_det, J_gene in tqdm(results, total=len(starts), desc="Calculating Jacobian in chunks"):
+        end = start + J.shape[0]
+        Js[:, :, start:end] = np.transpose(J, axes=(1, 2, 0))
+        if return_det: det[start:end] = J_det
+        if J_gene is not None: jacobian_gene[:, :, start:end] = J_gene
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return Js, det, jacobian_gene
+
+
 def Jacobian_rkhs_gaussian_parallel(x, vf_dict, cores=None):
     n = len(x)
     if cores is None: cores = mp.cpu_count()
@@ -294,6 +505,39 @@ def Jacobian_rkhs_gaussian_parallel(x, vf_dict, cores=None):
     return ret
 
 
+def open_jacobian_gene_file(path, shape, dtype=np.float32):
+    """Create an on-disk array for gene space Jacobians: a zarr array if `path` ends with `.zarr` and a `.npy`
+    memory-mapped numpy array otherwise."""
+    if path.endswith('.zarr'):
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError("You need to install the package `zarr` to store the Jacobian in a zarr array. "
+                              "Please install via pip install zarr. See more details at https://pypi.org/project/zarr/")
+        return zarr.open(path, mode='w', shape=shape, dtype=dtype,
+                         chunks=(shape[0], shape[1], min(shape[2], _jacobian_chunk_size(1, 1, shape[0], shape[1], 2**24))))
+    else:
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+
+def load_jacobian_gene(J_dict, key='jacobian_gene'):
+    """Get the gene space tensor `key` (e.g. `'jacobian_gene'`) of a `jacobian` (or `sensitivity`) result dictionary.
+
+    When the tensor was written to disk (see `jacobian_gene_file` of `jacobian`), only its path is stored under
+    `key + '_file'` so that the AnnData object stays serializable, and the file is opened (read-only and lazily) here.
+    Returns `None` if neither is available.
+    """
+    if J_dict.get(key) is not None:
+        return J_dict[key]
+    path = J_dict.get(key + '_file')
+    if path is None:
+        return None
+    if path.endswith('.zarr'):
+        import zarr
+        return zarr.open(path, mode='r')
+    return np.load(path, mmap_mode='r')
+
+
 def Jacobian_numerical(f, input_vector_convention='row'):
     '''
         Get the numerical Jacobian of the vector field function.
@@ -17,6 +17,9 @@ from .utils import (
     vector_transformation,
     elementwise_jacobian_transformation,
     subset_jacobian_transformation,
+    Jacobian_rkhs_gaussian_chunked,
+    open_jacobian_gene_file,
+    load_jacobian_gene,
     get_metric_gene_in_rank,
     get_metric_gene_in_rank_by_group,
     get_sorted_metric_genes_df,
@@ -149,6 +152,9 @@ def jacobian(adata,
              vector_field_class=None,
              method='analytical',
              store_in_adata=True,
+             cores=1,
+             chunk_size=None,
+             jacobian_gene_file=None,
              **kwargs
              ):
     """Calculate Jacobian for each cell with the reconstructed vector field.
@@ -186,14 +192,31 @@ def jacobian(adata,
         vector_field_class: :class:`~scVectorField.vectorfield`
             If not `None`, the jacobian will be computed using this class instead of the vector field stored in adata.
         method: str (default: 'analytical')
-            The method that will be used for calculating Jacobian, either `'analytical'` or `'numerical'`. `'analytical'`
-            method uses the analytical expressions for calculating Jacobian while `'numerical'` method uses numdifftools,
-            a numerical differentiation tool, for computing Jacobian. `'analytical'` method is much more efficient.
+            The method that will be used for calculating Jacobian, either `'analytical'`, `'parallel'` or `'numerical'`.
+            `'analytical'` method uses the analytical expressions for calculating Jacobian while `'numerical'` method
+            uses numdifftools, a numerical differentiation tool, for computing Jacobian. `'analytical'` method is much
+            more efficient. For RKHS vector fields it computes the Jacobians, their determinants and the gene space
+            Jacobians in memory-bounded chunks of cells. `'parallel'` computes the analytical Jacobians with
+            `Jacobian_rkhs_gaussian_parallel`, i.e. blocks of cells distributed over a thread pool of `cores` workers.
+        store_in_adata: bool (default: True)
+            Whether to store the results in the `.uns` of adata.
         cores: int (default: 1)
-            Number of cores to calculate Jacobian. If cores is set to be > 1, multiprocessing will be used to
-            parallel the Jacobian calculation.
+            Number of threads used to calculate Jacobian. Note that a thread pool (`multiprocessing.dummy`), not a
+            process pool, distributes the chunks of cells: each chunk is dominated by BLAS matrix products that release
+            the GIL and threads avoid copying the vector field into every worker. It is also passed to
+            `subset_jacobian_transformation`.
+        chunk_size: int or None (default: None)
+            The number of cells whose (analytical) Jacobians, determinants and gene space projections are computed in
+            each chunk. If `None`, the chunk size is chosen to bound the memory used by each chunk.
+        jacobian_gene_file: str or None (default: None)
+            If not `None`, the gene space Jacobian tensor is written to this file instead of being held in memory (chunk
+            by chunk with the `'analytical'` method): a zarr array if the path ends with `.zarr` and a `.npy` file
+            otherwise. Only the path is stored (under `'jacobian_gene_file'`) so that adata can still be written to
+            disk; use `dynamo.vectorfield.utils.load_jacobian_gene` to open the tensor lazily.
         kwargs:
-            Any additional keys that will be passed to elementwise_jacobian_transformation function.
+            Any additional keys that will be passed to elementwise_jacobian_transformation or
+            subset_jacobian_transformation function. The chunked analytical engine does not take them, so the Jacobians
+            are computed by the vector field class and transformed afterwards when they are given.
 
     Returns
     -------
@@ -217,14 +240,12 @@ def jacobian(adata,
         else:
             cell_idx = sample(np.arange(adata.n_obs), sample_ncells, sampling, X, V)
 
-    Jac_func = vector_field_class.get_Jacobian(method=method)
-    Js = Jac_func(X[cell_idx])
-
     if regulators is None and effectors is not None:
         regulators = effectors
     elif effectors is None and regulators is not None:
         effectors = regulators
 
+    Qi, Qj = None, None
     if regulators is not None and effectors is not None:
         if type(regulators) is str:
             if regulators in adata.var.keys():
@@ -252,21 +273,47 @@ def jacobian(adata,
         else:
             raise Exception(f'No PC matrix {Qkey} found in neither .uns nor .varm.')
         Q = Q[:, :X.shape[1]]
-        if len(regulators) == 1 and len(effectors) == 1:
-            Jacobian = elementwise_jacobian_transformation(Js,
-                    Q[eff_idx, :].flatten(), Q[reg_idx, :].flatten(), **kwargs)
-        else:
-            Jacobian = subset_jacobian_transformation(Js, Q[eff_idx, :], Q[reg_idx, :], **kwargs)
+        Qi, Qj = Q[eff_idx, :], Q[reg_idx, :]
+
+    Jacobian = None
+    vf_dict = getattr(vector_field_class, 'vf_dict', {}).get('VecFld', {})
+    if method == 'analytical' and len(kwargs) == 0 and all(k in vf_dict for k in ['X_ctrl', 'beta', 'C']):
+        x = X[cell_idx]
+        if Qi is not None and jacobian_gene_file is not None:
+            Jacobian = open_jacobian_gene_file(jacobian_gene_file, (Qi.shape[0], Qj.shape[0], x.shape[0]))
+        Js, Js_det, Jacobian = Jacobian_rkhs_gaussian_chunked(x, vf_dict, Qi=Qi, Qj=Qj, chunk_size=chunk_size,
+                                                              cores=cores, jacobian_gene=Jacobian)
+        if Jacobian is not None and jacobian_gene_file is None and len(regulators) == 1 and len(effectors) == 1:
+            Jacobian = Jacobian[0, 0].astype(float)
     else:
-        Jacobian = None
+        # numerical or process-parallel Jacobians, vector fields that are not RKHS ones, or extra keyword arguments
+        # for the gene space transformations are handled by the vector field class and the transformation functions.
+        Jac_func = vector_field_class.get_Jacobian(method=method, **({'cores': cores} if method == 'parallel' else {}))
+        Js = Jac_func(X[cell_idx])
+        Js_det = [np.linalg.det(Js[:, :, i]) for i in np.arange(Js.shape[2])]
+        if Qi is not None:
+            if len(regulators) == 1 and len(effectors) == 1:
+                Jacobian = elementwise_jacobian_transformation(Js, Qi.flatten(), Qj.flatten(), **kwargs)
+            else:
+                Jacobian = subset_jacobian_transformation(Js, Qi, Qj, cores=cores, **kwargs)
+            if jacobian_gene_file is not None:
+                J_file = open_jacobian_gene_file(jacobian_gene_file, (Qi.shape[0], Qj.shape[0], Js.shape[2]))
+                J_file[:] = np.reshape(Jacobian, J_file.shape)
+                Jacobian = J_file
 
     ret_dict = {"jacobian": Js, "cell_idx": cell_idx}
     # use 'str_key' in dict.keys() to check if these items are computed, or use dict.get('str_key')
-    if Jacobian is not None: ret_dict['jacobian_gene'] = Jacobian
+    if Jacobian is not None:
+        if jacobian_gene_file is None:
+            ret_dict['jacobian_gene'] = Jacobian
+        else:
+            # only keep the path so that adata stays serializable; open it again with `load_jacobian_gene`
+            if hasattr(Jacobian, 'flush'): Jacobian.flush()
+            del Jacobian
+            ret_dict['jacobian_gene_file'] = jacobian_gene_file
     if regulators is not None: ret_dict['regulators'] = regulators.to_list()
     if effectors is not None: ret_dict['effectors'] = effectors.to_list()
 
-    Js_det = [np.linalg.det(Js[:, :, i]) for i in np.arange(Js.shape[2])]
     adata.obs['jacobian_det_' + basis] = np.nan
     adata.obs['jacobian_det_' + basis][cell_idx] = Js_det
     if store_in_adata:
@@ -415,7 +462,7 @@ def sensitivity(adata,
                         **kwargs
                         )
 
-            J, regulators, effectors = Js.get('jacobian_gene'), Js.get('regulators'), Js.get('effectors')
+            J, regulators, effectors = load_jacobian_gene(Js), Js.get('regulators'), Js.get('effectors')
             Sensitivity = np.zeros_like(J)
             n_genes, n_genes_, n_cells = J.shape
             I = np.eye(n_genes)
@@ -990,7 +1037,7 @@ def rank_divergence_genes(adata,
     else:
         Genes = adata.uns[jkey]['regulators']
     cell_idx = adata.uns[jkey]['cell_idx']
-    div = np.einsum('iij->ji', adata.uns[jkey]['jacobian_gene'])
+    div = np.einsum('iij->ji', np.asarray(load_jacobian_gene(adata.uns[jkey])))
     Div = create_layer(adata, div, genes=Genes, cells=cell_idx, dtype=np.float32)
 
     if genes is not None:
@@ -1147,7 +1194,7 @@ def rank_jacobian_genes(adata,
             AnnData object which has the rank dictionary in `.uns`.
     """
     J_dict = adata.uns[jkey]
-    J = J_dict['jacobian_gene']
+    J = np.asarray(load_jacobian_gene(J_dict))
     if abs:
         J = np.abs(J)
     if groups is None:
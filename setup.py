@@ -13,8 +13,7 @@ setup(
     install_requires=[
         l.strip() for l in Path('requirements.txt').read_text('utf-8').splitlines()
     ], # 'yt>=3.5.1',
-    extras_require={"spatial": ["pysal>2.0.0"],
-                    "interactive_plots": ["plotly"],
+    extras_require={"interactive_plots": ["plotly"],
                     "network": ["networkx", "nxviz", "hiveplotlib"],
                     "dimension_reduction": ["fitsne>=1.0.1", "dbmap>=1.1.2"],
                     "test": ['sympy>=1.4'],
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from scipy.cluster.vq import kmeans2
+from scipy.sparse.csgraph import minimum_spanning_tree
+from scipy.sparse.linalg import LinearOperator
+
+from dynamo.tools.DDRTree_py import DDRTree, pca_projection, sqdist
+
+
+def _reference_ddrtree(X, maxIter, sigma, gamma, dim=2, Lambda=1.0, ncenter=None):
+    """The original DDRTree iterations with the dense N x N matrix Q."""
+    D, N = X.shape
+    W = pca_projection(X @ X.T, dim)
+    Z = W.T @ X
+    if ncenter is None:
+        K, Y = N, Z
+    else:
+        K = ncenter
+        Y = kmeans2(Z.T, K)[0].T
+
+    objs = []
+    for it in range(maxIter):
+        stree = minimum_spanning_tree(np.tril(sqdist(Y, Y))).toarray()
+        stree = stree + stree.T
+        B = stree != 0
+        L = np.diag(B.sum(0)) - B
+
+        distZY = sqdist(Z, Y)
+        min_dist = distZY.min(1)[:, None]
+        tmp_R = np.exp(-(distZY - min_dist) / sigma)
+        R = tmp_R / tmp_R.sum(1)[:, None]
+        Gamma = np.diag(R.sum(0))
+        obj1 = -sigma * np.sum(np.log(tmp_R.sum(1)) - min_dist[:, 0] / sigma)
+        objs.append(np.linalg.norm(X - W @ Z, 2) ** 2 + Lambda * np.trace(Y @ L @ Y.T) + gamma * obj1)
+
+        tmp = R @ np.linalg.inv(((gamma + 1) / gamma) * ((Lambda / gamma) * L + Gamma) - R.T @ R)
+        Q = (np.eye(N) + tmp @ R.T) / (gamma + 1)
+        C = X @ Q
+        tmp1 = C @ X.T
+        W = pca_projection((tmp1 + tmp1.T) / 2, dim)
+        Z = W.T @ C
+        Y = Z @ R @ np.linalg.inv((Lambda / gamma) * L + Gamma)
+
+    return Z, Y, stree, R, W, Q, C, objs
+
+
+def _data(N=120, D=8, seed=0):
+    rng = np.random.RandomState(seed)
+    t = rng.rand(N) * 3
+    X = np.vstack([np.sin(t), np.cos(2 * t), t] + [0.1 * rng.normal(size=N) for _ in range(D - 3)])
+    return X + 0.05 * rng.normal(size=(D, N))
+
+
+@pytest.mark.parametrize("ncenter", [None, 15])
+def test_ddrtree_matches_dense_reference(ncenter):
+    X = _data()
+    kwargs = dict(maxIter=5, sigma=0.01, gamma=10, Lambda=5 * X.shape[1], ncenter=ncenter)
+    np.random.seed(0)
+    ref = _reference_ddrtree(X, **kwargs)
+    np.random.seed(0)
+    res = DDRTree(X, verbose=False, **kwargs)
+    np.random.seed(0)
+    res_op = DDRTree(X, verbose=False, Q_operator=True, **kwargs)
+
+    for name, a, b in zip(["Z", "Y", "stree", "R", "W", "Q", "C", "objs"], res, ref):
+        # eigenvectors are only defined up to their sign
+        if name in ["Z", "Y", "W"]:
+            a, b = np.abs(a), np.abs(b)
+        assert np.allclose(a, b, rtol=1e-6, atol=1e-8 * np.abs(b).max()), name
+    assert isinstance(res_op[5], LinearOperator)
+    assert np.allclose(res_op[5] @ np.eye(X.shape[1]), res[5])
+
+
+def test_ddrtree_without_iterations(capsys):
+    X = _data(N=30)
+    Z, Y, stree, R, W, Q, C, objs = DDRTree(X, maxIter=0, sigma=0.01, gamma=10, ncenter=5)
+    assert objs == [] and capsys.readouterr().out == ""
+    assert np.allclose(Q, np.eye(30) / 11) and np.allclose(C, X / 11)
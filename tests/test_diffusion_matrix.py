@@ -0,0 +1,96 @@
+import warnings
+
+import anndata
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+from sklearn.neighbors import NearestNeighbors
+
+from dynamo.vectorfield.stochastic_process import diffusionMatrix
+
+
+def _reference_diffusion_matrix(V_data, Idx):
+    """The original per-cell loop with `np.cov` over the neighbors' residuals to their average."""
+    n_cells = V_data.shape[0]
+    V_ave = np.zeros_like(V_data)
+    val, dmatrix = np.zeros(n_cells), [None] * n_cells
+    with warnings.catch_warnings(), np.errstate(invalid="ignore", divide="ignore"):
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for i in range(n_cells):
+            V_ave[i] = V_data[Idx[i]].mean(0)
+        V_diff = V_data - V_ave
+        for i in range(n_cells):
+            d = np.cov(V_diff[Idx[i]].T)
+            val[i] = np.sqrt(np.sum(d))
+            dmatrix[i] = d
+    return val, np.array(dmatrix)
+
+
+def _make_adata(n_cells=120, n_dims=3, seed=0):
+    rng = np.random.RandomState(seed)
+    adata = anndata.AnnData(rng.rand(n_cells, 5))
+    adata.obsm["X_umap"] = rng.rand(n_cells, n_dims)
+    adata.obsm["velocity_umap"] = rng.randn(n_cells, n_dims)
+    return adata
+
+
+@pytest.mark.parametrize("chunk_size", [None, 7])
+def test_diffusion_matrix_matches_reference_knn(chunk_size):
+    adata = _make_adata()
+    X, V = adata.obsm["X_umap"], adata.obsm["velocity_umap"]
+    _, Idx = NearestNeighbors(n_neighbors=10).fit(X).kneighbors(X)
+    val, dmatrix = _reference_diffusion_matrix(V, Idx)
+
+    diffusionMatrix(adata, n=10, residual="average", chunk_size=chunk_size)
+    np.testing.assert_allclose(adata.obs["diffusion"], val, rtol=1e-10)
+    np.testing.assert_allclose(adata.uns["diffusion_matrix"], dmatrix, rtol=1e-10, atol=1e-14)
+
+    diffusionMatrix(adata, n=10, residual="average", store="trace", chunk_size=chunk_size)
+    np.testing.assert_allclose(adata.uns["diffusion_trace"], np.trace(dmatrix, axis1=1, axis2=2), rtol=1e-10)
+    assert "diffusion_matrix" not in adata.uns
+
+
+def test_diffusion_matrix_uses_user_data():
+    adata = _make_adata()
+    rng = np.random.RandomState(1)
+    X, V = rng.rand(adata.n_obs, 2), rng.randn(adata.n_obs, 2)
+    _, Idx = NearestNeighbors(n_neighbors=8).fit(X).kneighbors(X)
+    val, dmatrix = _reference_diffusion_matrix(V, Idx)
+
+    # a stored neighbor graph is not used for the user supplied data
+    adata.uns["neighbors"] = {}
+    adata.obsp["connectivities"] = csr_matrix((adata.n_obs, adata.n_obs))
+    diffusionMatrix(adata, X_data=X, V_data=V, n=8, residual="average")
+    np.testing.assert_allclose(adata.obs["diffusion"], val, rtol=1e-10)
+    np.testing.assert_allclose(adata.uns["diffusion_matrix"], dmatrix, rtol=1e-10, atol=1e-14)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 7])
+def test_diffusion_matrix_ragged_neighbor_graph(chunk_size):
+    adata = _make_adata(n_cells=60)
+    rng = np.random.RandomState(2)
+    conn = csr_matrix(rng.rand(60, 60) * (rng.rand(60, 60) < 0.1))
+    conn.setdiag(0)
+    conn = conn.tolil()
+    conn.rows[3], conn.data[3] = [], []  # no neighbors
+    conn.rows[5], conn.data[5] = [7], [1.0]  # a single neighbor
+    adata.uns["neighbors"] = {}
+    adata.obsp["connectivities"] = conn.tocsr()
+    Idx = adata.obsp["connectivities"].tolil().rows
+    val, dmatrix = _reference_diffusion_matrix(adata.obsm["velocity_umap"], Idx)
+
+    adata.uns["diffusion_trace"] = np.zeros(60)
+    diffusionMatrix(adata, residual="average", chunk_size=chunk_size)
+    assert np.isnan(adata.obs["diffusion"].values[[3, 5]]).all()
+    np.testing.assert_allclose(adata.obs["diffusion"], val, rtol=1e-10)
+    np.testing.assert_allclose(adata.uns["diffusion_matrix"], dmatrix, rtol=1e-10, atol=1e-14)
+    assert "diffusion_trace" not in adata.uns
+
+
+def test_diffusion_matrix_store_none_removes_stale_results():
+    adata = _make_adata()
+    diffusionMatrix(adata, n=10, residual="average")
+    assert "diffusion_matrix" in adata.uns
+    diffusionMatrix(adata, n=10, residual="average", store=None)
+    assert "diffusion_matrix" not in adata.uns and "diffusion_trace" not in adata.uns
+    assert np.isfinite(adata.obs["diffusion"]).all()
@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import pytest
+from anndata import AnnData
+from scipy.integrate import solve_ivp
+from scipy.linalg import expm
+from sklearn.neighbors import NearestNeighbors
+
+from dynamo.prediction.fate import _fate, fate_bias
+from dynamo.prediction.utils import dopri5_batch
+
+A = np.array([[-0.1, 1.0], [-1.0, -0.1]])
+Y0 = np.random.RandomState(0).normal(size=(5, 2)) * 3
+
+
+@pytest.mark.parametrize("t_bound", [10.0, -4.0])
+def test_dopri5_batch_matches_rk45(t_bound):
+    T, Y, dY = dopri5_batch(lambda x: x @ A.T, Y0, t_bound, max_step=0.5, disable=True)
+    for i in range(len(Y0)):
+        sol = solve_ivp(lambda t, x: A @ x, (0, t_bound), Y0[i], method="RK45", max_step=0.5, rtol=1e-3, atol=1e-6)
+        # same step size controller, so the same accepted steps
+        assert np.allclose(T[i], sol.t, rtol=0, atol=1e-12)
+        assert np.allclose(Y[i], sol.y.T, rtol=0, atol=1e-12)
+        assert np.allclose(dY[i], Y[i] @ A.T)
+        assert np.allclose(Y[i][-1], expm(A * t_bound) @ Y0[i], atol=1e-3)
+
+
+@pytest.mark.parametrize("sampling", ["arc_length", "uniform_indices"])
+@pytest.mark.parametrize("average", [False, True])
+def test_fate_batch_matches_ivp(sampling, average):
+    kwargs = dict(t_end=10, interpolation_num=50, average=average, sampling=sampling)
+    t_ivp, pred_ivp = _fate(lambda x: x @ A.T, Y0, integration_method="ivp", **kwargs)
+    t_batch, pred_batch = _fate(lambda x: x @ A.T, Y0, integration_method="batch", **kwargs)
+    assert np.allclose(np.asarray(t_ivp), np.asarray(t_batch))
+    # only the dense output (RK45 interpolant vs cubic Hermite spline) differs
+    assert np.allclose(np.asarray(pred_ivp), np.asarray(pred_batch), atol=1e-4)
+
+
+def _reference_fate_bias(adata, group, basis="umap", source_groups=None, speed_percentile=5, dist_threshold=1):
+    """The original fate_bias, which queried the neighbor index again for the neighbors of each cell state."""
+    clusters = adata.obs[group]
+    X = adata.obsm["X_" + basis]
+    nbrs = NearestNeighbors(n_neighbors=30, algorithm="kd_tree").fit(X)
+    distances, knn = nbrs.kneighbors(X)
+    median_dist = np.median(distances[:, 1])
+    fate = adata.uns["fate_" + basis]
+    pred_dict, confidence = {}, np.zeros(len(fate["t"]))
+    for i, prediction in enumerate(fate["prediction"]):
+        cur_t, n_steps = fate["t"][i], len(fate["t"][i])
+        avg_speed = np.array([np.linalg.norm(i) for i in np.diff(prediction, 1).T]) / np.diff(cur_t)
+        sink_checker = np.where(avg_speed[::-1] > np.percentile(avg_speed, speed_percentile))[0]
+        indices = np.arange(n_steps - max(min(sink_checker), 10), n_steps)
+        distances, knn = nbrs.kneighbors(prediction[:, indices].T)
+        walk_back_steps = 0
+        while True:
+            close = distances.flatten() < dist_threshold * median_dist
+            if any(close):
+                _, knn = nbrs.kneighbors(X[knn.flatten(), :])
+                fate_prob = clusters.iloc[knn.flatten()].value_counts() / len(knn.flatten())
+                if source_groups is not None:
+                    reached = fate_prob.index.intersection(source_groups)
+                    source_p = fate_prob[reached].sum()
+                    if 1 > source_p > 0:
+                        fate_prob[reached] = 0
+                        fate_prob[fate_prob.idxmax()] += source_p
+                pred_dict[i] = fate_prob
+                confidence[i] = 1 - (sum(~close) + walk_back_steps) / (len(close) + walk_back_steps)
+                break
+            walk_back_steps += 1
+            distances, knn = nbrs.kneighbors(prediction[:, indices - 1].T)
+            knn, distances = knn[:, 0], distances[:, 0]
+            indices = indices - 1
+    bias = pd.DataFrame(pred_dict).T
+    conf = pd.DataFrame({"confidence": confidence}, index=bias.index)
+    return pd.merge(conf, bias, left_index=True, right_index=True)
+
+
+@pytest.mark.parametrize("categorical", [True, False])
+# "b" is reassigned for the state that ends between b and d, and never reached by the others
+@pytest.mark.parametrize("source_groups", [None, ["b"]])
+def test_fate_bias_matches_per_state_queries(categorical, source_groups):
+    rng = np.random.RandomState(0)
+    centers = np.array([[0, 0], [6, 0], [0, 6], [6, 6]])
+    X = np.vstack([c + rng.normal(size=(80, 2)) for c in centers])
+    labels = np.repeat(list("abcd"), 80)
+    adata = AnnData(np.zeros((len(X), 1)), obs=pd.DataFrame(
+        {"group": pd.Categorical(labels) if categorical else labels}, index=[f"c{i}" for i in range(len(X))]))
+    adata.obsm["X_umap"] = X
+
+    # trajectories relax from the first cluster towards the others; the last one overshoots into an empty region and
+    # has to walk back
+    t = np.linspace(0, 10, 60)
+    targets = [centers[1], centers[2], centers[3], (centers[3] + centers[1]) / 2, np.array([20.0, 20.0])]
+    prediction = [(targets[k][:, None] + (X[k][:, None] - targets[k][:, None]) * np.exp(-t)[None, :]) for k in
+                  range(len(targets))]
+    adata.uns["fate_umap"] = {"prediction": prediction, "t": [t] * len(targets), "init_cells": None}
+
+    bias = fate_bias(adata, "group", source_groups=source_groups)
+    ref = _reference_fate_bias(adata, "group", source_groups=source_groups)
+    pd.testing.assert_frame_equal(bias.astype(float), ref.astype(float), check_like=True, check_names=False,
+                                  check_categorical=False, check_column_type=False, check_index_type=False)
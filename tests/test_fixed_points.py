@@ -0,0 +1,91 @@
+import sys
+
+import numpy as np
+import pytest
+
+from dynamo.vectorfield.utils import Jacobian_rkhs_gaussian_block, vector_field_function
+
+topography = sys.modules["dynamo.vectorfield.topography"]
+
+
+def bistable(X):
+    # roots at (0, 0) and (+-1, 0)
+    X = np.atleast_2d(X)
+    return np.column_stack((X[:, 0] - X[:, 0] ** 3, -2 * X[:, 1] + 0.5 * X[:, 0] * X[:, 1]))
+
+
+def bistable_jac(X):
+    J = np.zeros((len(X), 2, 2))
+    J[:, 0, 0] = 1 - 3 * X[:, 0] ** 2
+    J[:, 1, 0] = 0.5 * X[:, 1]
+    J[:, 1, 1] = -2 + 0.5 * X[:, 0]
+    return J
+
+
+X0 = np.random.RandomState(0).uniform(-1.8, 1.8, size=(40, 2))
+
+
+@pytest.mark.parametrize("use_jac", [True, False])
+@pytest.mark.parametrize("chunk_size, cores", [(None, 1), (7, 3)])
+def test_lm_fixed_points_match_fsolve(use_jac, chunk_size, cores):
+    jac = bistable_jac if use_jac else None
+    X, J, fval, converged = topography.solve_fixed_points_batch(X0, bistable, jac, chunk_size=chunk_size, cores=cores)
+
+    assert converged.all()
+    assert np.abs(fval).max() < 1e-10
+    assert np.allclose(fval, bistable(X))
+    assert np.allclose(J, bistable_jac(X), atol=1e-6)
+    # every start point ends at a true root
+    roots = np.array([[0, 0], [1, 0], [-1, 0]])
+    assert np.abs(X[:, None] - roots[None]).sum(2).min(1).max() < 1e-8
+
+    P = topography.find_fixed_points_batch(X0, bistable, jac)
+    P_ref = topography.find_fixed_points(X0, lambda x: bistable(x)[0])
+    assert np.allclose(np.sort(P, 0), np.sort(P_ref, 0), atol=1e-8)
+    assert len(P) == 3
+
+
+def test_lm_fixed_points_rkhs_field():
+    rng = np.random.RandomState(1)
+    X = rng.normal(size=(100, 2))
+    vf_dict = {"X": X, "X_ctrl": X[:20], "C": -X[:20] * 0.8 + rng.normal(size=(20, 2)) * 0.1, "beta": 0.5}
+    func = lambda x: vector_field_function(x, vf_dict)
+    jac = lambda x: Jacobian_rkhs_gaussian_block(x, vf_dict)
+
+    starts = rng.uniform(-1, 1, size=(15, 2))
+    P, J, fval = topography.find_fixed_points_batch(starts, func, jac, full_output=True)
+    P_ref = topography.find_fixed_points(starts, func)
+
+    # the field vanishes far from the data, so some starts drift away with either solver; compare the ones inside
+    inside, inside_ref = np.abs(P).max(1) < 3, np.abs(P_ref).max(1) < 3
+    assert inside.sum() == inside_ref.sum() == 1
+    assert np.abs(fval[inside]).max() < 1e-10
+    assert np.allclose(P[inside], P_ref[inside_ref], atol=1e-8)
+    # the analytical Jacobian agrees with central differences
+    x, h = P[inside][0], 1e-6
+    J_fd = np.column_stack([(func(x + h * e) - func(x - h * e)).ravel() / (2 * h) for e in np.eye(2)])
+    assert np.allclose(J[inside][0], J_fd, atol=1e-6)
+
+
+def test_solve_fixed_points_batch_without_start_points():
+    X, J, fval, converged = topography.solve_fixed_points_batch(np.zeros((0, 2)), bistable)
+    assert X.shape == (0, 2) and J.shape == (0, 2, 2) and fval.shape == (0, 2) and converged.shape == (0,)
+    assert len(topography.find_fixed_points_batch(np.zeros((0, 2)), bistable)) == 0
+
+
+@pytest.mark.parametrize(
+    "func, vectorized",
+    [(bistable, True), (lambda x: np.array([x[0] - x[0] ** 3, -x[1]]), False)],
+)
+def test_vector_field_2d_fixed_points(func, vectorized):
+    assert topography._is_vectorized(func) == vectorized
+
+    vf = topography.VectorField2D(func)
+    np.random.seed(0)
+    vf.find_fixed_points_by_sampling(30, [-2, 2], [-2, 2])
+    X = vf.get_fixed_points(get_types=False)
+    assert np.allclose(X[np.argsort(X[:, 0])], [[-1, 0], [0, 0], [1, 0]], atol=1e-6)
+
+    vf = topography.VectorField2D(func)
+    vf.find_nearest_fixed_point(np.array([[0.8, 0.3]]), [-2, 2], [-2, 2])
+    assert np.allclose(vf.get_fixed_points(get_types=False), [[1, 0]], atol=1e-6)
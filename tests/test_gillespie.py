@@ -0,0 +1,57 @@
+import numpy as np
+from numba import njit
+
+from dynamo.simulation.gillespie_utils import (
+    directMethod,
+    prop_2bifurgenes,
+    prop_2bifurgenes_jit,
+    prop_slam,
+    prop_slam_jit,
+    simulate_ssa,
+    stoich_2bifurgenes,
+    stoich_slam,
+)
+
+
+def _replay(prop, stoich, p, c0, t_eval, seed):
+    """The state of the python direct method right after the last reaction at or before each time point."""
+    np.random.seed(seed)
+    T, C = directMethod(lambda c: prop(c, *p), lambda c, mu: c + stoich[mu], [t_eval[0], t_eval[-1]], c0)
+    return C[:, np.searchsorted(T, t_eval, side="right") - 1]
+
+
+def test_simulate_ssa_replays_direct_method():
+    t_eval = np.linspace(0, 20, 41)
+    p = np.array([0.5, 0.3, 0.7, 20, 2, 0.6, 1.0, 0.4])
+    C0 = np.zeros((6, 5))
+    C0[::2, 0] = 1
+    res = simulate_ssa(prop_slam_jit, stoich_slam(), p, C0, t_eval, seed=7)
+    for i in range(len(C0)):
+        assert np.array_equal(res[i], _replay(prop_slam, stoich_slam(), p, C0[i], t_eval, 7 + i))
+
+    p2 = np.array([20, 20, 20, 20, 20, 3, 1, 1, 1, 1.0])
+    res = simulate_ssa(prop_2bifurgenes_jit, stoich_2bifurgenes(), p2, np.zeros(4), t_eval, seed=3)
+    assert np.array_equal(res[0], _replay(prop_2bifurgenes, stoich_2bifurgenes(), p2, np.zeros(4), t_eval, 3))
+
+
+def test_simulate_ssa_is_independent_of_cores():
+    t_eval = np.linspace(0, 10, 11)
+    p = np.array([0.5, 0.3, 0.7, 20, 2, 0.6, 1.0, 0.4])
+    a = simulate_ssa(prop_slam_jit, stoich_slam(), p, np.zeros((20, 5)), t_eval, cores=1)
+    b = simulate_ssa(prop_slam_jit, stoich_slam(), p, np.zeros((20, 5)), t_eval, cores=4)
+    assert np.array_equal(a, b)
+
+
+@njit
+def _prop_birth_death(C, p, prop):
+    prop[0], prop[1] = p[0], p[1] * C[0]
+
+
+def test_simulate_ssa_birth_death_moments():
+    # the copy number of a birth-death process started at 0 is poisson with mean k / g (1 - exp(-g t))
+    k, g, n = 10.0, 0.5, 4000
+    t_eval = np.array([0, 0.5, 1, 2, 5, 10])
+    res = simulate_ssa(_prop_birth_death, np.array([[1.0], [-1.0]]), np.array([k, g]), np.zeros((n, 1)), t_eval)
+    mean = k / g * (1 - np.exp(-g * t_eval))
+    assert np.all(np.abs(res[:, 0].mean(0) - mean) <= 4 * np.sqrt(mean / n))
+    assert np.allclose(res[:, 0].var(0)[1:], mean[1:], rtol=0.1)
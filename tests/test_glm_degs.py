@@ -0,0 +1,92 @@
+import sys
+
+import anndata
+import numpy as np
+import pandas as pd
+import pytest
+
+import dynamo.tools  # noqa: F401
+
+markers = sys.modules["dynamo.tools.markers"]
+
+
+def _adata(n_cells=300, n_genes=12, seed=0):
+    rng = np.random.RandomState(seed)
+    obs = pd.DataFrame({"x": rng.rand(n_cells), "y": rng.normal(size=n_cells)},
+                       index=[f"c{i}" for i in range(n_cells)])
+    # NB counts, half of the genes depend on x
+    slope = np.where(np.arange(n_genes) % 2 == 0, 1.5, 0)
+    mu = np.exp(0.5 + slope[None, :] * obs["x"].values[:, None] + 0.2 * obs["y"].values[:, None])
+    counts = rng.negative_binomial(2, 2 / (2 + mu)).astype(float)
+    counts[:, -1] = 0  # a gene whose fit fails
+    adata = anndata.AnnData(counts, obs=obs, var=pd.DataFrame(index=[f"g{i}" for i in range(n_genes)]))
+    adata.uns["pp"] = {"norm_method": None}
+    return adata
+
+
+@pytest.mark.parametrize("chunk_size, cores", [(None, 1), (5, 2)])
+def test_glm_degs_matches_statsmodels(chunk_size, cores):
+    adata = _adata()
+    full, reduced = "~x + y", "~y"
+    markers.glm_degs(adata, X_data=adata.X.copy(), genes=adata.var_names, fullModelFormulaStr=full,
+                     reducedModelFormulaStr=reduced, chunk_size=chunk_size, cores=cores)
+    res = adata.uns["glm_degs"]
+
+    assert res.loc["g11", "status"] == "fail" and res.loc["g11", "pval"] == 1
+    for j, gene in enumerate(adata.var_names[:-1]):
+        data = adata.obs.copy()
+        data["expression"] = adata.X[:, j]
+        status, family, pval = markers.diff_test_helper(data, full, reduced)
+        assert res.loc[gene, "status"] == status == "ok"
+        assert np.isclose(res.loc[gene, "pval"], pval, rtol=1e-6, atol=1e-300)
+    assert (res["pval"].values[:-1:2] < 1e-3).all()
+
+
+def test_glm_irls_matches_statsmodels_fits():
+    import statsmodels.api as sm
+
+    adata = _adata(n_genes=6)
+    X = np.column_stack((np.ones(adata.n_obs), adata.obs["x"], adata.obs["y"]))
+    Y = adata.X[:, :-1]
+    alpha = np.linspace(0.2, 1.0, Y.shape[1])
+
+    mu_pois, failed_pois = markers._glm_irls(Y, X, tol=1e-12)
+    mu_nb, failed_nb = markers._glm_irls(Y, X, alpha, tol=1e-12)
+    assert not failed_pois.any() and not failed_nb.any()
+    for j in range(Y.shape[1]):
+        pois = sm.GLM(Y[:, j], X, family=sm.families.Poisson()).fit(tol=1e-12)
+        nb = sm.GLM(Y[:, j], X, family=sm.families.NegativeBinomial(alpha=alpha[j])).fit(tol=1e-12)
+        assert np.allclose(mu_pois[:, j], pois.mu, rtol=1e-8)
+        assert np.allclose(mu_nb[:, j], nb.mu, rtol=1e-8)
+
+    # the fitted means only depend on the column space of the design
+    mu_basis, _ = markers._glm_irls(Y, markers._design_basis(X), alpha, tol=1e-12)
+    assert np.allclose(mu_basis, mu_nb, rtol=1e-8)
+
+
+def test_glm_degs_poisson_like_genes():
+    import statsmodels.api as sm
+
+    adata = _adata(n_genes=6)
+    rng = np.random.RandomState(1)
+    x = adata.obs["x"].values
+    adata.X[:, 0] = rng.poisson(np.exp(0.5 + x))  # Poisson, dispersion estimate around 0
+    adata.X[:, 1] = rng.binomial(4, 0.5, size=adata.n_obs)  # underdispersed
+    markers.glm_degs(adata, X_data=adata.X.copy(), genes=adata.var_names, fullModelFormulaStr="~x + y",
+                     reducedModelFormulaStr="~y")
+    res = adata.uns["glm_degs"]
+
+    assert np.isfinite(res["pval"]).all() and np.isfinite(res["qval"]).all()
+    assert (res["status"].values[:-1] == "ok").all() and res["status"].values[-1] == "fail"
+    X_full = np.column_stack((np.ones(adata.n_obs), x, adata.obs["y"]))
+    # the genes without a positive dispersion estimate are tested with the Poisson likelihood ratio
+    n_poisson = 0
+    for j in range(2):
+        full = sm.GLM(adata.X[:, j], X_full, family=sm.families.Poisson()).fit()
+        if ((adata.X[:, j] - full.mu) ** 2 - adata.X[:, j]).sum() <= 0:
+            null = sm.GLM(adata.X[:, j], X_full[:, [0, 2]], family=sm.families.Poisson()).fit()
+            pval = markers.stats.chi2.sf(2 * (full.llf - null.llf), df=1)
+            assert np.isclose(res["pval"].iloc[j], pval, rtol=1e-6)
+            n_poisson += 1
+    assert n_poisson >= 1
+    assert res["pval"].iloc[0] < 1e-3
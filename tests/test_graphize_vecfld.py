@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+from dynamo.tools.connectivity import k_nearest_neighbors
+from dynamo.vectorfield.scVectorField import graphize_vecfld
+
+
+def _field(X):
+    X = np.atleast_2d(X)
+    return np.column_stack((-X[:, 1] + 0.3 * X[:, 0], X[:, 0] - X[:, 1] ** 3, np.sin(X[:, 2])))
+
+
+def _reference(func, X, nbrs_idx, dist, distance_free, n_int_steps):
+    # edge by edge, as graphize_vecfld used to: the weight of i -> j is set on (i, j) and its negative on (j, i), and
+    # the graphs of all cells are summed
+    n = X.shape[0]
+    V = np.zeros((n, n))
+    for i, idx in enumerate(nbrs_idx):
+        for jj, j in enumerate(idx[1:]):
+            x, y = X[i], X[j]
+            v = func(np.linspace(x, y, n_int_steps))
+            lxy = np.linalg.norm(y - x)
+            u = (y - x) / lxy if lxy > 0 else y - x
+            w = np.mean(v.dot(u))
+            if not distance_free:
+                w *= lxy if dist is None else dist[i][jj + 1]
+            V[i, j] += w
+            V[j, i] -= w
+    return V
+
+
+@pytest.mark.parametrize("distance_free", [True, False])
+@pytest.mark.parametrize("use_dist", [True, False])
+@pytest.mark.parametrize("cores, chunk_size", [(1, None), (3, 17)])
+def test_graphize_vecfld_matches_edge_loop(distance_free, use_dist, cores, chunk_size):
+    X = np.random.RandomState(0).normal(size=(80, 3))
+    nbrs_idx, dist = k_nearest_neighbors(X, k=6, use_cache=False)
+    # a duplicated cell gives a zero length edge
+    X[1] = X[nbrs_idx[1, 1]]
+
+    V, nbrs = graphize_vecfld(_field, X, nbrs_idx=nbrs_idx, dist=dist if use_dist else None,
+                              distance_free=distance_free, n_int_steps=7, cores=cores, chunk_size=chunk_size)
+    ref = _reference(_field, X, nbrs_idx, dist if use_dist else None, distance_free, 7)
+
+    assert nbrs is None
+    assert sp.issparse(V)
+    assert np.allclose(V.A, ref, rtol=1e-12, atol=1e-14)
+    assert np.allclose(V.A, -V.A.T)
+
+
+def test_graphize_vecfld_ragged_neighbors_and_sparse_input():
+    X = np.random.RandomState(1).normal(size=(40, 3))
+    nbrs_idx = [[i] + list(np.random.RandomState(i).choice(np.delete(np.arange(40), i), i % 4, replace=False))
+                for i in range(40)]
+    V, _ = graphize_vecfld(_field, sp.csr_matrix(X), nbrs_idx=nbrs_idx, distance_free=False, n_int_steps=5)
+    assert np.allclose(V.A, _reference(_field, X, nbrs_idx, None, False, 5))
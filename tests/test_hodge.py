@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from sklearn.neighbors import NearestNeighbors
+
+from dynamo.external.hodge import _edge_pairs, build_graph, curl, curlop, div, graph_laplacian, potential
+
+
+def _graph(n=300, k=8, weights=None, n_comp=1, seed=0):
+    """Antisymmetric kNN graph with one edge per neighbor pair in each direction."""
+    rng = np.random.RandomState(seed)
+    X = rng.rand(n, 2)
+    X[: n // 2, 0] += 10 * (n_comp > 1)
+    idx = NearestNeighbors(n_neighbors=k + 1).fit(X).kneighbors(X)[1]
+    pairs = np.unique(np.sort(np.vstack((np.repeat(np.arange(n), k), idx[:, 1:].flatten())).T, 1), axis=0)
+    rows, cols = pairs.T
+    w = rng.normal(size=len(rows)) if weights is None else weights(X)[cols] - weights(X)[rows]
+    A = sp.csr_matrix((np.r_[w, -w], (np.r_[rows, cols], np.r_[cols, rows])), shape=(n, n))
+    return build_graph(A), X
+
+
+def test_graph_laplacian_matches_igraph():
+    g, _ = _graph()
+    g_undirected = g.copy()
+    g_undirected.to_undirected()
+    assert np.array_equal(graph_laplacian(g).A, np.array(g_undirected.laplacian()))
+
+
+def test_potential_of_gradient_flow():
+    f = lambda X: X[:, 0] ** 2 + X[:, 1]
+    g, X = _graph(weights=f)
+    # each neighbor pair contributes an edge in both directions
+    assert np.allclose(potential(g), 2 * (f(X) - f(X).min()), atol=1e-8)
+    assert np.allclose(curl(g), 0)
+
+
+@pytest.mark.parametrize("n_comp", [1, 2])
+def test_potential_cg_matches_qr(n_comp):
+    g, _ = _graph(n_comp=n_comp)
+    d = -div(g)
+    p_qr = potential(g, d, method="qr")
+    assert np.allclose(potential(g, d), p_qr, atol=1e-7 * np.ptp(p_qr))
+
+
+def test_curlop_matches_loop():
+    g, _ = _graph()
+    e, pair_key, pair_eid = _edge_pairs(g)
+    n, w = g.vcount(), np.array(g.es["weight"])
+
+    def eid(a, b):
+        return pair_eid[np.searchsorted(pair_key, min(a, b) * n + max(a, b))]
+
+    ref = []
+    for t in sorted(tuple(sorted(c)) for c in g.cliques(min=3, max=3)):
+        cycle = [(t[0], t[1]), (t[1], t[2]), (t[2], t[0])]
+        ids = [eid(*c) for c in cycle]
+        s = [1 if e[i][0] == c[0] else -1 for i, c in zip(ids, cycle)]
+        ref.append(sum(s[0] * s[j] * w[ids[j]] for j in range(3)))
+
+    C = curlop(g)
+    assert C.shape == (len(ref), g.ecount())
+    assert np.allclose(C.dot(w), ref)
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from scipy.integrate import odeint
+
+from dynamo.tools.utils import integrate_vf
+
+A = np.array([[-0.1, 1.0], [-1.0, -0.1]])
+Y0 = np.random.RandomState(0).normal(size=(4, 2)) * 3
+T = np.linspace(0, 5, 30)
+
+
+def f(x):
+    return A @ x
+
+
+@pytest.mark.parametrize("direction", ["forward", "backward", "both"])
+@pytest.mark.parametrize("average", [False, True])
+def test_integrate_vf_keeps_time_and_stacks_cells(direction, average):
+    t, Y = integrate_vf(Y0, T, (), direction, f, average=average)
+    # the input time points are returned unchanged, untiled
+    assert np.array_equal(t, T)
+
+    ref = []
+    for y0 in Y0:
+        y_f = odeint(lambda x, t: f(x), y0, T)
+        y_b = odeint(lambda x, t: f(x), y0, -T)
+        ref.append({"forward": y_f, "backward": y_b, "both": np.vstack((y_b[::-1], y_f))}[direction])
+    ref = np.array(ref)
+    assert np.allclose(Y, ref.mean(0) if average else ref.reshape((-1, 2)))
+
+
+@pytest.mark.parametrize("average", [False, True])
+def test_integrate_vf_interpolation(average):
+    # relaxation towards 10 from below keeps every coordinate increasing, so no time point is trimmed
+    g = lambda x: 0.5 * (10 - x)
+    t, Y = integrate_vf(Y0, T, (), "forward", g, interpolation_num=20, average=average)
+    # the moving test is on consecutive differences, so the last time point is never kept
+    grid = np.linspace(T[0], T[-2], 20)
+    ref = np.array([[np.interp(grid, T, odeint(lambda x, t: g(x), y0, T)[:, k]) for k in range(2)] for y0 in Y0])
+    ref = ref.transpose((0, 2, 1))
+    if average:
+        assert np.allclose(t, grid)
+        assert np.allclose(Y, ref.mean(0))
+    else:
+        assert np.allclose(t, np.tile(grid, len(Y0)))
+        assert np.allclose(Y, ref.reshape((-1, 2)))
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+import anndata
+
+from dynamo.vectorfield.scVectorField import vectorfield
+from dynamo.vectorfield.utils import (
+    Jacobian_rkhs_gaussian,
+    Jacobian_rkhs_gaussian_chunked,
+    subset_jacobian_transformation,
+    vector_field_function,
+    load_jacobian_gene,
+)
+from dynamo.vectorfield.vector_calculus import jacobian
+
+
+def _small_field(n=120, d=4, m=15, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.normal(size=(n, d))
+    vf_dict = {"X": X, "X_ctrl": X[rng.choice(n, m, replace=False)], "C": rng.normal(size=(m, d)), "beta": 0.3}
+    vf_dict["V"] = vector_field_function(X, vf_dict)
+    return vf_dict
+
+
+def _small_adata(vf_dict, n_genes=8, seed=0):
+    rng = np.random.RandomState(seed)
+    n, d = vf_dict["X"].shape
+    adata = anndata.AnnData(rng.normal(size=(n, n_genes)), obs=pd.DataFrame(index=[f"c{i}" for i in range(n)]),
+                            var=pd.DataFrame({"use_for_dynamics": True}, index=[f"g{i}" for i in range(n_genes)]))
+    adata.uns["PCs"] = np.linalg.qr(rng.normal(size=(n_genes, d)))[0]
+
+    vf = vectorfield()
+    vf.data["X"], vf.data["V"] = vf_dict["X"], vf_dict["V"]
+    vf.vf_dict["VecFld"] = vf_dict
+    vf.func = lambda x: vector_field_function(x, vf_dict)
+    return adata, vf
+
+
+def test_chunked_jacobian_matches_per_cell_jacobian():
+    vf_dict = _small_field()
+    x = vf_dict["X"]
+    Qi, Qj = np.random.RandomState(1).normal(size=(3, 4)), np.random.RandomState(2).normal(size=(5, 4))
+
+    J_ref = Jacobian_rkhs_gaussian(x, vf_dict)
+    for cores in [1, 2]:
+        Js, det, J_gene = Jacobian_rkhs_gaussian_chunked(x, vf_dict, Qi=Qi, Qj=Qj, chunk_size=17, cores=cores)
+        assert np.allclose(Js, J_ref, atol=1e-12)
+        assert np.allclose(det, [np.linalg.det(J_ref[:, :, i]) for i in range(x.shape[0])], atol=1e-12)
+        assert np.allclose(J_gene, subset_jacobian_transformation(J_ref, Qi, Qj), atol=1e-5)
+
+    assert np.allclose(Jacobian_rkhs_gaussian(x, vf_dict, vectorize=True), J_ref, atol=1e-12)
+
+
+def test_jacobian_gene_file_keeps_adata_writable(tmp_path):
+    vf_dict = _small_field()
+    genes = [f"g{i}" for i in range(5)]
+
+    adata, vf = _small_adata(vf_dict)
+    J_mem = jacobian(adata, regulators=genes, vector_field_class=vf, store_in_adata=False)["jacobian_gene"]
+
+    adata, vf = _small_adata(vf_dict)
+    jacobian(adata, regulators=genes, vector_field_class=vf, jacobian_gene_file=str(tmp_path / "J.npy"))
+    assert "jacobian_gene" not in adata.uns["jacobian_pca"]
+    assert np.allclose(load_jacobian_gene(adata.uns["jacobian_pca"]), J_mem)
+
+    adata.write_h5ad(tmp_path / "adata.h5ad")
+    J_dict = anndata.read_h5ad(tmp_path / "adata.h5ad").uns["jacobian_pca"]
+    assert np.allclose(load_jacobian_gene(J_dict), J_mem)
+
+
+def test_jacobian_methods_agree():
+    vf_dict = _small_field()
+    genes = [f"g{i}" for i in range(3)]
+    res = {}
+    for method in ["analytical", "parallel"]:
+        adata, vf = _small_adata(vf_dict)
+        res[method] = jacobian(adata, regulators=genes, vector_field_class=vf, method=method, cores=2,
+                               store_in_adata=False)
+    assert np.allclose(res["analytical"]["jacobian"], res["parallel"]["jacobian"], atol=1e-12)
+    assert np.allclose(res["analytical"]["jacobian_gene"], res["parallel"]["jacobian_gene"], atol=1e-5)
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from dynamo.estimation.tsc.estimation_kinetic import Estimation_DeterministicKin
+from dynamo.tools.sampling import lhsclassic
+from dynamo.tools.utils import map_genes
+
+
+def _draw(scale, random_state=None):
+    if scale < 0:
+        raise ValueError("negative scale")
+    return scale * random_state.rand(3)
+
+
+@pytest.mark.parametrize("backend, cores, chunk_size", [("thread", 2, 3), ("thread", 3, 1), ("joblib", 2, 4)])
+def test_map_genes_per_gene_random_states(backend, cores, chunk_size):
+    args = [(i,) for i in range(10)] + [(-1,)]
+    ref, ref_failed = map_genes(_draw, args, seed=7)
+
+    state = np.random.get_state()
+    res, failed = map_genes(_draw, args, backend=backend, cores=cores, chunk_size=chunk_size, seed=7)
+    # the global random state is left alone
+    assert np.array_equal(np.random.get_state()[1], state[1])
+
+    assert list(failed) == list(ref_failed) == [10] and res[10] is None
+    for i in range(10):
+        assert np.array_equal(res[i], ref[i])
+        assert np.array_equal(res[i], i * np.random.RandomState(7 + i).rand(3))
+
+
+def test_kinetic_estimation_initial_guesses():
+    est = Estimation_DeterministicKin(alpha=[0, 10], beta=[0, 5], gamma=[0, 2], x0=np.zeros((2, 2)))
+    # without a random state the latin hypercube samples use the fixed default seed
+    assert np.array_equal(est.sample_p0(5), est.sample_p0(5))
+
+    est.random_state = np.random.RandomState(3)
+    p0 = est.sample_p0(5)
+    ranges = np.array(est.ranges)
+    assert np.allclose((p0 - ranges[:, 0]) / (ranges[:, 1] - ranges[:, 0]),
+                       lhsclassic(5, est.n_params, seed=np.random.RandomState(3)))
@@ -0,0 +1,105 @@
+import sys
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from scipy.stats import mannwhitneyu
+
+import dynamo.tools  # noqa: F401
+
+markers = sys.modules["dynamo.tools.markers"]
+
+
+def _kept_control(ctrl, n_keep, sort_abs):
+    # the top `n_keep` values by value, or by absolute value with ties broken toward the larger value
+    order = np.lexsort((ctrl, np.abs(ctrl))) if sort_abs else np.argsort(ctrl, kind="stable")
+    return ctrl[order][len(ctrl) - n_keep:]
+
+
+def _reference(x, codes, pg, ph, subset, sort_abs):
+    n_k = np.bincount(codes)
+    rows = []
+    for g, h in zip(pg, ph):
+        test, ctrl = x[codes == g], x[codes == h]
+        if subset:
+            ctrl = _kept_control(ctrl, min(n_k[g], n_k[h]), sort_abs)
+        res = mannwhitneyu(test, ctrl, alternative="two-sided")
+        rows.append((res.statistic, res.pvalue, ctrl.sum(), (ctrl > 0).sum(), len(ctrl), (test > 0).mean()))
+    return np.array(rows)
+
+
+def _pairs(K):
+    pg, ph = np.nonzero(~np.eye(K, dtype=bool))
+    return pg, ph
+
+
+def _run(x, codes, subset, sort_abs):
+    K = codes.max() + 1
+    n_k = np.bincount(codes)
+    pg, ph = _pairs(K)
+    s = np.maximum(n_k[None, :] - n_k[:, None], 0) if subset else np.zeros((K, K), dtype=int)
+    idx = np.flatnonzero(x)
+    return markers._mwu_gene(x[idx], codes[idx], n_k, pg, ph, s, sort_abs), pg, ph
+
+
+@pytest.mark.parametrize("subset, sort_abs", [(False, False), (True, False), (True, True)])
+@pytest.mark.parametrize("seed", range(3))
+def test_mwu_gene_matches_scipy(subset, sort_abs, seed):
+    rng = np.random.RandomState(seed)
+    codes = np.repeat(np.arange(4), [30, 12, 5, 20])
+    # few distinct values with +-v pairs, so there are many ties, and small groups for the exact test
+    x = rng.choice([-2.0, -1.0, 0.0, 0.0, 1.0, 2.0, 3.5], size=len(codes))
+    if not sort_abs:
+        x = np.abs(x) + (rng.rand(len(codes)) < 0.3) * rng.rand(len(codes))
+    (nnz_k, sum_k, pos_k, U, pval, ctrl_sum, ctrl_pos), pg, ph = _run(x, codes, subset, sort_abs)
+    ref = _reference(x, codes, pg, ph, subset, sort_abs)
+
+    assert np.allclose(U, ref[:, 0])
+    assert np.allclose(pval, ref[:, 1])
+    assert np.allclose(ctrl_sum, ref[:, 2])
+    assert np.allclose(ctrl_pos, ref[:, 3])
+    assert np.array_equal(nnz_k, [np.count_nonzero(x[codes == k]) for k in range(4)])
+    assert np.allclose(sum_k, [x[codes == k].sum() for k in range(4)])
+    assert np.array_equal(pos_k, [(x[codes == k] > 0).sum() for k in range(4)])
+
+
+def test_mwu_gene_exact_small_groups():
+    # no ties and a group of at most 8 cells: scipy's exact test
+    rng = np.random.RandomState(0)
+    codes = np.repeat(np.arange(3), [6, 15, 8])
+    x = rng.permutation(np.arange(1, len(codes) + 1)).astype(float)
+    (_, _, _, U, pval, _, _), pg, ph = _run(x, codes, False, False)
+    ref = _reference(x, codes, pg, ph, False, False)
+    assert np.allclose(U, ref[:, 0])
+    assert np.allclose(pval, ref[:, 1])
+
+
+def test_mwu_gene_abs_ties_keep_positive_value():
+    # the control group keeps one value; -3 and 3 tie by absolute value and the positive one is kept
+    codes = np.array([0, 1, 1, 1, 1])
+    x = np.array([1.0, -3.0, 3.0, 0.5, 0.0])
+    (_, _, _, U, _, ctrl_sum, ctrl_pos), pg, ph = _run(x, codes, True, True)
+    pair = np.flatnonzero((pg == 0) & (ph == 1))[0]
+    assert ctrl_sum[pair] == 3.0
+    assert ctrl_pos[pair] == 1
+    assert U[pair] == 0
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+@pytest.mark.parametrize("subset", [False, True])
+def test_mwu_groups_diff_ratio_pos(sparse, subset):
+    rng = np.random.RandomState(1)
+    codes = np.repeat(np.arange(3), [25, 10, 40])
+    X = rng.poisson(0.8, size=(len(codes), 6)) * (rng.rand(len(codes), 6) < 0.7)
+    X = X.astype(float)
+    pg, ph = _pairs(3)
+    res = markers._mwu_groups(sp.csr_matrix(X) if sparse else X, codes, pg, ph, exp_frac_thresh=0,
+                              log2_fc_thresh=None, subset_control_vals=subset)
+    assert len(res) == X.shape[1] * len(pg)
+
+    for gene, pair, diff_ratio_pos, pval in res[["gene", "pair", "diff_ratio_pos", "pval"]].values:
+        gene, pair = int(gene), int(pair)
+        ref = _reference(X[:, gene], codes, pg[[pair]], ph[[pair]], subset, False)[0]
+        # the positive ratio of the (kept) control values, not of the test values
+        assert np.isclose(diff_ratio_pos, ref[5] - ref[3] / ref[4])
+        assert np.isclose(pval, ref[1])
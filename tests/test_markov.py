@@ -0,0 +1,138 @@
+import warnings
+import numpy as np
+import pytest
+import scipy.linalg
+import scipy.sparse as sp
+from sklearn.neighbors import NearestNeighbors
+
+from dynamo.tools.Markov import (
+    KernelMarkovChain,
+    compute_density_kernel,
+    compute_drift_kernel,
+    compute_drift_local_kernel,
+    propagate_distribution,
+    stationary_distribution_sparse,
+)
+from dynamo.tools.cell_velocities import _normalize_rows, diffusion, expected_return_time
+
+
+def _reference_transition_matrix(X, V, M_diff, Idx, epsilon=None, adaptive_local_kernel=False, tol=1e-4):
+    """The per-cell loop of the original `KernelMarkovChain.fit`."""
+    n = X.shape[0]
+    P = np.zeros((n, n))
+    inv_s = 1 / M_diff if np.isscalar(M_diff) else np.linalg.inv(M_diff)
+    if epsilon is not None:
+        Kd = np.zeros((n, n))
+        for i in range(n):
+            Kd[i, Idx[i]] = compute_density_kernel(X[i], X[Idx[i]], 1 / epsilon)
+        D = Kd.sum(0)
+
+    for i in range(n):
+        kernel = compute_drift_local_kernel if adaptive_local_kernel else compute_drift_kernel
+        k = kernel(X[i], V[i], X[Idx[i]], inv_s)
+        if epsilon is not None:
+            k = k / D[Idx[i]]
+        p = k / np.sum(k) if np.sum(k) > 0 else np.ones_like(k) / n
+        p[p <= tol] = 0
+        P[Idx[i], i] = p / np.sum(p)
+    return P
+
+
+@pytest.mark.parametrize("M_diff", [0.5, np.eye(3) * 0.7])
+@pytest.mark.parametrize("adaptive_local_kernel", [False, True])
+@pytest.mark.parametrize("epsilon", [None, 0.3])
+def test_kernel_markov_chain_matches_loop(M_diff, adaptive_local_kernel, epsilon):
+    rng = np.random.RandomState(0)
+    X, V = rng.normal(size=(200, 3)), 0.3 * rng.normal(size=(200, 3))
+    _, Idx = NearestNeighbors(n_neighbors=10).fit(X).kneighbors(X)
+
+    mc = KernelMarkovChain()
+    mc.fit(X, V, M_diff, neighbor_idx=Idx, epsilon=epsilon, adaptive_local_kernel=adaptive_local_kernel,
+           chunk_size=37)
+    P = _reference_transition_matrix(X, V, M_diff, Idx, epsilon, adaptive_local_kernel)
+
+    assert np.allclose(mc.P.toarray(), P, atol=1e-12)
+    assert np.allclose(mc.P.sum(0), 1)
+
+
+def test_kernel_markov_chain_sparse_construct_deprecated():
+    rng = np.random.RandomState(0)
+    X, V = rng.normal(size=(50, 2)), rng.normal(size=(50, 2))
+    _, Idx = NearestNeighbors(n_neighbors=5).fit(X).kneighbors(X)
+
+    with pytest.warns(DeprecationWarning):
+        KernelMarkovChain().fit(X, V, 1.0, neighbor_idx=Idx, sparse_construct=False)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", DeprecationWarning)
+        KernelMarkovChain().fit(X, V, 1.0, neighbor_idx=Idx)
+
+
+def _random_chain(n, seed=0, density=0.2):
+    rng = np.random.RandomState(seed)
+    P = sp.random(n, n, density=density, random_state=rng, format="csr") + sp.eye(n) * 0.1
+    return sp.diags(1 / np.asarray(P.sum(1)).ravel()).dot(P).tocsr()
+
+
+def _dense_stationary(P):
+    # left Perron eigenvector of a row-stochastic matrix
+    w, vl = scipy.linalg.eig(P, left=True, right=False)
+    p = np.real(vl[:, np.argmin(np.abs(w - 1))])
+    return p / p.sum()
+
+
+@pytest.mark.parametrize("method", ["eigs", "power"])
+def test_stationary_distribution_two_states(method):
+    P = np.array([[0.1, 0.9], [0.5, 0.5]])
+    ref = np.array([5 / 14, 9 / 14])
+    assert np.allclose(stationary_distribution_sparse(P, method=method), ref)
+    assert np.allclose(stationary_distribution_sparse(sp.csr_matrix(P), method=method), ref)
+    # the right eigenvector of the column-stochastic transpose
+    assert np.allclose(stationary_distribution_sparse(P.T, left=False, method=method), ref)
+    assert np.allclose(diffusion(P), ref)
+
+
+@pytest.mark.parametrize("n", [2, 30])
+@pytest.mark.parametrize("method", ["eigs", "power"])
+def test_stationary_distribution_matches_dense(n, method):
+    P = _random_chain(n, seed=n, density=0.6 if n == 2 else 0.2)
+    ref = _dense_stationary(P.A)
+    assert np.allclose(stationary_distribution_sparse(P, method=method), ref, atol=1e-10)
+    assert np.allclose(stationary_distribution_sparse(P.T.tocsr(), left=False, method=method), ref, atol=1e-10)
+    assert np.allclose(diffusion(P), ref, atol=1e-10)
+    assert np.allclose(expected_return_time(P), 1 / ref, rtol=1e-8)
+
+
+@pytest.mark.parametrize("n", [2, 30])
+def test_propagate_distribution_matches_matrix_power(n):
+    P = _random_chain(n, seed=1, density=0.6 if n == 2 else 0.2)
+    rng = np.random.RandomState(2)
+    p0, P0 = rng.dirichlet(np.ones(n)), rng.dirichlet(np.ones(n), size=4)
+    Pk = np.linalg.matrix_power(P.A, 5)
+
+    assert np.allclose(propagate_distribution(P, p0, steps=5), p0 @ Pk)
+    assert np.allclose(propagate_distribution(P, P0, steps=5), P0 @ Pk)
+    assert np.allclose(propagate_distribution(P.A, P0, steps=5), P0 @ Pk)
+    assert np.allclose(propagate_distribution(P, sp.csr_matrix(P0), steps=5).A, P0 @ Pk)
+    assert np.allclose(propagate_distribution(P.T.tocsr(), p0, steps=5, left=False), p0 @ Pk)
+
+    # diffusion with steps, as the old dense matrix powers
+    assert np.allclose(diffusion(P, p0, steps=5), p0 @ Pk)
+    assert np.allclose(diffusion(P, P0, steps=5), P0 @ Pk)
+    assert np.allclose(diffusion(P, steps=5), np.nanmean(P.A @ Pk, 0))
+
+
+def test_normalize_rows_and_backward_diffusion():
+    M = sp.random(20, 20, density=0.3, random_state=0, format="csr")
+    M = M.tolil()
+    M[3, :] = 0  # an empty row stays empty
+    M = M.tocsr()
+    ref = M.A / np.where(M.A.sum(1) == 0, 1, M.A.sum(1))[:, None]
+    assert sp.issparse(_normalize_rows(M))
+    assert np.allclose(_normalize_rows(M).A, ref)
+    assert np.allclose(_normalize_rows(M.A), ref)
+
+    P = _random_chain(20, seed=3)
+    back = P.A.T / P.A.T.sum(1)[:, None]
+    assert np.allclose(diffusion(P, backward=True), _dense_stationary(back), atol=1e-10)
+    p0 = np.ones(20) / 20
+    assert np.allclose(diffusion(P, p0, steps=3, backward=True), p0 @ np.linalg.matrix_power(back, 3))
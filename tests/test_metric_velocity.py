@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+
+from dynamo.tools.metric_velocity import neighbor_velocity_scores
+
+
+def _reference(V, rows, cols, method):
+    scores = np.zeros(len(rows))
+    for i, (r, c) in enumerate(zip(rows, cols)):
+        x, y = V[r], V[c]
+        if method == "correlation":
+            x, y = x - x.mean(), y - y.mean()
+        cos = x.dot(y) / (np.linalg.norm(x) * np.linalg.norm(y))
+        if method == "consensus":
+            cos *= min(np.linalg.norm(x), np.linalg.norm(y)) / max(np.linalg.norm(x), np.linalg.norm(y))
+        scores[i] = cos
+    return np.bincount(rows, scores, minlength=len(V)) / np.bincount(rows, minlength=len(V))
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+@pytest.mark.parametrize("method", ["cosine", "correlation", "consensus"])
+@pytest.mark.parametrize("offset", [0, 1e7])
+def test_neighbor_velocity_scores(sparse, method, offset):
+    rng = np.random.RandomState(0)
+    V = rng.normal(size=(50, 40)) * (rng.rand(50, 40) < 0.3) + offset
+    if offset == 0:
+        V[:, :3] = 0  # implicit zeros of the sparse matrix
+    # otherwise the variances are small compared to the squared means, where uncentered sums cancel
+    rows, cols = np.repeat(np.arange(45), 6), rng.randint(0, 50, 45 * 6)
+    ref = _reference(V, rows, cols, method)
+
+    scores = neighbor_velocity_scores(csr_matrix(V) if sparse else V, rows, cols, method=method, chunk_size=17)
+    # cells without pairs
+    assert np.isnan(scores[45:]).all()
+    assert np.allclose(scores[:45], ref[:45], rtol=0, atol=1e-9)
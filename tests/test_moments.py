@@ -0,0 +1,118 @@
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from anndata import AnnData
+from scipy.sparse import csr_matrix, issparse, lil_matrix
+
+from dynamo.tools.connectivity import k_nearest_neighbors
+from dynamo.tools.moments import calc_1nd_moment, calc_2nd_moment, gaussian_kernel, moments
+from dynamo.tools.connectivity import normalize_knn_graph
+
+moments_module = sys.modules["dynamo.tools.moments"]
+
+
+def _reference_gaussian_kernel(X, nbr_idx, sigma, dists):
+    n = X.shape[0]
+    W = lil_matrix((n, n))
+    s2_inv = 1 / (2 * sigma ** 2)
+    for i in range(n):
+        W[i, nbr_idx[i]] = np.exp(-s2_inv * dists[i] ** 2)
+    return W.tocsr()
+
+
+def test_gaussian_kernel_matches_loop():
+    X = np.random.RandomState(0).normal(size=(300, 5))
+    knn, dists = k_nearest_neighbors(X, k=10, use_cache=False)
+    ref = _reference_gaussian_kernel(X, knn, 2, dists)
+
+    assert np.allclose(gaussian_kernel(X, knn, sigma=2, dists=dists).A, ref.A)
+    # distances computed from X are euclidean distances as well
+    assert np.allclose(gaussian_kernel(X, knn, sigma=2, chunk_size=64).A, ref.A)
+
+
+def _adata(n=400, n_genes=20, seed=0):
+    rng = np.random.RandomState(seed)
+    layers = {key: rng.poisson(2, size=(n, n_genes)).astype(float) for key in ["X_spliced", "X_unspliced"]}
+    adata = AnnData(layers["X_spliced"].copy(), layers=layers)
+    adata.obsm["X"] = rng.normal(size=(n, 10))
+    adata.obs["group"] = pd.Categorical(rng.choice(list("abc"), n))
+    adata.uns["pp"] = {"norm_method": None}
+    return adata
+
+
+def _fake_umap_embedding(X, n_neighbors=30, return_mapper=True, use_cache=True, **kwargs):
+    # a deterministic stand-in for the umap graph: weighted kNN graph (self included) of the cells in X
+    knn, dists = k_nearest_neighbors(X, k=n_neighbors, use_cache=use_cache)
+    n = X.shape[0]
+    kNN = csr_matrix((np.exp(-dists.ravel()), (np.repeat(np.arange(n), knn.shape[1]), knn.ravel())), shape=(n, n))
+    return kNN, knn, dists, None
+
+
+@pytest.mark.parametrize("use_gaussian_kernel", [False, True])
+def test_group_connectivity_matches_block_assignment(monkeypatch, use_gaussian_kernel):
+    monkeypatch.setattr(moments_module, "umap_conn_indices_dist_embedding", _fake_umap_embedding)
+    adata = _adata()
+    X, cells_group = adata.obsm["X"], adata.obs["group"].values
+
+    # the block assignment of the connectivity graph of each group, as moments did before
+    ref = lil_matrix((adata.n_obs, adata.n_obs))
+    rows, cols, vals = [], [], []
+    for cur_grp in np.unique(cells_group):
+        cur_cells_ = np.where(cells_group == cur_grp)[0]
+        cur_kNN, cur_knn_indices, cur_knn_dists, _ = _fake_umap_embedding(
+            X[cur_cells_], n_neighbors=min(10, len(cur_cells_) - 1))
+        if use_gaussian_kernel:
+            cur_conn = gaussian_kernel(X[cur_cells_], cur_knn_indices, sigma=10, k=None, dists=cur_knn_dists)
+        else:
+            cur_conn = normalize_knn_graph(cur_kNN > 0)
+        ref[cur_cells_[:, None], cur_cells_] = cur_conn
+
+        r, c, v = moments_module.group_connectivity(cur_cells_, X, 10, use_gaussian_kernel)
+        rows.append(r), cols.append(c), vals.append(v)
+
+    conn = csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))), shape=ref.shape)
+    assert np.allclose(conn.A, ref.A)
+
+
+@pytest.mark.parametrize("use_gaussian_kernel", [False, True])
+def test_moments_grouped_threads_match_serial(monkeypatch, use_gaussian_kernel):
+    monkeypatch.setattr(moments_module, "umap_conn_indices_dist_embedding", _fake_umap_embedding)
+    a = moments(_adata(), group="group", n_neighbors=10, use_gaussian_kernel=use_gaussian_kernel, cores=1)
+    b = moments(_adata(), group="group", n_neighbors=10, use_gaussian_kernel=use_gaussian_kernel, cores=3)
+    assert np.allclose(a.obsp["moments_con"].A, b.obsp["moments_con"].A)
+    # no edges between groups
+    groups = a.obs["group"].values
+    r, c = a.obsp["moments_con"].nonzero()
+    assert (groups[r] == groups[c]).all()
+    for key in ["M_s", "M_u", "M_ss", "M_us", "M_uu"]:
+        assert np.allclose(a.layers[key], b.layers[key])
+
+
+@pytest.mark.parametrize("sparse_layers", [False, True])
+@pytest.mark.parametrize("chunk_size", [None, 7])
+def test_moments_chunked_match_per_layer_products(sparse_layers, chunk_size):
+    adata = _adata(n=200)
+    rng = np.random.RandomState(1)
+    adata.layers["X_new"] = rng.poisson(1, size=adata.shape).astype(float)
+    adata.layers["X_total"] = adata.layers["X_new"] + adata.layers["X_spliced"]
+    if sparse_layers:
+        for key in ["X_spliced", "X_unspliced", "X_new", "X_total"]:
+            adata.layers[key] = csr_matrix(adata.layers[key])
+    conn = csr_matrix(rng.rand(200, 200) * (rng.rand(200, 200) < 0.05) + np.eye(200))
+    layers = {key: adata.layers[key].copy() for key in adata.layers.keys()}
+
+    adata = moments(adata, conn=conn, chunk_size=chunk_size)
+
+    def dense(x):
+        return x.A if issparse(x) else np.asarray(x)
+
+    for key, m in zip(["X_spliced", "X_unspliced", "X_new", "X_total"], ["M_s", "M_u", "M_n", "M_t"]):
+        assert issparse(adata.layers[m]) == sparse_layers
+        assert np.allclose(dense(adata.layers[m]), dense(calc_1nd_moment(layers[key], conn)[0]))
+    for (x, y), m in zip([("X_unspliced", "X_spliced"), ("X_total", "X_new"), ("X_spliced", "X_spliced")],
+                         ["M_us", "M_tn", "M_ss"]):
+        assert np.allclose(dense(adata.layers[m]), dense(calc_2nd_moment(layers[x], layers[y], conn)))
+    # moments are only computed within the splicing or the labeling layers
+    assert "M_un" not in adata.layers.keys()
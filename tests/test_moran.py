@@ -0,0 +1,104 @@
+import sys
+
+import anndata
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+from scipy import stats
+
+import dynamo.tools  # noqa: F401
+
+markers = sys.modules["dynamo.tools.markers"]
+
+
+def _graph(n=60, k=5, seed=0):
+    rng = np.random.RandomState(seed)
+    G = np.zeros((n, n))
+    # cells on a ring, each linked to k of its 8 closest cells
+    for i in range(n):
+        G[i, (i + rng.choice([-4, -3, -2, -1, 1, 2, 3, 4], k, replace=False)) % n] = rng.rand(k) + 0.5
+    G[0] = 0  # an isolated cell keeps a zero row
+    return G
+
+
+def _reference(x, G, weighted=True):
+    """Moran's I, its moments under normality and randomization (Cliff and Ord) and local Moran's I, term by term."""
+    n = len(x)
+    W = G.copy() if weighted else (G > 0).astype(float)
+    for i in range(n):
+        if W[i].sum() > 0:
+            W[i] /= W[i].sum()
+    z = x - x.mean()
+    m2, m4 = (z ** 2).sum() / n, (z ** 4).sum() / n
+    S0 = sum(W[i, j] for i in range(n) for j in range(n))
+    S1 = 0.5 * sum((W[i, j] + W[j, i]) ** 2 for i in range(n) for j in range(n))
+    S2 = sum((W[i].sum() + W[:, i].sum()) ** 2 for i in range(n))
+    I = n / S0 * sum(W[i, j] * z[i] * z[j] for i in range(n) for j in range(n)) / (z ** 2).sum()
+
+    EI = -1 / (n - 1)
+    VI_norm = (n ** 2 * S1 - n * S2 + 3 * S0 ** 2) / ((n ** 2 - 1) * S0 ** 2) - EI ** 2
+    b2 = m4 / m2 ** 2
+    VI_rand = (n * ((n ** 2 - 3 * n + 3) * S1 - n * S2 + 3 * S0 ** 2)
+               - b2 * ((n ** 2 - n) * S1 - 2 * n * S2 + 6 * S0 ** 2)) / ((n - 1) * (n - 2) * (n - 3) * S0 ** 2) - EI ** 2
+    z_norm, z_rand = (I - EI) / np.sqrt(VI_norm), (I - EI) / np.sqrt(VI_rand)
+    local_I = np.array([z[i] / m2 * (W[i] * z).sum() for i in range(n)]) * (n - 1) / n
+    return {"I": I, "z_norm": z_norm, "z_rand": z_rand, "p_norm": stats.norm.sf(abs(z_norm)),
+            "p_rand": stats.norm.sf(abs(z_rand)), "local_I": local_I}
+
+
+def _data(n=60, seed=0):
+    rng = np.random.RandomState(seed)
+    G = _graph(n, seed=seed)
+    x_smooth = np.sin(np.arange(n) / n * 2 * np.pi) + 0.3 * rng.normal(size=n)
+    X = np.column_stack((rng.normal(size=n), x_smooth, rng.poisson(1.0, size=n), np.full(n, 2.5)))
+    return G, X
+
+
+@pytest.mark.parametrize("weighted", [True, False])
+@pytest.mark.parametrize("chunk_size, cores", [(None, 1), (1, 2)])
+def test_moran_genes_closed_form(weighted, chunk_size, cores):
+    G, X = _data()
+    W, s0, s1, s2 = markers._moran_weights(sp.csr_matrix(G), weighted)
+    res, local_I = markers._moran_genes(sp.csr_matrix(X), W, s0, s1, s2, permutations=0, local_moran=True,
+                                        chunk_size=chunk_size, cores=cores)
+    for j in range(3):
+        ref = _reference(X[:, j], G, weighted)
+        for key in ["I", "z_norm", "z_rand", "p_norm", "p_rand"]:
+            assert np.isclose(res[key][j], ref[key], rtol=1e-10, atol=1e-14), key
+        assert np.allclose(local_I[:, j], ref["local_I"])
+
+    # the constant gene has no defined statistics
+    for key in ["I", "z_norm", "z_rand", "p_norm", "p_rand"]:
+        assert np.isnan(res[key][3])
+
+
+def test_moran_genes_permutations():
+    G, X = _data()
+    W, s0, s1, s2 = markers._moran_weights(sp.csr_matrix(G))
+    res, _ = markers._moran_genes(X, W, s0, s1, s2, permutations=99, seed=0)
+
+    rng = np.random.default_rng(0)
+    perms = [rng.permutation(len(X)) for _ in range(99)]
+    for j in range(3):
+        I = _reference(X[:, j], G)["I"]
+        sim = np.array([_reference(X[p, j], G)["I"] for p in perms])
+        larger = min((sim >= I).sum(), 99 - (sim >= I).sum())
+        assert np.isclose(res["p_sim"][j], (larger + 1) / 100)
+        assert np.isclose(res["z_sim"][j], (I - sim.mean()) / sim.std())
+    assert np.isnan(res["p_sim"][3]) and np.isnan(res["z_sim"][3])
+
+
+def test_moran_i_skips_constant_genes_in_fdr():
+    G, X = _data()
+    genes = [f"g{i}" for i in range(X.shape[1])]
+    adata = anndata.AnnData(X, obs=pd.DataFrame(index=[f"c{i}" for i in range(len(X))]),
+                            var=pd.DataFrame(index=genes))
+    adata.obsp["connectivities"] = sp.csr_matrix(G)
+    adata.uns["neighbors"] = {}
+    markers.moran_i(adata, X_data=X, genes=genes, assumption="normality")
+
+    assert np.isnan(adata.var.loc["g3", ["moran_i", "moran_p_val", "moran_q_val", "moran_z"]].astype(float)).all()
+    p = adata.var["moran_p_val"].values[:3]
+    assert np.allclose(adata.var["moran_q_val"].values[:3], markers.fdr(p))
+    assert adata.var.loc["g1", "moran_i"] > 0.3 and adata.var.loc["g1", "moran_p_val"] < 1e-3
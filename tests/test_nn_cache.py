@@ -0,0 +1,95 @@
+from multiprocessing.dummy import Pool as ThreadPool
+
+import numpy as np
+import pytest
+from sklearn.neighbors import NearestNeighbors
+
+from dynamo.tools import connectivity
+from dynamo.tools.connectivity import clear_nn_cache, k_nearest_neighbors
+from dynamo.tools.Markov import compute_tau
+
+
+@pytest.fixture(autouse=True)
+def _empty_cache():
+    clear_nn_cache()
+    yield
+    clear_nn_cache()
+
+
+def _X(n=500, d=5, seed=0):
+    return np.random.RandomState(seed).normal(size=(n, d))
+
+
+def test_knn_matches_fresh_search_and_slices_cached_neighbors():
+    X = _X()
+    dists, knn = NearestNeighbors(n_neighbors=15).fit(X).kneighbors(X)
+    knn_, dists_, index = k_nearest_neighbors(X, k=15, return_index=True)
+    assert np.array_equal(knn_, knn) and np.allclose(dists_, dists)
+
+    knn_, dists_, index_ = k_nearest_neighbors(X, k=5, return_index=True)
+    assert index_ is index and np.array_equal(knn_, knn[:, :5])
+    knn_, _, index_ = k_nearest_neighbors(X, k=20, return_index=True)
+    assert index_ is index and np.array_equal(knn_[:, :15], knn)
+    assert len(connectivity._nn_index_cache) == 1
+
+
+def test_knn_cache_hits_and_misses():
+    X = _X()
+    _, _, index = k_nearest_neighbors(X, k=10, return_index=True)
+    # views of the same buffer and copies of the same content hit
+    assert k_nearest_neighbors(X[:, :], k=10, return_index=True)[2] is index
+    assert k_nearest_neighbors(X.copy(), k=10, return_index=True)[2] is index
+    assert k_nearest_neighbors(X[:, :4], k=10, return_index=True)[2] is not index
+    # any difference in the search parameters misses
+    for kwargs in [dict(basis="pca"), dict(metric="manhattan"), dict(metric="minkowski", metric_kwds={"p": 3}),
+                   dict(leaf_size=10), dict(method="brute")]:
+        assert k_nearest_neighbors(X, k=10, return_index=True, **kwargs)[2] is not index
+    # identified by the buffer, a copy of the data and a different slice of the same buffer miss
+    index = k_nearest_neighbors(X, k=10, fingerprint=False, return_index=True)[2]
+    assert k_nearest_neighbors(X[:, :], k=10, fingerprint=False, return_index=True)[2] is index
+    assert k_nearest_neighbors(X.copy(), k=10, fingerprint=False, return_index=True)[2] is not index
+    assert k_nearest_neighbors(X[:, :4], k=10, fingerprint=False, return_index=True)[2] is not index
+    # frozen keyword arguments hit
+    a = k_nearest_neighbors(X, k=10, metric="minkowski", metric_kwds={"p": 3}, return_index=True)[2]
+    assert k_nearest_neighbors(X, k=10, metric="minkowski", metric_kwds={"p": 3}, return_index=True)[2] is a
+    # not cached
+    assert k_nearest_neighbors(X, k=10, return_index=True, use_cache=False)[2] is not index
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_knn_cache_default_detects_inplace_changes(sparse):
+    X = _X()
+    if sparse:
+        from scipy.sparse import csr_matrix
+
+        X = csr_matrix(X)
+    stale, _ = k_nearest_neighbors(X, k=10)
+    if sparse:
+        X.data[:] = np.random.RandomState(1).normal(size=X.nnz)
+    else:
+        X[:] = np.random.RandomState(1).normal(size=X.shape)
+    knn, _ = k_nearest_neighbors(X, k=10)
+    assert np.array_equal(knn, k_nearest_neighbors(X, k=10, use_cache=False)[0])
+    assert not np.array_equal(knn, stale)
+    assert len(connectivity._nn_index_cache) == 2
+
+
+def test_knn_cache_threads():
+    Xs = [_X(n=200, seed=i) for i in range(20)]
+    refs = [NearestNeighbors(n_neighbors=8).fit(X).kneighbors(X)[1] for X in Xs]
+    pool = ThreadPool(4)
+    res = pool.map(lambda i: k_nearest_neighbors(Xs[i % 20], k=8 - i // 20)[0], range(60))
+    pool.close()
+    pool.join()
+    for i, knn in enumerate(res):
+        assert np.array_equal(knn, refs[i % 20][:, :8 - i // 20])
+    assert len(connectivity._nn_index_cache) <= connectivity.nn_cache_size
+
+
+def test_compute_tau():
+    X, V = _X(), _X(seed=1)
+    knn, dists = k_nearest_neighbors(X, k=10, use_cache=False)
+    tau, v = compute_tau(X, V, k=10)
+    assert np.allclose(v, np.linalg.norm(V, axis=1))
+    assert np.allclose(tau, dists[:, 1:].mean(1) / v)
+    assert np.allclose(compute_tau(X, V, nbr_idx=knn)[0], tau)
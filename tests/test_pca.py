@@ -0,0 +1,70 @@
+import anndata
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from sklearn.decomposition import PCA
+
+from dynamo.preprocessing.utils import pca
+
+
+def _counts(n_obs=300, n_var=60, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.poisson(rng.gamma(0.3, 2, size=(1, n_var)) * rng.gamma(2, 0.5, size=(n_obs, 1)))
+    return np.log1p(X.astype(float))
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32, np.int64])
+def test_sparse_pca_matches_dense(dtype):
+    X = _counts().astype(dtype)
+    X_sparse = sp.csr_matrix(X)
+    adata = anndata.AnnData(X=X.astype(float))
+
+    _, fit, X_pca = pca(adata, X_sparse, n_pca_components=10)
+    ref = PCA(n_components=10, svd_solver="arpack", random_state=0).fit(X.astype(np.float64))
+
+    assert isinstance(fit, PCA)
+    assert np.allclose(X_pca, ref.transform(X.astype(np.float64)), atol=1e-8)
+    assert np.allclose(fit.components_, ref.components_, atol=1e-8)
+    assert np.allclose(fit.mean_, ref.mean_)
+    assert np.allclose(fit.explained_variance_, ref.explained_variance_)
+    assert np.allclose(fit.explained_variance_ratio_, ref.explained_variance_ratio_)
+    assert np.allclose(fit.noise_variance_, ref.noise_variance_)
+    assert np.allclose(adata.uns["explained_variance_ratio_"], ref.explained_variance_ratio_)
+    assert np.allclose(adata.uns["PCs"], ref.components_.T, atol=1e-8)
+
+    # the fitted object transforms sparse and dense input alike and inverts the dense projection
+    assert np.allclose(fit.transform(X_sparse[:20]), fit.transform(X[:20].astype(np.float64)))
+    assert np.allclose(fit.inverse_transform(X_pca), ref.inverse_transform(X_pca), atol=1e-8)
+
+
+def test_sparse_pca_does_not_modify_input():
+    X_sparse = sp.csr_matrix(_counts())
+    data = X_sparse.data.copy()
+    pca(anndata.AnnData(X=X_sparse.copy()), X_sparse, n_pca_components=5)
+    assert np.array_equal(X_sparse.data, data)
+
+
+def test_sparse_pca_variance_with_large_offset():
+    # sum(x^2) - n * mean^2 cancels catastrophically for a large mean and a small spread
+    X = 1e8 + np.random.RandomState(1).rand(300, 20)
+    _, fit, _ = pca(anndata.AnnData(X=X), sp.csr_matrix(X), n_pca_components=5)
+    ref = PCA(n_components=5, svd_solver="arpack", random_state=0).fit(X)
+
+    assert np.allclose(fit.explained_variance_ratio_, ref.explained_variance_ratio_)
+    assert np.allclose(fit.noise_variance_, ref.noise_variance_)
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+def test_incremental_pca_matches_dense(sparse):
+    rng = np.random.RandomState(2)
+    X = rng.randn(300, 3) * [5, 3, 2] @ rng.randn(3, 40) + 0.1 * rng.randn(300, 40)
+    adata = anndata.AnnData(X=X)
+
+    _, fit, X_pca = pca(adata, sp.csr_matrix(X) if sparse else X, n_pca_components=3, incremental=True, batch_size=70)
+    ref = PCA(n_components=3, svd_solver="full").fit(X)
+    signs = np.sign(np.sum(fit.components_ * ref.components_, 1))
+
+    assert np.allclose(fit.components_ * signs[:, None], ref.components_, atol=1e-5)
+    assert np.allclose(X_pca * signs, ref.transform(X), atol=1e-5)
+    assert np.allclose(fit.explained_variance_ratio_, ref.explained_variance_ratio_)
+    assert np.allclose(adata.uns["PCs"], fit.components_.T)
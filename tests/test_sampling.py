@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from dynamo.tools.sampling import TRNET, trn_steps
+
+
+def _run_reference(trnet, P, tmax, li, lf, ei, ef, c):
+    """The original TRN loop with one `TRNET.runOnce` call per step."""
+    for t in range(1, tmax + 1):
+        tt = t / tmax
+        l = li * np.power(lf / li, tt)
+        ep = ei * np.power(ef / ei, tt)
+        trnet.runOnce(P[t - 1], l, ep, c)
+    return trnet.W
+
+
+@pytest.mark.parametrize("n_nodes", [20, 300])
+@pytest.mark.parametrize("c", [0, 1e-3])
+def test_trn_steps_match_run_once(n_nodes, c):
+    rng = np.random.RandomState(0)
+    X = rng.rand(500, 3)
+
+    trnet = TRNET(n_nodes, X, seed=7)
+    # duplicated initial nodes have tied distances to every sample
+    trnet.W = np.array(trnet.W, dtype=float)
+    trnet.W[1::4] = trnet.W[::4][: len(trnet.W[1::4])]
+    W0 = trnet.W.copy()
+
+    tmax, li, lf, ei, ef = 2 * n_nodes, 0.2 * n_nodes, 0.01, 0.3, 0.05
+    P = np.asarray(trnet.draw_sample(tmax), dtype=float)
+
+    W = trn_steps(W0.copy(), P, 1, tmax, tmax, li, lf, ei, ef, c)
+    W_ref = _run_reference(trnet, P, tmax, li, lf, ei, ef, c)
+
+    np.testing.assert_allclose(W, W_ref, rtol=1e-10, atol=1e-12)
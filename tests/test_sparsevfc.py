@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from dynamo.vectorfield.scVectorField import SparseVFC
+
+
+def _data(N=600, d=2, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.normal(size=(N, d))
+    Y = -X + 0.1 * rng.normal(size=(N, d))
+    Y[: N // 20] = 3 * rng.normal(size=(N // 20, d))  # outliers
+    return X, Y
+
+
+def test_sparsevfc_single_chunk_is_identical():
+    X, Y = _data()
+    a = SparseVFC(X, Y, None, M=30, MaxIter=15, verbose=0)
+    b = SparseVFC(X, Y, None, M=30, MaxIter=15, verbose=0, chunk_size=len(X))
+    for key in ["C", "P", "V", "sigma2"]:
+        assert np.array_equal(a[key], b[key])
+
+
+@pytest.mark.parametrize("chunk_size", [97, 250])
+def test_sparsevfc_chunks_match_full_solver(chunk_size):
+    X, Y = _data()
+    a = SparseVFC(X, Y, None, M=30, MaxIter=10, ecr=1e-12, verbose=0)
+    b = SparseVFC(X, Y, None, M=30, MaxIter=10, ecr=1e-12, verbose=0, chunk_size=chunk_size)
+    assert a["iteration"] == b["iteration"]
+    # only the summation order differs, but the Gaussian kernel normal equations amplify it to ~1e-6
+    assert np.allclose(a["C"], b["C"], rtol=0, atol=1e-5 * np.abs(a["C"]).max())
+    assert np.allclose(a["V"], b["V"], atol=1e-5)
+    assert np.allclose(a["P"], b["P"], atol=1e-5)
+    assert np.isclose(a["sigma2"], b["sigma2"], rtol=1e-6)
+
+
+def test_sparsevfc_chunks_reject_div_cur_free_kernels():
+    X, Y = _data(N=100)
+    with pytest.raises(ValueError):
+        SparseVFC(X, Y, None, M=10, MaxIter=2, verbose=0, div_cur_free_kernels=True, chunk_size=10)
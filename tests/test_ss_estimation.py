@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+
+from dynamo.estimation.csc.velocity import ss_estimation
+
+
+def _data(n_genes=40, n_cells=300, seed=0):
+    rng = np.random.RandomState(seed)
+    gamma = rng.uniform(0.2, 2, size=(n_genes, 1))
+    S = rng.gamma(2, 2, size=(n_genes, n_cells))
+    U = gamma * S + rng.normal(scale=0.5, size=S.shape)
+    U[U < 0] = 0
+    S[:, rng.rand(n_cells) < 0.2] = 0  # ties in the percentiles
+    return U, S
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+@pytest.mark.parametrize("intercept, perc_left, perc_right", [(False, None, 5), (True, None, 5), (True, 10, 20)])
+def test_fit_gamma_steady_state_batch_matches_per_gene(sparse, intercept, perc_left, perc_right):
+    U, S = _data()
+    if sparse:
+        U, S = csr_matrix(U), csr_matrix(S)
+    est = ss_estimation(U=U, S=S, est_method="ols")
+
+    batch = est.fit_gamma_steady_state_batch(U, S, intercept, perc_left, perc_right, chunk_size=7)
+    ref = np.array([est.fit_gamma_steady_state(U[i], S[i], intercept, perc_left, perc_right)
+                    for i in range(U.shape[0])]).T
+    for b, r in zip(batch, ref):
+        assert np.allclose(b, r, rtol=1e-8, atol=1e-10)
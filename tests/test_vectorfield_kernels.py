@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist
+
+from dynamo.vectorfield.utils import (
+    Jacobian_rkhs_gaussian,
+    Jacobian_rkhs_gaussian_block,
+    con_K,
+    con_K_dot,
+    sqdist,
+    vector_field_function,
+)
+
+
+def _field(offset=0.0, n=300, d=5, m=40, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.normal(size=(n, d)) + offset
+    return X, {"X_ctrl": X[rng.choice(n, m, replace=False)], "C": rng.normal(size=(m, d)), "beta": 0.5}
+
+
+@pytest.mark.parametrize("offset", [0.0, 1e4])
+def test_sqdist_matches_cdist(offset):
+    X, vf_dict = _field(offset)
+    D_ref = cdist(X, vf_dict["X_ctrl"], "sqeuclidean")
+    assert np.allclose(sqdist(X, vf_dict["X_ctrl"], block_size=37), D_ref, rtol=1e-9, atol=1e-9)
+    assert np.allclose(con_K(X, vf_dict["X_ctrl"], 0.5, method="sqdist"), np.exp(-0.5 * D_ref), atol=1e-6)
+
+
+@pytest.mark.parametrize("offset", [0.0, 1e4])
+def test_vector_field_function_matches_full_kernel(offset):
+    X, vf_dict = _field(offset)
+    V_ref = np.exp(-vf_dict["beta"] * cdist(X, vf_dict["X_ctrl"], "sqeuclidean")).dot(vf_dict["C"])
+
+    assert np.allclose(vector_field_function(X, vf_dict), V_ref, atol=1e-8)
+    assert np.allclose(con_K_dot(X, vf_dict["X_ctrl"], vf_dict["beta"], vf_dict["C"], block_size=13), V_ref, atol=1e-8)
+    assert np.allclose(vector_field_function(X, vf_dict, method="cdist"), V_ref, atol=1e-8)
+    assert np.allclose(vector_field_function(X, vf_dict, dim=[1, 3]), V_ref[:, [1, 3]], atol=1e-8)
+    assert vector_field_function(X[0], vf_dict).shape == (X.shape[1],)
+
+    with pytest.raises(ValueError):
+        vector_field_function(X, vf_dict, return_d=True)
+    with pytest.raises(ValueError):
+        vector_field_function(X, vf_dict, method="unknown")
+
+
+def test_jacobian_block_far_from_origin():
+    X, vf_dict = _field(1e4, n=50)
+    J_ref = np.transpose(Jacobian_rkhs_gaussian(X, vf_dict), axes=(2, 0, 1))
+    assert np.allclose(Jacobian_rkhs_gaussian_block(X, vf_dict), J_ref, rtol=1e-6, atol=1e-8)
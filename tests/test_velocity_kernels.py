@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from dynamo.tools.cell_velocities import kernels_from_velocyto_scvelo
+from dynamo.tools.connectivity import k_nearest_neighbors
+from dynamo.tools.utils import (
+    append_iterative_neighbor_indices,
+    einsum_correlation,
+    get_iterative_indices,
+    iterative_neighbor_graph,
+)
+
+
+def _indices(n=120, k=6, seed=0, with_nan=False):
+    X = np.random.RandomState(seed).normal(size=(n, 4))
+    indices = k_nearest_neighbors(X, k=k, use_cache=False)[0][:, 1:]
+    if with_nan:
+        indices = indices.astype(float)
+        indices[::7, -2:] = np.nan
+    return indices
+
+
+@pytest.mark.parametrize("n_recurse_neighbors", [1, 2, 3])
+@pytest.mark.parametrize("with_nan", [False, True])
+def test_iterative_neighbor_graph_matches_recursion(n_recurse_neighbors, with_nan):
+    indices = _indices(with_nan=with_nan)
+    G = iterative_neighbor_graph(indices, n_recurse_neighbors)
+    for i in range(len(indices)):
+        assert np.array_equal(G[i].indices, get_iterative_indices(indices, i, n_recurse_neighbors))
+
+    rows = np.array([3, 0, 57])
+    G_rows = iterative_neighbor_graph(indices, n_recurse_neighbors, rows=rows)
+    assert np.array_equal(G_rows.A, G[rows].A)
+
+
+def test_iterative_neighbor_graph_max_neighs():
+    indices = _indices()
+    # the cap draws the same random subsets (up to order) as the recursion, cell after cell
+    np.random.seed(0)
+    ref = [np.sort(get_iterative_indices(indices, i, 3, max_neighs=15)) for i in range(len(indices))]
+    np.random.seed(0)
+    G = iterative_neighbor_graph(indices, 3, max_neighs=15)
+    assert np.diff(G.indptr).max() == 15
+    for i in range(len(indices)):
+        assert np.array_equal(G[i].indices, ref[i])
+
+    np.random.seed(0)
+    rec = append_iterative_neighbor_indices(indices, 3, max_neighs=15)
+    assert all(np.array_equal(a, b) for a, b in zip(rec, ref))
+
+
+def _kernel_data(n=150, d=8, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.normal(size=(n, d))
+    V = rng.normal(size=(n, d))
+    V[5] = 0  # a cell without velocity
+    X_embedding = X[:, :2] + 0.1 * rng.normal(size=(n, 2))
+    return X, X_embedding, V, _indices(n, k=8, seed=seed)
+
+
+@pytest.mark.parametrize("kernel", ["pearson", "cosine"])
+@pytest.mark.parametrize("transform", ["sqrt", "log", "logratio", "linear"])
+@pytest.mark.parametrize("neg_cells_trick", [False, True])
+def test_kernels_chunked_match_unchunked(kernel, transform, neg_cells_trick):
+    X, X_embedding, V, indices = _kernel_data()
+    args = (X, X_embedding, V, indices, neg_cells_trick, [20, 20])
+    kwargs = dict(kernel=kernel, transform=transform)
+    T, delta_X = kernels_from_velocyto_scvelo(*args, **kwargs)[:2]
+    for chunk_size in [1, 37, 500]:
+        T_c, delta_X_c = kernels_from_velocyto_scvelo(*args, chunk_size=chunk_size, **kwargs)[:2]
+        assert np.array_equal(T_c.indptr, T.indptr) and np.array_equal(T_c.indices, T.indices)
+        assert np.array_equal(T_c.data, T.data)
+        np.testing.assert_array_equal(delta_X_c, delta_X)
+
+
+@pytest.mark.parametrize("kernel", ["pearson", "cosine"])
+def test_kernel_values_match_per_cell_correlation(kernel):
+    X, X_embedding, V, indices = _kernel_data()
+    T = kernels_from_velocyto_scvelo(X, X_embedding, V, indices, False, [20, 20], kernel=kernel, transform="linear",
+                                     chunk_size=64)[0].tocsr()
+    # off the diagonal, each row is proportional to exp(corr / 0.1) - 1 of the positive correlations between the
+    # displacements to the recursive neighbors and the velocity, as in the old per-cell loop
+    for i in [0, 1, 42, 149]:
+        i_vals = get_iterative_indices(indices, i, 2)
+        i_vals = i_vals[i_vals != i]
+        corr = einsum_correlation(X[i_vals] - X[i], V[i], type=kernel).ravel()
+        w = np.expm1(np.clip(np.nan_to_num(corr), 0, None) / 0.1)
+        row = T[i, i_vals].A.ravel()
+        assert np.allclose(row / row.sum(), w / w.sum())
+        assert set(T[i].indices) <= set(i_vals)
+    assert T[5].nnz == 0